@@ -7,13 +7,15 @@ __copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
 
 from django.contrib import admin
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, Q
 from django import forms
 from django.contrib.admin import helpers
-from django.utils.encoding import force_text
+from django.utils.encoding import force_str
 
 from polymorphic.admin import PolymorphicInlineSupportMixin, StackedPolymorphicInline
 
 from .models import *
+from .instrumentation import timed
 
 
 @admin.register(UserChoice)
@@ -21,6 +23,13 @@ class UserChoiceAdmin(admin.ModelAdmin):
     prepopulated_fields = { 'display' : ('value', ) }
 
 
+@admin.register(FormProjection)
+class FormProjectionAdmin(admin.ModelAdmin):
+    list_display = ('form', 'mode', 'schema_version', 'rebuilt', 'refreshed')
+    filter_horizontal = ('content_types', )
+    readonly_fields = ('schema_version', 'rebuilt', 'refreshed')
+
+
 class FieldInline(StackedPolymorphicInline):
     model = Field
     child_inlines = []
@@ -100,13 +109,49 @@ class FormAdmin(PolymorphicInlineSupportMixin, admin.ModelAdmin):
         )
 
     inlines = (FieldInline, )
-    list_display = ('name', 'n_fields')
+    list_display = ('name', 'n_fields', 'field_types', 'modified')
     # Allow "Save as new" for quick duplication of forms
     save_as = True
 
+    def get_field_types(self):
+        """
+        Returns a list of ``(annotation name, field model)`` pairs for the
+        concrete field types.
+        """
+        return [
+            ('n_{}'.format(model._meta.model_name), model)
+            for model in Field.subclass_paths()
+            if model.form_field_class
+        ]
+
+    def get_queryset(self, request):
+        # Annotate the field counts in the changelist query rather than
+        # counting the fields for each row
+        field_types = self.get_field_types()
+        content_types = ContentType.objects.get_for_models(
+            *(model for _, model in field_types),
+            for_concrete_models = False
+        )
+        return super().get_queryset(request).annotate(
+            n_fields = Count('field'),
+            **{
+                name : Count('field', filter = Q(field__polymorphic_ctype = content_types[model]))
+                for name, model in field_types
+            }
+        )
+
     def n_fields(self, obj):
-        return obj.fields.count()
+        return obj.n_fields
     n_fields.short_description = '# fields'
+    n_fields.admin_order_field = 'n_fields'
+
+    def field_types(self, obj):
+        return ', '.join(
+            '{} × {}'.format(getattr(obj, name), model._meta.verbose_name)
+            for name, model in self.get_field_types()
+            if getattr(obj, name)
+        )
+    field_types.short_description = 'field types'
 
 
 ################################################################################
@@ -136,25 +181,88 @@ class HasMetadataModelAdmin(admin.ModelAdmin):
         Gets the initial data for the metadata form. By default, this just
         returns the metadata currently attached to the object.
         """
-        ctype = ContentType.objects.get_for_model(obj)
-        metadata = Metadatum.objects.filter(content_type = ctype, object_id = obj.pk)
-        return { d.key : d.value for d in metadata.all() }
+        return dict(self._get_stored_metadata(request, obj))
+
+    def _memoise(self, request, obj, key, factory):
+        # Memoise values for the object on the request, so that the hooks that
+        # are called during a single request share them
+        memo = request.__dict__.setdefault('_jasmin_metadata_memo', {})
+        # Model instances are not hashable before they are saved, so use the id
+        # and keep a reference to the object so that the id can't be reused
+        _, values = memo.setdefault(id(obj), (obj, {}))
+        if key not in values:
+            values[key] = factory()
+        return values[key]
+
+    def _get_stored_metadata(self, request, obj):
+        # The metadata currently attached to the object, read once per request
+        def factory():
+            if obj is None or obj.pk is None:
+                return {}
+            return { d.key : d.value for d in Metadatum.objects.for_object(obj) }
+        return self._memoise(request, obj, 'stored', factory)
+
+    def get_memoised_metadata_form_class(self, request, obj):
+        """
+        Returns the result of :py:meth:`get_metadata_form_class`, computing it
+        only once per request.
+        """
+        return self._memoise(
+            request, obj, 'form_class',
+            lambda: self.get_metadata_form_class(request, obj)
+        )
+
+    def get_memoised_metadata_form_initial_data(self, request, obj):
+        """
+        Returns the result of :py:meth:`get_metadata_form_initial_data`, computing
+        it only once per request.
+        """
+        return self._memoise(
+            request, obj, 'initial',
+            lambda: self.get_metadata_form_initial_data(request, obj)
+        )
+
+    def get_metadata_form(self, request, obj, bound):
+        """
+        Returns the metadata form instance for the object, creating it only once
+        per request. If ``bound`` is true, the form is bound to the submitted data,
+        so it is only validated once however many hooks check it. Otherwise it is
+        populated with the initial data.
+        """
+        def factory():
+            metadata_form_class = self.get_memoised_metadata_form_class(request, obj)
+            if bound:
+                return metadata_form_class(data = request.POST, prefix = 'metadata')
+            else:
+                return metadata_form_class(
+                    initial = self.get_memoised_metadata_form_initial_data(request, obj),
+                    prefix = 'metadata'
+                )
+        return self._memoise(request, obj, ('form', bound), factory)
 
+    @timed('admin.save_model', queries = True)
     def save_model(self, request, obj, form, change):
         #####
         ## Override save_model to only save the model if the metadata is also valid
         #####
-        metadata_form_class = self.get_metadata_form_class(request, obj)
+        metadata_form_class = self.get_memoised_metadata_form_class(request, obj)
         # If there is no metadata form, behave as normal
         if not metadata_form_class:
             return super().save_model(request, obj, form, change)
         # If the metadata is valid, save the object and the metadata
         if '_has_metadata' in request.POST:
-            metadata_form = metadata_form_class(data = request.POST, prefix = 'metadata')
+            metadata_form = self.get_metadata_form(request, obj, bound = True)
             if metadata_form.is_valid():
+                # Give the form the stored metadata, before the object is saved, so
+                # that only the fields that were changed are written
+                # This is not the initial data, which subclasses may override, e.g.
+                # to prefill fields, and those values must still be written
+                metadata_form.initial = self._get_stored_metadata(request, obj)
+                metadata_form.__dict__.pop('changed_data', None)
                 super().save_model(request, obj, form, change)
-                metadata_form.save(obj)
+                metadata_form.save(obj, only_changed = True)
 
+    @timed('admin.response_add', queries = True)
     def response_add(self, request, obj, post_url_continue = None):
         #####
         ## Override response_add to collect metadata after the object is fully
@@ -164,22 +272,19 @@ class HasMetadataModelAdmin(admin.ModelAdmin):
         ## required metadata is dependent on an objects state in an intuitive way
         #####
         # If there is no metadata form, behave as normal
-        metadata_form_class = self.get_metadata_form_class(request, obj)
+        metadata_form_class = self.get_memoised_metadata_form_class(request, obj)
         # If there is no metadata form, behave as normal
         if not metadata_form_class:
             return super().response_add(request, obj, post_url_continue)
         if '_has_metadata' in request.POST:
             # If the submit supposedly has metadata, validate it
             # If the metadata is valid (and hence has been saved), behave as normal
-            metadata_form = metadata_form_class(data = request.POST, prefix = 'metadata')
+            metadata_form = self.get_metadata_form(request, obj, bound = True)
             if metadata_form.is_valid():
                 return super().response_add(request, obj, post_url_continue)
         else:
             # If there is no metadata in the submit, create the form
-            metadata_form = metadata_form_class(
-                initial = self.get_metadata_form_initial_data(request, obj),
-                prefix = 'metadata'
-            )
+            metadata_form = self.get_metadata_form(request, obj, bound = False)
         #######
         ## THIS CODE IS SIMILAR TO changeform_view
         #######
@@ -209,7 +314,7 @@ class HasMetadataModelAdmin(admin.ModelAdmin):
         if metadata_form.errors:
             errors.extend(metadata_form.errors.values())
         context = dict(self.admin_site.each_context(request),
-            title = 'Set metadata for {}'.format(force_text(self.model._meta.verbose_name)),
+            title = 'Set metadata for {}'.format(force_str(self.model._meta.verbose_name)),
             adminform = admin_form,
             metadata_form = metadata_admin_form,
             object_id = obj.pk,
@@ -223,20 +328,21 @@ class HasMetadataModelAdmin(admin.ModelAdmin):
         )
         return self.render_change_form(request, context, add = True, change = False, obj = obj)
 
+    @timed('admin.response_change', queries = True)
     def response_change(self, request, obj):
         #####
         ## Override response_change to ensure that the metadata is valid before
         ## proceeding with the normal action
         #####
         # If there is no metadata form, behave as normal
-        metadata_form_class = self.get_metadata_form_class(request, obj)
+        metadata_form_class = self.get_memoised_metadata_form_class(request, obj)
         # If there is no metadata form, behave as normal
         if not metadata_form_class:
             return super().response_change(request, obj)
         if '_has_metadata' in request.POST:
             # If the submit supposedly has metadata, validate it
             # If the metadata is valid (and hence has been saved), behave as normal
-            metadata_form = metadata_form_class(data = request.POST, prefix = 'metadata')
+            metadata_form = self.get_metadata_form(request, obj, bound = True)
             if metadata_form.is_valid():
                 return super().response_change(request, obj)
         #######
@@ -254,7 +360,7 @@ class HasMetadataModelAdmin(admin.ModelAdmin):
         )
         media = self.media + admin_form.media
         context = dict(self.admin_site.each_context(request),
-            title = 'Change {}'.format(force_text(self.model._meta.verbose_name)),
+            title = 'Change {}'.format(force_str(self.model._meta.verbose_name)),
             adminform = admin_form,
             object_id = obj.pk,
             original = obj,
@@ -267,6 +373,7 @@ class HasMetadataModelAdmin(admin.ModelAdmin):
         )
         return self.render_change_form(request, context, add = False, change = True, obj = obj)
 
+    @timed('admin.render_change_form', queries = True)
     def render_change_form(self, request, context, add = False,
                                  change = False, form_url = '', obj = None):
         #####
@@ -274,18 +381,15 @@ class HasMetadataModelAdmin(admin.ModelAdmin):
         ## fieldset on change pages
         #####
         if change:
-            metadata_form_class = self.get_metadata_form_class(request, obj)
+            metadata_form_class = self.get_memoised_metadata_form_class(request, obj)
             if metadata_form_class:
                 if request.method == 'POST':
-                    metadata_form = metadata_form_class(data = request.POST, prefix = 'metadata')
+                    metadata_form = self.get_metadata_form(request, obj, bound = True)
                     # Force a validation - we don't really care about the result here
                     metadata_form.is_valid()
                 else:
                     # If there is no metadata in the submit, create the form
-                    metadata_form = metadata_form_class(
-                        initial = self.get_metadata_form_initial_data(request, obj),
-                        prefix = 'metadata'
-                    )
+                    metadata_form = self.get_metadata_form(request, obj, bound = False)
                 context['metadata_form'] = helpers.AdminForm(
                     metadata_form,
                     # Put all the fields in one fieldset
@@ -6,6 +6,7 @@ __author__ = "Matt Pryor"
 __copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
 
 from django.apps import AppConfig as BaseAppConfig
+from django.conf import settings
 
 
 class AppConfig(BaseAppConfig):
@@ -14,3 +15,16 @@ class AppConfig(BaseAppConfig):
     """
     name = '.'.join(__name__.split('.')[:-1])
     verbose_name = 'JASMIN Metadata'
+
+    def ready(self):
+        # Connect the signal handlers
+        from . import signals
+        from .cache import get_metadata_cache
+        if get_metadata_cache() is not None:
+            signals.connect_metadata_cache_signals()
+        # Warm the compiled form cache from a schema snapshot file, if given, so
+        # that workers don't need to query the database to build forms
+        schema_file = getattr(settings, 'JASMIN_METADATA_SCHEMA_FILE', None)
+        if schema_file:
+            from .schema import warm_form_cache_from_file
+            warm_form_cache_from_file(schema_file)
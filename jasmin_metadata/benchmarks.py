@@ -0,0 +1,405 @@
+"""
+Benchmarks for the JASMIN metadata app.
+
+The benchmarks measure the wall time, number of queries and memory allocated by
+the main operations of the app, and are run using the ``benchmark_metadata``
+management command, which emits the results as JSON so that they can be compared
+across versions. To benchmark against a different database, e.g. a local
+PostgreSQL, add it to ``DATABASES`` and use the ``--database`` option.
+
+Each benchmark runs inside a transaction that is rolled back once it has been
+measured, with the metadata cache disabled, so the benchmarks can safely be run
+against any database without leaving anything behind in the cache.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import time, datetime, decimal, tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, transaction
+from django.db.models import Max, Sum, TextField
+from django.db.models.functions import Cast, Length
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+from .fields import ENCODINGS, COMPRESSIONS, encode_value, decode_value
+from .models import *
+from .admin import HasMetadataModelAdmin
+
+
+class Runner:
+    """
+    Runs benchmarks against a database and measures the operations in them.
+    """
+    def __init__(self, using = 'default', allocations = True):
+        #: The alias of the database to run the benchmarks against
+        self.using = using
+        #: Whether to measure memory allocations, which slows the operations down
+        self.allocations = allocations
+
+    def measure(self, func):
+        """
+        Calls ``func`` and returns a dictionary containing the wall time taken,
+        the number of queries executed and, if enabled, the peak memory allocated.
+        """
+        queries = []
+        def count_queries(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+        if self.allocations:
+            tracemalloc.start()
+        try:
+            with connections[self.using].execute_wrapper(count_queries):
+                start = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - start
+            result = OrderedDict([
+                ('wall_time', elapsed),
+                ('queries', len(queries)),
+            ])
+            if self.allocations:
+                result['peak_allocated_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            if self.allocations:
+                tracemalloc.stop()
+        return result
+
+    @contextmanager
+    def rollback(self):
+        """
+        Context manager for a transaction that is always rolled back.
+
+        The metadata cache is disabled inside the transaction, so that the
+        benchmarks always read from the database and never cache metadata for
+        objects that don't exist once it is rolled back.
+        """
+        with override_settings(JASMIN_METADATA_CACHE = None):
+            with transaction.atomic(using = self.using):
+                yield
+                transaction.set_rollback(True, using = self.using)
+
+
+def has_metadata_model():
+    """
+    Returns a concrete model that inherits from :py:class:`HasMetadata`, or ``None``
+    if there isn't one.
+    """
+    return next((m for m in apps.get_models() if issubclass(m, HasMetadata)), None)
+
+
+def unused_object_ids(model, n_objects, using = 'default'):
+    """
+    Returns a range of ``n_objects`` primary keys for the given model that are not
+    used by any object and have no metadata attached, so that benchmarks can
+    attach metadata to them without touching or reading any real metadata.
+    """
+    content_type = ContentType.objects.db_manager(using).get_for_model(model)
+    start = max(
+        model._base_manager.using(using).aggregate(pk = Max('pk'))['pk'] or 0,
+        Metadatum.objects.using(using)
+            .filter(content_type = content_type)
+            .aggregate(pk = Max('object_int_id'))['pk'] or 0
+    ) + 1
+    return range(start, start + n_objects)
+
+
+def make_objects(model, pks, using = 'default'):
+    """
+    Returns unsaved instances of the given model with the given primary keys, as
+    metadata only needs a primary key, not a saved object.
+    """
+    objs = [model(pk = pk) for pk in pks]
+    for obj in objs:
+        obj._state.db = using
+    return objs
+
+
+def sample_values(n_values):
+    """
+    Returns a list of ``n_values`` values of the types produced by the form fields.
+    """
+    samples = [
+        True,
+        42,
+        3.14159,
+        'A single line of text',
+        'A longer piece of text, as entered in a multi-line text field.\n' * 10,
+        'someone@example.com',
+        datetime.date(2020, 9, 10),
+        datetime.datetime(2020, 9, 10, 9, 26, 0),
+        datetime.time(9, 26, 0),
+        decimal.Decimal('12.50'),
+        ['choice_a', 'choice_b', 'choice_c'],
+        None,
+    ]
+    return [samples[i % len(samples)] for i in range(n_values)]
+
+
+def sample_large_values(n_values):
+    """
+    Returns a list of ``n_values`` values of the kind that are large enough to be
+    compressed, i.e. long text and long lists of choices.
+    """
+    samples = [
+        'A longer piece of text, as entered in a multi-line text field.\n' * 50,
+        ['choice_{}'.format(i) for i in range(200)],
+    ]
+    return [samples[i % len(samples)] for i in range(n_values)]
+
+
+def sample_metadata(n_keys):
+    """
+    Returns a metadata dictionary with ``n_keys`` keys.
+    """
+    return OrderedDict(
+        ('key_{}'.format(i), value)
+        for i, value in enumerate(sample_values(n_keys))
+    )
+
+
+#: The field models and extra attributes used to build benchmark forms
+SAMPLE_FIELDS = [
+    (BooleanField, {}),
+    (SingleLineTextField, { 'max_length' : 100 }),
+    (MultiLineTextField, {}),
+    (EmailField, {}),
+    (IPv4Field, {}),
+    (RegexField, { 'regex' : '^[a-z]+$' }),
+    (SlugField, {}),
+    (URLField, {}),
+    (IntegerField, { 'min_value' : 0 }),
+    (FloatField, {}),
+    (DateField, {}),
+    (DateTimeField, {}),
+    (TimeField, {}),
+    (ChoiceField, {}),
+    (MultipleChoiceField, {}),
+]
+
+
+def create_sample_form(n_fields, using = 'default'):
+    """
+    Creates a form with ``n_fields`` fields of mixed types.
+    """
+    form = Form.objects.using(using).create(name = 'benchmark')
+    choices = [
+        UserChoice.objects.using(using).get_or_create(
+            value = 'benchmark_{}'.format(i),
+            defaults = { 'display' : 'Benchmark {}'.format(i) }
+        )[0]
+        for i in range(5)
+    ]
+    for i in range(n_fields):
+        model, extra = SAMPLE_FIELDS[i % len(SAMPLE_FIELDS)]
+        field = model.objects.using(using).create(
+            form = form,
+            name = 'field_{}'.format(i),
+            label = 'Field {}'.format(i),
+            help_text = 'Help for *field {}*, with [a link](https://example.com).'.format(i),
+            position = i,
+            **extra
+        )
+        if isinstance(field, ChoiceFieldBase):
+            field.choices.add(*choices)
+    return Form.objects.using(using).get(pk = form.pk)
+
+
+def bench_form_build(runner, n_fields):
+    """
+    Measures building a form with ``n_fields`` fields of mixed types, both from
+    the database and from the compiled form cache.
+    """
+    results = OrderedDict()
+    with runner.rollback():
+        form = create_sample_form(n_fields, runner.using)
+        results['build'] = runner.measure(form.build_form)
+        form.get_form()
+        results['cached'] = runner.measure(form.get_form)
+    return results
+
+
+def bench_metadata_write(runner, n_keys):
+    """
+    Measures saving a metadata form with ``n_keys`` fields of mixed types to an
+    object using :py:meth:`~.forms.MetadataForm.save`, then changing half of the
+    values, then saving it again unchanged.
+
+    The cleaned data is given to the form directly, so that only the save is
+    measured and not the validation.
+    """
+    results = OrderedDict()
+    with runner.rollback():
+        # Any saved model instance can have metadata attached
+        obj = Form.objects.using(runner.using).create(name = 'benchmark')
+        form = create_sample_form(n_keys, runner.using).get_form()()
+        form.cleaned_data = OrderedDict(zip(form.fields, sample_values(n_keys)))
+        results['insert'] = runner.measure(lambda: form.save(obj))
+        form.cleaned_data.update(
+            ('field_{}'.format(i), 'changed') for i in range(0, n_keys, 2)
+        )
+        results['update'] = runner.measure(lambda: form.save(obj))
+        results['unchanged'] = runner.measure(lambda: form.save(obj))
+    return results
+
+
+def bench_copy_metadata(runner, n_keys):
+    """
+    Measures copying ``n_keys`` metadata entries from one object to another using
+    :py:meth:`HasMetadata.copy_metadata_to`.
+    """
+    model = has_metadata_model()
+    if model is None:
+        return { 'skipped' : 'no model inherits from HasMetadata' }
+    with runner.rollback():
+        source, target = make_objects(model, unused_object_ids(model, 2, runner.using), runner.using)
+        Metadatum.objects.db_manager(runner.using).set_for_object(source, sample_metadata(n_keys))
+        return runner.measure(lambda: source.copy_metadata_to(target))
+
+
+def bench_metadata_dict(runner, n_objects):
+    """
+    Measures reading :py:attr:`HasMetadata.metadata_dict` for ``n_objects``
+    objects with ten keys each, both one object at a time and batched using
+    :py:func:`load_metadata`.
+    """
+    model = has_metadata_model()
+    if model is None:
+        return { 'skipped' : 'no model inherits from HasMetadata' }
+    results = OrderedDict()
+    with runner.rollback():
+        content_type = ContentType.objects.db_manager(runner.using).get_for_model(model)
+        pks = unused_object_ids(model, n_objects, runner.using)
+        metadata = sample_metadata(10)
+        Metadatum.objects.using(runner.using).bulk_create(
+            [
+                Metadatum(
+                    content_type = content_type, object_id = str(i), object_int_id = i,
+                    key = key, value = value
+                )
+                for i in pks
+                for key, value in metadata.items()
+            ],
+            batch_size = 1000
+        )
+        objs = make_objects(model, pks, runner.using)
+        results['per_object'] = runner.measure(lambda: [o.metadata_dict for o in objs])
+        objs = make_objects(model, pks, runner.using)
+        def batched():
+            load_metadata(objs)
+            return [o.metadata_dict for o in objs]
+        results['batched'] = runner.measure(batched)
+    return results
+
+
+def bench_admin_change_view(runner, n_requests):
+    """
+    Measures rendering the admin change view ``n_requests`` times for an object
+    whose model admin inherits from :py:class:`~.admin.HasMetadataModelAdmin`.
+
+    The first such model admin registered with the default admin site that has
+    at least one object is used.
+    """
+    for model, model_admin in admin.site._registry.items():
+        if isinstance(model_admin, HasMetadataModelAdmin):
+            obj = model._default_manager.using(runner.using).first()
+            if obj is not None:
+                break
+    else:
+        return { 'skipped' : 'no HasMetadataModelAdmin with any objects' }
+    user = get_user_model()(is_active = True, is_staff = True, is_superuser = True)
+    def change_view():
+        for _ in range(n_requests):
+            request = RequestFactory().get('/')
+            request.user = user
+            model_admin.change_view(request, str(obj.pk)).render()
+    with runner.rollback():
+        return runner.measure(change_view)
+
+
+def bench_value_encoding(runner, n_values):
+    """
+    Measures the time to encode and decode ``n_values`` typical metadata values
+    and ``n_values`` large values, and their total encoded size, for each of the
+    available encodings and compressions.
+    """
+    results = OrderedDict()
+    for encoding in ENCODINGS:
+        for compression in COMPRESSIONS:
+            name = encoding if compression == 'none' else '{}+{}'.format(encoding, compression)
+            results[name] = OrderedDict()
+            for sample, values in [
+                ('typical', sample_values(n_values)),
+                ('large', sample_large_values(n_values)),
+            ]:
+                encode = lambda: [encode_value(v, encoding, compression = compression) for v in values]
+                encoded = encode()
+                results[name][sample] = OrderedDict([
+                    ('encode', runner.measure(encode)),
+                    ('decode', runner.measure(lambda: [decode_value(raw) for raw in encoded])),
+                    ('encoded_bytes', sum(len(raw.encode()) for raw in encoded)),
+                ])
+    return results
+
+
+def bench_value_storage(runner, n_objects):
+    """
+    Measures the stored size of the values for ``n_objects`` objects with ten
+    large values each, and the time to read them all using :py:func:`load_metadata`,
+    for each of the available compressions.
+    """
+    model = has_metadata_model()
+    if model is None:
+        return { 'skipped' : 'no model inherits from HasMetadata' }
+    results = OrderedDict()
+    content_type = ContentType.objects.db_manager(runner.using).get_for_model(model)
+    pks = unused_object_ids(model, n_objects, runner.using)
+    values = sample_large_values(10)
+    for compression in COMPRESSIONS:
+        with runner.rollback():
+            # Encode the values up front, as they are stored as-is
+            encoded = [encode_value(v, compression = compression) for v in values]
+            Metadatum.objects.using(runner.using).bulk_create(
+                [
+                    Metadatum(
+                        content_type = content_type, object_id = str(i), object_int_id = i,
+                        key = 'key_{}'.format(j), value = value
+                    )
+                    for i in pks
+                    for j, value in enumerate(encoded)
+                ],
+                batch_size = 1000
+            )
+            stored_bytes = (
+                Metadatum.objects.using(runner.using)
+                    .filter(content_type = content_type, object_int_id__range = (pks[0], pks[-1]))
+                    .aggregate(size = Sum(Length(Cast('value', TextField()))))['size']
+            )
+            objs = make_objects(model, pks, runner.using)
+            def read():
+                load_metadata(objs)
+                return [o.metadata_dict for o in objs]
+            results[compression] = OrderedDict([
+                ('stored_bytes', stored_bytes),
+                ('read', runner.measure(read)),
+            ])
+    return results
+
+
+#: The available benchmarks, mapping name to the benchmark function and the
+#: default problem sizes to run it with
+BENCHMARKS = OrderedDict([
+    ('form_build', (bench_form_build, [10, 100, 500])),
+    ('metadata_write', (bench_metadata_write, [10, 100, 500])),
+    ('copy_metadata', (bench_copy_metadata, [10, 100, 500])),
+    ('metadata_dict', (bench_metadata_dict, [10000])),
+    ('admin_change_view', (bench_admin_change_view, [1])),
+    ('value_encoding', (bench_value_encoding, [1000])),
+    ('value_storage', (bench_value_storage, [1000])),
+])
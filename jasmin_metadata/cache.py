@@ -0,0 +1,247 @@
+"""
+Module containing caching utilities for the JASMIN metadata app.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import threading, functools
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction, DEFAULT_DB_ALIAS
+from django.dispatch import receiver
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded, process-local cache that evicts the least recently
+    used entry when it is full.
+
+    Keeps counts of hits, misses and evictions for instrumentation.
+    """
+    def __init__(self, maxsize = 128):
+        #: The maximum number of entries to keep, or ``0`` to disable caching
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default = None):
+        """
+        Returns the cached value for ``key``, or ``default`` if it is not present.
+        """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return value
+
+    def get_or_set(self, key, factory):
+        """
+        Returns the cached value for ``key``, calling ``factory`` to create and
+        cache it if it is not present.
+        """
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is not sentinel:
+            return value
+        # Call the factory outside the lock, as it may be expensive
+        value = factory()
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        """
+        Sets the cached value for ``key``, evicting old entries if required.
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last = False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """
+        Removes the entry for ``key`` from the cache, if present.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Removes all the entries from the cache. The counters are not reset.
+        """
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        Returns a dictionary of the counters for the cache.
+        """
+        return {
+            'size' : len(self._data),
+            'maxsize' : self.maxsize,
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'evictions' : self.evictions,
+        }
+
+
+class MetadataCache:
+    """
+    Read-through cache of the decoded metadata dictionaries for objects, stored
+    in one of the caches from Django's cache framework and keyed by content type
+    and object id.
+
+    Inside a transaction, entries are only stored when it commits, so that
+    uncommitted metadata is never cached, and entries invalidated by the
+    transaction are not read until it ends, so that it sees its own writes.
+
+    Keeps counts of hits, misses and invalidations for instrumentation.
+    """
+    def __init__(self, alias, timeout = 300):
+        #: The alias of the Django cache to use
+        self.alias = alias
+        #: The time to keep entries for in seconds, or ``None`` for no expiry
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # The keys invalidated by the open transaction in each thread, by database
+        self._local = threading.local()
+        self.hits = self.misses = self.invalidations = 0
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, content_type_id, object_id):
+        return 'jasmin_metadata:metadata:{}:{}'.format(content_type_id, object_id)
+
+    def _invalidated(self, using):
+        """
+        Returns the set of keys invalidated by the open transaction on the given
+        database in this thread.
+        """
+        invalidated = self._local.__dict__.setdefault('keys', {})
+        if not transaction.get_connection(using).in_atomic_block:
+            # Any transaction that invalidated keys has committed or rolled back
+            invalidated.pop(using, None)
+        return invalidated.setdefault(using, set())
+
+    def get(self, content_type_id, object_id, using = DEFAULT_DB_ALIAS):
+        """
+        Returns the cached metadata dictionary for the given object, or ``None``
+        if it is not cached.
+        """
+        key = self.key(content_type_id, object_id)
+        if key in self._invalidated(using):
+            data = None
+        else:
+            data = self.cache.get(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def set(self, content_type_id, object_id, data, using = DEFAULT_DB_ALIAS):
+        """
+        Caches the metadata dictionary for the given object, which must have been
+        read from the given database.
+
+        If called inside a transaction, the entry is stored when it commits, and
+        not at all if it rolls back.
+        """
+        key = self.key(content_type_id, object_id)
+        transaction.on_commit(lambda: self.cache.set(key, data, self.timeout), using = using)
+
+    async def aget(self, content_type_id, object_id):
+        """
+        Async counterpart of :py:meth:`get`.
+        """
+        data = await self.cache.aget(self.key(content_type_id, object_id))
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    async def aset(self, content_type_id, object_id, data):
+        """
+        Async counterpart of :py:meth:`set`.
+        """
+        await self.cache.aset(self.key(content_type_id, object_id), data, self.timeout)
+
+    def invalidate(self, objects, using = DEFAULT_DB_ALIAS):
+        """
+        Removes the entries for the given ``(content_type_id, object_id)`` pairs.
+
+        If called inside a transaction, the entries are removed straight away and
+        again when it commits, in case another reader cached the old metadata in
+        the meantime, and they are not read by the transaction until it ends.
+        """
+        keys = [self.key(content_type_id, object_id) for content_type_id, object_id in objects]
+        if not keys:
+            return
+        with self._lock:
+            self.invalidations += len(keys)
+        self.cache.delete_many(keys)
+        if transaction.get_connection(using).in_atomic_block:
+            self._invalidated(using).update(keys)
+            transaction.on_commit(lambda: self._committed(keys, using), using = using)
+
+    def _committed(self, keys, using):
+        self.cache.delete_many(keys)
+        self._local.__dict__.get('keys', {}).pop(using, None)
+
+    def stats(self):
+        """
+        Returns a dictionary of the counters for the cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'invalidations' : self.invalidations,
+            'hit_ratio' : self.hits / lookups if lookups else None,
+        }
+
+
+@functools.lru_cache(maxsize = None)
+def get_metadata_cache():
+    """
+    Returns the :py:class:`MetadataCache` for object metadata, as configured by the
+    ``JASMIN_METADATA_CACHE`` (cache alias) and ``JASMIN_METADATA_CACHE_TIMEOUT``
+    settings, or ``None`` if metadata is not cached.
+    """
+    alias = getattr(settings, 'JASMIN_METADATA_CACHE', None)
+    if not alias:
+        return None
+    return MetadataCache(alias, getattr(settings, 'JASMIN_METADATA_CACHE_TIMEOUT', 300))
+
+
+@receiver(setting_changed)
+def reset_metadata_cache(setting, **kwargs):
+    """
+    Discards the metadata cache when its settings change, e.g. in tests.
+    """
+    if setting.startswith('JASMIN_METADATA_CACHE'):
+        get_metadata_cache.cache_clear()
@@ -0,0 +1,205 @@
+"""
+Module containing the reverse DNS resolvers used to validate IPv4 address fields.
+
+The resolver in use is an instance of the class given by the
+``JASMIN_METADATA_DNS_RESOLVER`` setting (default :py:class:`SocketResolver`),
+constructed with the keyword arguments in ``JASMIN_METADATA_DNS_OPTIONS``.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import time, socket, asyncio, threading, functools
+from concurrent import futures
+from ipaddress import IPv4Address
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .cache import LRUCache
+
+
+class Resolver:
+    """
+    Base class for reverse DNS resolvers.
+
+    Results, both positive and negative, are cached for a configurable time and
+    lookups that take longer than the timeout are treated as failures. Lookups are
+    run in a thread pool, which also allows many addresses to be resolved
+    concurrently using :py:meth:`resolve_many`.
+
+    Subclasses must implement :py:meth:`lookup`.
+    """
+    def __init__(self, timeout = 2.0, ttl = 300, negative_ttl = 60,
+                       max_workers = 8, cache_size = 1024):
+        #: The maximum time to wait for a lookup in seconds
+        self.timeout = timeout
+        #: The time to cache successful lookups for in seconds
+        self.ttl = ttl
+        #: The time to cache failed lookups for in seconds
+        self.negative_ttl = negative_ttl
+        self._cache = LRUCache(cache_size)
+        self._executor = futures.ThreadPoolExecutor(max_workers = max_workers)
+        self._lock = threading.Lock()
+        self.lookups = self.cache_hits = self.timeouts = self.failures = 0
+
+    def lookup(self, address):
+        """
+        Performs an uncached reverse lookup of the given address, returning the
+        hostname or raising an exception if the lookup fails.
+        """
+        raise NotImplementedError
+
+    def _lookup(self, address):
+        with self._lock:
+            self.lookups += 1
+        try:
+            return self.lookup(address)
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            return None
+
+    def _cached(self, address):
+        entry = self._cache.get(address)
+        if entry is not None and entry[0] > time.monotonic():
+            with self._lock:
+                self.cache_hits += 1
+            return entry
+        return None
+
+    def _store(self, address, hostname):
+        ttl = self.ttl if hostname else self.negative_ttl
+        self._cache.set(address, (time.monotonic() + ttl, hostname))
+
+    def _submit(self, addresses):
+        """
+        Returns a dictionary of the results that are known without a lookup and a
+        dictionary of futures for the lookups that have been submitted.
+        """
+        results = {}
+        pending = {}
+        for address in set(addresses):
+            try:
+                _ = IPv4Address(address)
+            except ValueError:
+                results[address] = None
+                continue
+            entry = self._cached(address)
+            if entry is not None:
+                results[address] = entry[1]
+            else:
+                pending[address] = self._executor.submit(self._lookup, address)
+        return results, pending
+
+    def resolve(self, address):
+        """
+        Returns the hostname for the given address, or ``None`` if the lookup fails
+        or times out.
+        """
+        return self.resolve_many([address])[address]
+
+    def resolve_many(self, addresses):
+        """
+        Resolves the given addresses concurrently, returning a dictionary mapping
+        each address to its hostname, or ``None`` if the lookup failed or timed out.
+
+        Addresses that are not valid IPv4 addresses are mapped to ``None`` without
+        a lookup.
+        """
+        results, pending = self._submit(addresses)
+        deadline = time.monotonic() + self.timeout
+        for address, future in pending.items():
+            try:
+                hostname = future.result(timeout = max(deadline - time.monotonic(), 0))
+            except futures.TimeoutError:
+                with self._lock:
+                    self.timeouts += 1
+                hostname = None
+            self._store(address, hostname)
+            results[address] = hostname
+        return results
+
+    async def aresolve(self, address):
+        """
+        Async counterpart of :py:meth:`resolve`.
+        """
+        return (await self.aresolve_many([address]))[address]
+
+    async def aresolve_many(self, addresses):
+        """
+        Async counterpart of :py:meth:`resolve_many`.
+
+        The lookups run on the resolver's own thread pool and are awaited without
+        blocking a thread, so concurrent requests never hold more threads than the
+        pool has workers.
+        """
+        results, pending = self._submit(addresses)
+        if pending:
+            waiting = { address : asyncio.wrap_future(f) for address, f in pending.items() }
+            done, _ = await asyncio.wait(waiting.values(), timeout = self.timeout)
+            for address, future in waiting.items():
+                if future in done:
+                    hostname = future.result()
+                else:
+                    future.cancel()
+                    with self._lock:
+                        self.timeouts += 1
+                    hostname = None
+                self._store(address, hostname)
+                results[address] = hostname
+        return results
+
+    def stats(self):
+        """
+        Returns a dictionary of the counters for the resolver.
+        """
+        return {
+            'lookups' : self.lookups,
+            'cache_hits' : self.cache_hits,
+            'timeouts' : self.timeouts,
+            'failures' : self.failures,
+        }
+
+
+class SocketResolver(Resolver):
+    """
+    Resolver that uses the system resolver via ``socket.gethostbyaddr``.
+    """
+    def lookup(self, address):
+        return socket.gethostbyaddr(address)[0]
+
+
+class StaticResolver(Resolver):
+    """
+    Resolver that resolves addresses from a fixed mapping, for use in tests.
+    """
+    def __init__(self, hosts = None, **kwargs):
+        super().__init__(**kwargs)
+        #: Mapping of address to hostname
+        self.hosts = dict(hosts or {})
+
+    def lookup(self, address):
+        return self.hosts[address]
+
+
+@functools.lru_cache(maxsize = None)
+def get_resolver():
+    """
+    Returns the configured resolver.
+    """
+    resolver_class = import_string(
+        getattr(settings, 'JASMIN_METADATA_DNS_RESOLVER', 'jasmin_metadata.dns.SocketResolver')
+    )
+    return resolver_class(**getattr(settings, 'JASMIN_METADATA_DNS_OPTIONS', {}))
+
+
+@receiver(setting_changed)
+def reset_resolver(setting, **kwargs):
+    """
+    Discards the resolver when the resolver settings change, e.g. in tests.
+    """
+    if setting.startswith('JASMIN_METADATA_DNS_'):
+        get_resolver.cache_clear()
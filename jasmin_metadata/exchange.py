@@ -0,0 +1,209 @@
+"""
+Module containing functions for exporting metadata form definitions and
+importing them into another environment.
+
+The exported format is a list of plain-data form definitions that can be
+written as JSON or YAML.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import json
+
+from django.apps import apps
+from django.core.serializers.json import DjangoJSONEncoder
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+from .models import Form, Field, UserChoice, ChoiceFieldBase
+
+
+def _exported_fields(model):
+    """
+    Returns the model fields that are exported for the given field model.
+    """
+    return [
+        f for f in model._meta.concrete_fields
+        if not f.is_relation and not f.primary_key and f.name != 'help_text_html'
+    ]
+
+
+def export_forms(forms):
+    """
+    Returns a list of plain-data definitions for the given forms, including all
+    their fields and the choices they use.
+    """
+    definitions = []
+    for form in forms:
+        fields = []
+        for field in form.get_fields():
+            definition = {
+                'type' : field._meta.label_lower,
+                'attributes' : {
+                    f.name : getattr(field, f.attname)
+                    for f in _exported_fields(type(field))
+                },
+            }
+            if isinstance(field, ChoiceFieldBase):
+                definition['choices'] = [
+                    { 'value' : c.value, 'display' : c.display }
+                    for c in field.choices.all()
+                ]
+            fields.append(definition)
+        definitions.append({ 'name' : form.name, 'fields' : fields })
+    return definitions
+
+
+#: The formats that form definitions can be written in
+FORMATS = ('json', 'yaml')
+
+
+def _yaml():
+    """
+    Returns the ``yaml`` module, which is only required for the YAML format.
+    """
+    try:
+        import yaml
+    except ImportError:
+        raise ImproperlyConfigured('PyYAML must be installed to use the YAML format')
+    return yaml
+
+
+def dump_definitions(definitions, fp, format = 'json'):
+    """
+    Writes form definitions to the given file-like object in the given format.
+    """
+    if format == 'yaml':
+        _yaml().safe_dump(definitions, fp, default_flow_style = False, sort_keys = False)
+    else:
+        json.dump(definitions, fp, cls = DjangoJSONEncoder, indent = 2)
+
+
+def load_definitions(fp, format = 'json'):
+    """
+    Reads form definitions written by :py:func:`dump_definitions`.
+    """
+    if format == 'yaml':
+        return _yaml().safe_load(fp)
+    return json.load(fp)
+
+
+def _bulk_insert_table(model, objs, using):
+    """
+    Inserts the values of the local fields of ``model`` for each of the given
+    objects, which may be instances of ``model`` or of its subclasses.
+
+    ``bulk_create`` refuses multi-table inherited models, so this is used to
+    populate each table in the inheritance chain separately.
+    """
+    fields = model._meta.local_concrete_fields
+    batch_size = max(connections[using].ops.bulk_batch_size(fields, objs), 1)
+    manager = model._base_manager.db_manager(using)
+    for start in range(0, len(objs), batch_size):
+        manager._insert(objs[start:start + batch_size], fields = fields, using = using)
+
+
+def import_forms(definitions, using = DEFAULT_DB_ALIAS):
+    """
+    Creates forms from definitions produced by :py:func:`export_forms` in a single
+    transaction, returning the new :py:class:`~.models.Form` instances.
+
+    Fields are inserted in bulk, one query per table in the field model hierarchy,
+    and choices are matched to existing :py:class:`~.models.UserChoice` rows by
+    value, so the number of queries does not depend on the number of fields.
+
+    Raises ``django.core.exceptions.ValidationError`` if a definition is invalid,
+    including if a form has more than one field with the same name. As the rows
+    are inserted directly, uniqueness is checked here rather than by the database.
+    """
+    with transaction.atomic(using = using):
+        # Create any missing choices, then fetch the ids of all of them
+        displays = {
+            c['value'] : c['display']
+            for definition in definitions
+            for field in definition['fields']
+            for c in field.get('choices', [])
+        }
+        choice_ids = {}
+        if displays:
+            existing = set(
+                UserChoice.objects.using(using)
+                    .filter(value__in = displays)
+                    .values_list('value', flat = True)
+            )
+            UserChoice.objects.using(using).bulk_create([
+                UserChoice(value = value, display = display)
+                for value, display in displays.items()
+                if value not in existing
+            ])
+            choice_ids = dict(
+                UserChoice.objects.using(using)
+                    .filter(value__in = displays)
+                    .values_list('value', 'id')
+            )
+        forms = []
+        fields = []
+        for definition in definitions:
+            form = Form.objects.using(using).create(name = definition['name'])
+            forms.append(form)
+            names = set()
+            for field_def in definition['fields']:
+                model = apps.get_model(field_def['type'])
+                if not issubclass(model, Field):
+                    raise ValueError('{} is not a field model'.format(field_def['type']))
+                field = model(form = form, **field_def['attributes'])
+                field.full_clean(
+                    exclude = [
+                        f.name for f in model._meta.fields
+                        if f.name not in field_def['attributes']
+                    ],
+                    validate_unique = False
+                )
+                # The form is new, so the names only need to be unique in the definition
+                if field.name in names:
+                    raise ValidationError(
+                        'Form {} has more than one field named {}'.format(form.name, field.name)
+                    )
+                names.add(field.name)
+                field.polymorphic_ctype = ContentType.objects.db_manager(using) \
+                    .get_for_model(model, for_concrete_model = False)
+                # Field.save is bypassed, so render the help text here
+                field.help_text_html = field.render_help_text()
+                field.import_choices = field_def.get('choices', [])
+                fields.append(field)
+        # Insert the base field rows, then fetch their ids using the unique
+        # constraint on form and name
+        Field.objects.using(using).non_polymorphic().bulk_create([
+            Field(**{ f.attname : getattr(field, f.attname) for f in Field._meta.concrete_fields })
+            for field in fields
+        ])
+        ids = {
+            (form_id, name) : pk
+            for form_id, name, pk in (
+                Field.objects.using(using).non_polymorphic()
+                    .filter(form__in = forms)
+                    .values_list('form_id', 'name', 'id')
+            )
+        }
+        # Populate the tables for the subclasses, parents first
+        tables = {}
+        for field in fields:
+            field.id = ids[(field.form_id, field.name)]
+            models = [type(field)] + type(field)._meta.get_parent_list()
+            for model in models:
+                for link in model._meta.parents.values():
+                    setattr(field, link.attname, field.id)
+                if model is not Field:
+                    tables.setdefault(model, []).append(field)
+        for model in sorted(tables, key = lambda m: len(m._meta.get_parent_list())):
+            _bulk_insert_table(model, tables[model], using)
+        # Link the choices
+        Through = ChoiceFieldBase.choices.through
+        Through.objects.using(using).bulk_create([
+            Through(choicefieldbase_id = field.id, userchoice_id = choice_ids[c['value']])
+            for field in fields
+            for c in field.import_choices
+        ])
+    return forms
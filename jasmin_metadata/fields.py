@@ -0,0 +1,359 @@
+"""
+Model fields for the JASMIN metadata app.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import json, uuid, datetime, decimal, pickle, zlib, lzma
+from base64 import b64encode, b64decode
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import TextField
+from django.db.models.functions import Cast
+
+from picklefield.fields import (
+    PickledObjectField, PickledObject, dbsafe_encode, dbsafe_decode
+)
+
+from .instrumentation import increment
+
+
+#: Prefix that marks a value stored using the typed JSON encoding
+#: The base64 alphabet used for pickled values does not contain ':', so the two
+#: encodings can never be confused
+JSON_PREFIX = 'j:'
+
+#: The available encodings for metadata values
+ENCODINGS = ('pickle', 'json')
+
+#: The available compression modes for metadata values
+COMPRESSIONS = ('none', 'zlib', 'lzma')
+
+#: Map of each compression algorithm to its header character and compress function
+_COMPRESSORS = {
+    'zlib' : ('z', zlib.compress),
+    'lzma' : ('x', lzma.compress),
+}
+
+#: Map of the header character for each compression algorithm to the algorithm
+#: name and decompress function
+_DECOMPRESSORS = {
+    'z' : ('zlib', zlib.decompress),
+    'x' : ('lzma', lzma.decompress),
+}
+
+#: Map of the header character for each encoding of a compressed payload to the
+#: encoding name
+_PAYLOAD_ENCODINGS = { 'p' : 'pickle', 'j' : 'json' }
+
+
+def get_value_encoding():
+    """
+    Returns the encoding to use when writing metadata values, as given by the
+    ``JASMIN_METADATA_VALUE_ENCODING`` setting.
+    """
+    encoding = getattr(settings, 'JASMIN_METADATA_VALUE_ENCODING', 'pickle')
+    if encoding not in ENCODINGS:
+        raise ImproperlyConfigured(
+            'JASMIN_METADATA_VALUE_ENCODING must be one of {}'.format(', '.join(ENCODINGS))
+        )
+    return encoding
+
+
+def get_value_compression():
+    """
+    Returns the compression to use when writing metadata values, as given by the
+    ``JASMIN_METADATA_VALUE_COMPRESSION`` setting.
+    """
+    compression = getattr(settings, 'JASMIN_METADATA_VALUE_COMPRESSION', 'none')
+    if compression not in COMPRESSIONS:
+        raise ImproperlyConfigured(
+            'JASMIN_METADATA_VALUE_COMPRESSION must be one of {}'.format(', '.join(COMPRESSIONS))
+        )
+    return compression
+
+
+def get_compression_threshold():
+    """
+    Returns the length of encoded value above which values are compressed, as
+    given by the ``JASMIN_METADATA_VALUE_COMPRESSION_THRESHOLD`` setting.
+    """
+    return getattr(settings, 'JASMIN_METADATA_VALUE_COMPRESSION_THRESHOLD', 1024)
+
+
+def _to_json(value):
+    """
+    Converts the given value to a JSON-compatible structure, tagging types that
+    JSON does not support natively so that they can be restored.
+
+    Raises ``TypeError`` if the value contains a type that cannot be represented.
+    """
+    # Use exact type checks so that subclasses are never silently converted
+    value_type = type(value)
+    if value is None or value_type in (str, int, float, bool):
+        return value
+    if value_type is list:
+        return [_to_json(v) for v in value]
+    if value_type is dict:
+        if '__type__' not in value and all(type(k) is str for k in value):
+            return { k : _to_json(v) for k, v in value.items() }
+        return { '__type__' : 'dict', 'value' : [[_to_json(k), _to_json(v)] for k, v in value.items()] }
+    if value_type is tuple:
+        return { '__type__' : 'tuple', 'value' : [_to_json(v) for v in value] }
+    if value_type in (set, frozenset):
+        return { '__type__' : value_type.__name__, 'value' : [_to_json(v) for v in value] }
+    if value_type in (datetime.datetime, datetime.date, datetime.time):
+        return { '__type__' : value_type.__name__, 'value' : value.isoformat() }
+    if value_type is decimal.Decimal:
+        return { '__type__' : 'decimal', 'value' : str(value) }
+    if value_type is uuid.UUID:
+        return { '__type__' : 'uuid', 'value' : str(value) }
+    raise TypeError('Cannot encode {} as JSON'.format(value_type.__name__))
+
+
+_FROM_JSON = {
+    'dict' : lambda v: { _from_json(k) : _from_json(x) for k, x in v },
+    'tuple' : lambda v: tuple(_from_json(x) for x in v),
+    'set' : lambda v: set(_from_json(x) for x in v),
+    'frozenset' : lambda v: frozenset(_from_json(x) for x in v),
+    'datetime' : datetime.datetime.fromisoformat,
+    'date' : datetime.date.fromisoformat,
+    'time' : datetime.time.fromisoformat,
+    'decimal' : decimal.Decimal,
+    'uuid' : uuid.UUID,
+}
+
+
+def _from_json(value):
+    """
+    Reverses :py:func:`_to_json`.
+    """
+    if type(value) is list:
+        return [_from_json(v) for v in value]
+    if type(value) is dict:
+        if '__type__' in value:
+            return _FROM_JSON[value['__type__']](value['value'])
+        return { k : _from_json(v) for k, v in value.items() }
+    return value
+
+
+def _compress(encoded, compression):
+    """
+    Returns the compressed form of the given encoded value, which consists of a
+    header character for the algorithm, a header character for the encoding of
+    the payload and ``:`` followed by the base64-encoded compressed payload.
+
+    The payload is the JSON text or the raw pickle rather than its base64 form, so
+    that base64 is only applied once.
+    """
+    if encoded.startswith(JSON_PREFIX):
+        payload_header, payload = 'j', encoded[len(JSON_PREFIX):].encode()
+    else:
+        payload_header, payload = 'p', b64decode(encoded)
+    header, compress = _COMPRESSORS[compression]
+    return header + payload_header + ':' + b64encode(compress(payload)).decode()
+
+
+def _is_compressed(raw):
+    # Neither base64 nor the JSON prefix can have ':' as the third character
+    return raw[2:3] == ':' and raw[:1] in _DECOMPRESSORS and raw[1:2] in _PAYLOAD_ENCODINGS
+
+
+def encode_value(value, encoding = None, protocol = None, compression = None):
+    """
+    Encodes the given value as a string for storage using the given encoding and
+    compression, or the configured encoding and compression if not given.
+
+    Values that cannot be represented using the JSON encoding, including NaN and
+    infinite floats, are pickled. Values are only compressed if their encoded
+    length is at least :py:func:`get_compression_threshold` and compression makes
+    them smaller.
+
+    The result is a :py:class:`~picklefield.fields.PickledObject`, which
+    :py:class:`MetadataValueField` stores as-is.
+    """
+    encoding = encoding or get_value_encoding()
+    compression = compression or get_value_compression()
+    encoded = None
+    if encoding == 'json':
+        try:
+            # NaN and infinity are not valid JSON, so the database could not read them
+            encoded = PickledObject(JSON_PREFIX + json.dumps(
+                _to_json(value),
+                separators = (',', ':'),
+                allow_nan = False
+            ))
+        except (TypeError, ValueError):
+            # Fall through to pickle for unsupported values
+            pass
+    if encoded is None:
+        encoded = dbsafe_encode(value, pickle_protocol = protocol, copy = False)
+    if compression != 'none' and len(encoded) >= get_compression_threshold():
+        compressed = _compress(encoded, compression)
+        if len(compressed) < len(encoded):
+            encoded = PickledObject(compressed)
+    increment('value.bytes_encoded.{}'.format(get_raw_encoding(encoded)), len(encoded))
+    return encoded
+
+
+def decode_value(raw):
+    """
+    Decodes a value stored using any of the supported encodings and compressions.
+    """
+    if raw.startswith(JSON_PREFIX):
+        return _from_json(json.loads(raw[len(JSON_PREFIX):]))
+    if _is_compressed(raw):
+        payload = _DECOMPRESSORS[raw[0]][1](b64decode(raw[3:]))
+        if raw[1] == 'j':
+            return _from_json(json.loads(payload.decode()))
+        return pickle.loads(payload)
+    return dbsafe_decode(raw)
+
+
+def get_raw_encoding(raw):
+    """
+    Returns the name of the encoding used for the given stored value.
+    """
+    if _is_compressed(raw):
+        return _PAYLOAD_ENCODINGS[raw[1]]
+    return 'json' if raw.startswith(JSON_PREFIX) else 'pickle'
+
+
+def get_raw_compression(raw):
+    """
+    Returns the name of the compression used for the given stored value.
+    """
+    return _DECOMPRESSORS[raw[0]][0] if _is_compressed(raw) else 'none'
+
+
+#: The maximum length of the normalised representation of an indexed value
+INDEX_MAX_LENGTH = 250
+
+
+def index_value(value):
+    """
+    Returns a normalised string representation of the given value for indexing,
+    or ``None`` if the value is not a scalar or its representation is too long.
+
+    The representation is prefixed by the type of the value, so that e.g. ``1``,
+    ``'1'`` and ``True`` are distinguished.
+
+    Aware datetimes are converted to UTC, so that the same instant has the same
+    representation whatever time zone it was stored in. Datetimes and times always
+    include microseconds, so that their representations sort in time order.
+    """
+    value_type = type(value)
+    if value is None:
+        normalised = 'n:'
+    elif value_type is bool:
+        normalised = 'b:{}'.format(int(value))
+    elif value_type is int:
+        normalised = 'i:{}'.format(value)
+    elif value_type is float:
+        normalised = 'f:{!r}'.format(value)
+    elif value_type is decimal.Decimal:
+        normalised = 'D:{}'.format(value.normalize())
+    elif value_type is str:
+        normalised = 's:{}'.format(value)
+    elif value_type is datetime.datetime:
+        if value.utcoffset() is not None:
+            value = value.astimezone(datetime.timezone.utc)
+        normalised = 'dt:{}'.format(value.isoformat(timespec = 'microseconds'))
+    elif value_type is datetime.date:
+        normalised = 'd:{}'.format(value.isoformat())
+    elif value_type is datetime.time:
+        normalised = 't:{}'.format(value.isoformat(timespec = 'microseconds'))
+    elif value_type is uuid.UUID:
+        normalised = 'u:{}'.format(value)
+    else:
+        return None
+    return normalised if len(normalised) <= INDEX_MAX_LENGTH else None
+
+
+class MetadataValueField(PickledObjectField):
+    """
+    Field for metadata values that can be stored either pickled or using a typed
+    JSON encoding, which is faster to decode, smaller and readable by the database.
+
+    The encoding used for writes is selected by the ``JASMIN_METADATA_VALUE_ENCODING``
+    setting. Large values can also be compressed using zlib or lzma, as selected by
+    the ``JASMIN_METADATA_VALUE_COMPRESSION`` setting. Values in any encoding and
+    compression are always readable, so the settings can be changed at any time
+    and existing rows converted using the ``convert_metadata_values`` management
+    command.
+
+    .. note::
+
+        As for :py:class:`~picklefield.fields.PickledObjectField`, ``exact``
+        and ``in`` lookups compare encoded values, so only match rows that were
+        stored using the current encoding.
+    """
+    def to_python(self, value):
+        if isinstance(value, str) and (value.startswith(JSON_PREFIX) or _is_compressed(value)):
+            try:
+                return decode_value(value)
+            except Exception:
+                # Not a JSON-encoded or compressed value after all
+                return value
+        return super().to_python(value)
+
+    def get_db_prep_value(self, value, connection = None, prepared = False):
+        if value is not None and not isinstance(value, PickledObject):
+            value = str(encode_value(value, protocol = self.protocol))
+        return value
+
+
+def convert_values(queryset, encoding, batch_size = 1000, compression = None):
+    """
+    Re-encodes the values of the :py:class:`~.models.Metadatum` rows in the given
+    queryset using the given encoding and compression, or the configured compression
+    if not given, processing ``batch_size`` rows at a time. Rows that already use
+    the encoding and compression are not rewritten.
+
+    Returns a tuple of ``(rows examined, rows converted)``.
+    """
+    compression = compression or get_value_compression()
+    threshold = get_compression_threshold()
+    # Fetch the stored strings without decoding them, so that rows that already
+    # use the encoding cost nothing to skip
+    queryset = (
+        queryset
+            .exclude(value = None)
+            .annotate(raw_value = Cast('value', TextField()))
+            .only('pk')
+            .order_by('pk')
+    )
+    examined = converted = 0
+    last_pk = None
+    while True:
+        batch = queryset if last_pk is None else queryset.filter(pk__gt = last_pk)
+        batch = list(batch[:batch_size])
+        if not batch:
+            break
+        examined += len(batch)
+        last_pk = batch[-1].pk
+        to_update = []
+        for datum in batch:
+            raw = datum.raw_value
+            if get_raw_encoding(raw) == encoding:
+                raw_compression = get_raw_compression(raw)
+                if raw_compression == compression:
+                    continue
+                # Small values are not compressed, so they are already correct
+                if raw_compression == 'none' and len(raw) < threshold:
+                    continue
+            encoded = encode_value(decode_value(raw), encoding, compression = compression)
+            # Values that can't be JSON-encoded stay pickled and values that don't
+            # shrink stay uncompressed, so don't rewrite them
+            if (
+                get_raw_encoding(encoded) != get_raw_encoding(raw) or
+                get_raw_compression(encoded) != get_raw_compression(raw)
+            ):
+                datum.value = encoded
+                to_update.append(datum)
+        if to_update:
+            queryset.model._base_manager.using(queryset.db).bulk_update(to_update, ['value'])
+            converted += len(to_update)
+    return examined, converted
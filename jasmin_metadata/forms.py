@@ -5,29 +5,208 @@ Django forms for the JASMIN services app.
 __author__ = "Matt Pryor"
 __copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
 
+import uuid, itertools
+from collections import OrderedDict, namedtuple
+
 from django import forms
-from django.contrib.contenttypes.models import ContentType
+from django.db import transaction, DEFAULT_DB_ALIAS
+
+from asgiref.sync import sync_to_async
 
 from .models import Metadatum
+from .dns import get_resolver
+from .instrumentation import timer, timed
+
+
+#: The result of validating a single row using :py:meth:`MetadataForm.validate_many`
+#: ``cleaned_data`` is ``None`` if the row has errors, and ``errors`` maps field
+#: names, or ``'__all__'`` for errors from ``clean()``, to lists of messages
+RowValidationResult = namedtuple('RowValidationResult', ('index', 'cleaned_data', 'errors'))
+
+
+def _lookup_address(field, value):
+    """
+    Returns the address to resolve for the given raw value if the field
+    requires a reverse DNS lookup, otherwise ``None``.
+    """
+    if getattr(field, 'reverse_dns_lookup', False) and isinstance(value, str):
+        return value.strip() or None
+    return None
+
+
+def _project_metadata(form_id, items, using = DEFAULT_DB_ALIAS):
+    # The models module imports this one, so import the projections on first use
+    from .models.projections import project_metadata
+    project_metadata(form_id, items, using)
 
 
 class MetadataForm(forms.Form):
     """
     Form that can attach the collected data as metadata on an object.
     """
-    def save(self, obj):
+    #: The id of the :py:class:`~.models.Form` that the form was built from, if any
+    form_id = None
+
+    def _lookup_addresses(self):
         """
-        Saves the form's cleaned_data as metadata on the given object.
+        Returns the addresses submitted for fields that require a reverse DNS lookup.
+        """
+        addresses = []
+        if self.is_bound:
+            for name, field in self.fields.items():
+                if getattr(field, 'reverse_dns_lookup', False):
+                    address = _lookup_address(field, field.widget.value_from_datadict(
+                        self.data, self.files, self.add_prefix(name)
+                    ))
+                    if address:
+                        addresses.append(address)
+        return addresses
+
+    def full_clean(self):
+        # Resolve the addresses for all the fields that require a reverse DNS
+        # lookup concurrently, so that the validators find them in the cache
+        with timer('form.is_valid'):
+            addresses = self._lookup_addresses()
+            if len(addresses) > 1:
+                get_resolver().resolve_many(addresses)
+            super().full_clean()
+
+    async def ais_valid(self):
+        """
+        Async counterpart of ``is_valid``.
+
+        The reverse DNS lookups are awaited before the form is cleaned, so that
+        the validators find the results in the cache and never block.
+        """
+        addresses = self._lookup_addresses()
+        if addresses:
+            await get_resolver().aresolve_many(addresses)
+        return self.is_valid()
+
+    def get_changed_metadata(self):
+        """
+        Returns a dictionary of the cleaned values that need to be written when
+        the form was given the stored metadata as ``initial``, i.e. the values that
+        differ from their initial value and the values that have not been stored.
+        """
+        names = set(self.changed_data)
+        names.update(name for name in self.fields if name not in self.initial)
+        return { name : self.cleaned_data[name] for name in names if name in self.cleaned_data }
+
+    @timed('form.save', queries = True)
+    def save(self, obj, only_changed = False):
+        """
+        Saves the form's cleaned_data as metadata on the given object, replacing
+        any existing metadata.
+
+        If ``only_changed`` is true, only the values returned by
+        :py:meth:`get_changed_metadata` are written and any other metadata is left
+        untouched, so the stored values of unchanged fields are never read or
+        re-serialised. This requires the form to have been given the stored
+        metadata as ``initial``.
+
+        The metadata is written to the database that the object was saved to.
+
+        Returns a :py:class:`~.models.MetadataWriteResult`.
 
         .. warning::
 
             The object must be saved before calling this method.
         """
-        content_type = ContentType.objects.get_for_model(obj)
-        # Remove any existing metadata for the object
-        Metadatum.objects.filter(content_type = content_type, object_id = obj.pk).delete()
-        for key, value in self.cleaned_data.items():
-            Metadatum.objects.create(
-                content_type = content_type, object_id = obj.pk,
-                key = key, value = value
-            )
+        using = obj._state.db or DEFAULT_DB_ALIAS
+        manager = Metadatum.objects.db_manager(using)
+        with transaction.atomic(using = using):
+            if only_changed:
+                result = manager.update_for_object(obj, self.get_changed_metadata())
+            else:
+                result = manager.set_for_object(obj, self.cleaned_data)
+            if self.form_id is not None:
+                _project_metadata(self.form_id, [(obj, self.cleaned_data)], using)
+        return result
+
+    async def asave(self, obj, only_changed = False):
+        """
+        Async counterpart of :py:meth:`save`.
+
+        Django does not support transactions in async code, so the write runs in
+        a thread, as a single hop for all the queries.
+        """
+        return await sync_to_async(self.save)(obj, only_changed)
+
+    @classmethod
+    def validate_many(cls, rows, chunk_size = 500):
+        """
+        Validates an iterable of dictionaries of raw values, e.g. rows read from a
+        CSV file, yielding a :py:class:`RowValidationResult` for each row in order.
+
+        A single form instance is reused for all the rows, so the form's fields are
+        only copied once, and each row is cleaned exactly as :py:meth:`is_valid`
+        would clean it, including any ``clean_<name>()`` and ``clean()`` methods
+        defined by subclasses. Errors from ``clean()`` are reported under
+        ``'__all__'``. Rows are consumed ``chunk_size`` at a time, and the reverse
+        DNS lookups required by each chunk are made concurrently before it is
+        validated.
+        """
+        form = cls(data = {})
+        dns_fields = [
+            (name, field) for name, field in form.fields.items()
+            if getattr(field, 'reverse_dns_lookup', False)
+        ]
+        rows = iter(rows)
+        index = 0
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            if dns_fields:
+                addresses = set(
+                    _lookup_address(field, field.widget.value_from_datadict(row, {}, name))
+                    for row in chunk
+                    for name, field in dns_fields
+                )
+                addresses.discard(None)
+                if addresses:
+                    get_resolver().resolve_many(addresses)
+            for row in chunk:
+                # Rebind the form to the row, discarding the results for the last row
+                form.data = row
+                form._errors = None
+                form.__dict__.pop('changed_data', None)
+                if form.is_valid():
+                    yield RowValidationResult(index, form.cleaned_data, {})
+                else:
+                    errors = { name : list(messages) for name, messages in form.errors.items() }
+                    yield RowValidationResult(index, None, errors)
+                index += 1
+
+    @classmethod
+    @timed('form.save_many', queries = True)
+    def save_many(cls, items):
+        """
+        Saves cleaned data as metadata on many objects at once, given an iterable
+        of ``(obj, cleaned_data)`` pairs, e.g. built from the valid results of
+        :py:meth:`validate_many`.
+
+        Returns a :py:class:`~.models.MetadataWriteResult` with the totals for all
+        the objects.
+        """
+        items = list(items)
+        with transaction.atomic():
+            result = Metadatum.objects.set_for_objects(items)
+            if cls.form_id is not None:
+                _project_metadata(cls.form_id, items)
+        return result
+
+
+def metadata_form_class(fields, form_id = None):
+    """
+    Returns a new :py:class:`MetadataForm` subclass with a form field for each
+    of the given :py:class:`~.models.Field` instances, optionally recording the
+    id of the :py:class:`~.models.Form` that they belong to.
+    """
+    attrs = OrderedDict((f.name, f.get_field()) for f in fields)
+    form_class = type(uuid.uuid4().hex, (MetadataForm, ), attrs)
+    # Set the id once the metaclass has collected the fields, so that it can't
+    # replace a field named form_id
+    form_class.form_id = form_id
+    return form_class
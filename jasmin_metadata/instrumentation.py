@@ -0,0 +1,309 @@
+"""
+Module containing the instrumentation hooks for the JASMIN metadata app.
+
+When the ``JASMIN_METADATA_INSTRUMENTATION`` setting is enabled, the main operations
+of the app - building forms and fields, running validators, validating and saving
+metadata forms and the admin hooks - report their timings to a collector, along
+with the number of queries they make and the number of bytes of values encoded.
+
+The collector is an instance of the class given by the ``JASMIN_METADATA_COLLECTOR``
+setting (default :py:class:`MemoryCollector`), constructed with the keyword
+arguments in ``JASMIN_METADATA_COLLECTOR_OPTIONS``. The default collector only
+holds the statistics for the current process, so to collect the statistics for
+all the workers of a site use :py:class:`CacheCollector` with a cache that is
+shared between them. The statistics can then be dumped using the
+``dump_metadata_stats`` management command.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import time, threading, functools
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+class Collector:
+    """
+    Base class for instrumentation collectors.
+
+    Subclasses must implement :py:meth:`timing` and :py:meth:`increment`, and may
+    implement :py:meth:`stats` and :py:meth:`reset`.
+    """
+    def timing(self, name, seconds):
+        """
+        Records that the operation with the given name took the given time.
+        """
+        raise NotImplementedError
+
+    def increment(self, name, value = 1):
+        """
+        Adds the given value to the counter with the given name.
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Returns a dictionary of the statistics collected so far, if available.
+        """
+        return {}
+
+    def reset(self):
+        """
+        Discards the statistics collected so far.
+        """
+
+
+class MemoryCollector(Collector):
+    """
+    Thread-safe collector that aggregates timings and counters in memory.
+
+    The statistics are local to the process.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._counters = {}
+
+    def timing(self, name, seconds):
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                self._timings[name] = [1, seconds, seconds, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+                timing[2] = min(timing[2], seconds)
+                timing[3] = max(timing[3], seconds)
+
+    def increment(self, name, value = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def stats(self):
+        """
+        Returns a dictionary containing the count, total, mean, minimum and maximum
+        time in seconds for each operation and the value of each counter.
+        """
+        with self._lock:
+            return OrderedDict([
+                ('timings', OrderedDict(
+                    (name, OrderedDict([
+                        ('count', count),
+                        ('total', total),
+                        ('mean', total / count),
+                        ('min', minimum),
+                        ('max', maximum),
+                    ]))
+                    for name, (count, total, minimum, maximum) in sorted(self._timings.items())
+                )),
+                ('counters', OrderedDict(sorted(self._counters.items()))),
+            ])
+
+    def reset(self):
+        with self._lock:
+            self._timings.clear()
+            self._counters.clear()
+
+
+class CacheCollector(Collector):
+    """
+    Collector that aggregates timings and counters in one of the caches from
+    Django's cache framework, so that the statistics for all the processes that
+    share the cache are collected together.
+
+    Counts and totals are updated using the cache's atomic increment. The minimum
+    and maximum times are updated without a lock, so they may occasionally miss a
+    concurrent update. Each process re-registers the names that it reports every
+    ``refresh`` seconds, so names are not lost if the statistics are reset, or if
+    two processes add new names at the same time.
+    """
+    def __init__(self, alias = 'default', prefix = 'jasmin_metadata:stats', refresh = 60):
+        #: The alias of the Django cache to use
+        self.alias = alias
+        #: The prefix for the cache keys
+        self.prefix = prefix
+        #: The interval in seconds at which the names are re-registered
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._registered = set()
+        self._registered_at = time.monotonic()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, *parts):
+        return ':'.join((self.prefix, ) + parts)
+
+    def _register(self, kind, name):
+        """
+        Adds the name to the list of names of the given kind, if it is not known to
+        have been added recently.
+        """
+        with self._lock:
+            if time.monotonic() - self._registered_at >= self.refresh:
+                self._registered.clear()
+                self._registered_at = time.monotonic()
+            if (kind, name) in self._registered:
+                return
+            self._registered.add((kind, name))
+        key = self.key(kind)
+        names = self.cache.get(key, [])
+        if name not in names:
+            self.cache.set(key, names + [name], None)
+
+    def _incr(self, key, value):
+        # add is a no-op if the key exists, so the increment is always atomic
+        self.cache.add(key, 0, None)
+        try:
+            self.cache.incr(key, value)
+        except ValueError:
+            # The key was deleted by a reset between the add and the increment
+            self.cache.add(key, value, None)
+
+    def timing(self, name, seconds):
+        self._register('timings', name)
+        self._incr(self.key('timing', name, 'count'), 1)
+        # The cache can only increment integers, so store the total in microseconds
+        self._incr(self.key('timing', name, 'total'), int(round(seconds * 1e6)))
+        minimum, maximum = self.key('timing', name, 'min'), self.key('timing', name, 'max')
+        current = self.cache.get_many([minimum, maximum])
+        if minimum not in current or seconds < current[minimum]:
+            self.cache.set(minimum, seconds, None)
+        if maximum not in current or seconds > current[maximum]:
+            self.cache.set(maximum, seconds, None)
+
+    def increment(self, name, value = 1):
+        self._register('counters', name)
+        self._incr(self.key('counter', name), value)
+
+    def _keys(self):
+        timings = self.cache.get(self.key('timings'), [])
+        counters = self.cache.get(self.key('counters'), [])
+        keys = [
+            self.key('timing', name, part)
+            for name in timings
+            for part in ('count', 'total', 'min', 'max')
+        ]
+        keys.extend(self.key('counter', name) for name in counters)
+        return timings, counters, keys
+
+    def stats(self):
+        """
+        Returns a dictionary in the same format as :py:meth:`MemoryCollector.stats`
+        containing the statistics for all the processes using the cache.
+        """
+        timings, counters, keys = self._keys()
+        values = self.cache.get_many(keys)
+        result = OrderedDict()
+        for name in sorted(timings):
+            count = values.get(self.key('timing', name, 'count'))
+            if not count:
+                continue
+            total = values.get(self.key('timing', name, 'total'), 0) / 1e6
+            result[name] = OrderedDict([
+                ('count', count),
+                ('total', total),
+                ('mean', total / count),
+                ('min', values.get(self.key('timing', name, 'min'))),
+                ('max', values.get(self.key('timing', name, 'max'))),
+            ])
+        return OrderedDict([
+            ('timings', result),
+            ('counters', OrderedDict(
+                (name, values[self.key('counter', name)])
+                for name in sorted(counters)
+                if self.key('counter', name) in values
+            )),
+        ])
+
+    def reset(self):
+        _, _, keys = self._keys()
+        self.cache.delete_many(keys + [self.key('timings'), self.key('counters')])
+        with self._lock:
+            self._registered.clear()
+
+
+@functools.lru_cache(maxsize = None)
+def get_collector():
+    """
+    Returns the configured collector, or ``None`` if instrumentation is disabled.
+    """
+    if not getattr(settings, 'JASMIN_METADATA_INSTRUMENTATION', False):
+        return None
+    collector_class = import_string(
+        getattr(settings, 'JASMIN_METADATA_COLLECTOR', 'jasmin_metadata.instrumentation.MemoryCollector')
+    )
+    return collector_class(**getattr(settings, 'JASMIN_METADATA_COLLECTOR_OPTIONS', {}))
+
+
+@receiver(setting_changed)
+def reset_collector(setting, **kwargs):
+    """
+    Discards the collector when the instrumentation settings change, e.g. in tests.
+    """
+    if setting.startswith(('JASMIN_METADATA_INSTRUMENTATION', 'JASMIN_METADATA_COLLECTOR')):
+        get_collector.cache_clear()
+
+
+def increment(name, value = 1):
+    """
+    Adds the given value to the counter with the given name, if instrumentation
+    is enabled.
+    """
+    collector = get_collector()
+    if collector is not None:
+        collector.increment(name, value)
+
+
+@contextmanager
+def timer(name, queries = False, using = DEFAULT_DB_ALIAS):
+    """
+    Context manager that reports the time taken by the block to the collector as
+    ``name``, if instrumentation is enabled.
+
+    If ``queries`` is true, the number of queries made by the block on the given
+    database is also added to the counter ``name + '.queries'``.
+    """
+    collector = get_collector()
+    if collector is None:
+        yield
+        return
+    count = 0
+    def count_queries(execute, sql, params, many, context):
+        nonlocal count
+        count += 1
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        if queries:
+            with connections[using].execute_wrapper(count_queries):
+                yield
+        else:
+            yield
+    finally:
+        collector.timing(name, time.perf_counter() - start)
+        if queries:
+            collector.increment(name + '.queries', count)
+
+
+def timed(name, queries = False):
+    """
+    Decorator that reports the time taken by each call of the decorated function
+    using :py:func:`timer`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, queries):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,79 @@
+"""
+Management command that runs the metadata benchmarks and prints the results as JSON.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import json, platform
+from collections import OrderedDict
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils import timezone
+
+from ... import __version__
+from ...benchmarks import BENCHMARKS, Runner
+
+
+class Command(BaseCommand):
+    help = 'Runs the metadata benchmarks and prints the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'benchmarks', nargs = '*', metavar = 'benchmark',
+            help = 'The benchmarks to run (default all). '
+                   'Choices: {}'.format(', '.join(BENCHMARKS))
+        )
+        parser.add_argument(
+            '--sizes', type = int, nargs = '+', default = None,
+            help = 'The problem sizes to run each benchmark with '
+                   '(default depends on the benchmark)'
+        )
+        parser.add_argument(
+            '--database', default = DEFAULT_DB_ALIAS,
+            help = 'The database to run the benchmarks against'
+        )
+        parser.add_argument(
+            '--no-allocations', action = 'store_false', dest = 'allocations',
+            help = 'Do not measure memory allocations, which slows down the '
+                   'operations being timed'
+        )
+        parser.add_argument(
+            '--output', '-o', default = '-',
+            help = 'The file to write the results to (default stdout)'
+        )
+
+    def handle(self, *args, **options):
+        names = options['benchmarks'] or list(BENCHMARKS)
+        unknown = set(names).difference(BENCHMARKS)
+        if unknown:
+            raise CommandError('Unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+        runner = Runner(options['database'], options['allocations'])
+        results = OrderedDict()
+        for name in names:
+            func, sizes = BENCHMARKS[name]
+            results[name] = OrderedDict(
+                (str(size), func(runner, size))
+                for size in options['sizes'] or sizes
+            )
+        output = json.dumps(
+            OrderedDict([
+                ('environment', OrderedDict([
+                    ('version', __version__),
+                    ('django', django.get_version()),
+                    ('python', platform.python_version()),
+                    ('database', connections[options['database']].vendor),
+                    ('allocations', options['allocations']),
+                    ('timestamp', timezone.now().isoformat()),
+                ])),
+                ('results', results),
+            ]),
+            indent = 2
+        )
+        if options['output'] == '-':
+            self.stdout.write(output)
+        else:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
@@ -0,0 +1,54 @@
+"""
+Management command that converts stored metadata values to a different encoding
+or compression.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from ...fields import (
+    ENCODINGS, COMPRESSIONS, get_value_encoding, get_value_compression, convert_values
+)
+from ...models import Metadatum
+
+
+class Command(BaseCommand):
+    help = 'Converts stored metadata values to the given encoding and compression in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--encoding', choices = ENCODINGS, default = None,
+            help = 'The encoding to convert to (default JASMIN_METADATA_VALUE_ENCODING)'
+        )
+        parser.add_argument(
+            '--compression', choices = COMPRESSIONS, default = None,
+            help = 'The compression to convert to (default JASMIN_METADATA_VALUE_COMPRESSION). '
+                   'Values shorter than JASMIN_METADATA_VALUE_COMPRESSION_THRESHOLD are '
+                   'never compressed'
+        )
+        parser.add_argument(
+            '--batch-size', type = int, default = 1000,
+            help = 'The number of rows to convert at once'
+        )
+        parser.add_argument(
+            '--database', default = DEFAULT_DB_ALIAS,
+            help = 'The database to convert'
+        )
+
+    def handle(self, *args, **options):
+        encoding = options['encoding'] or get_value_encoding()
+        compression = options['compression'] or get_value_compression()
+        examined, converted = convert_values(
+            Metadatum.objects.using(options['database']),
+            encoding,
+            options['batch_size'],
+            compression
+        )
+        self.stdout.write(
+            'Converted {} of {} values to {} with compression {}'.format(
+                converted, examined, encoding, compression
+            )
+        )
@@ -0,0 +1,45 @@
+"""
+Management command that writes schema snapshots for metadata forms to a file.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import Form
+from ...schema import dump_schemas, set_cached_schema
+
+
+class Command(BaseCommand):
+    help = 'Writes schema snapshots for metadata forms to a file, so that workers ' \
+           'can build the forms at startup without querying the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'form_ids', nargs = '*', type = int, metavar = 'form_id',
+            help = 'The ids of the forms to snapshot (default all)'
+        )
+        parser.add_argument(
+            '--output', '-o', default = getattr(settings, 'JASMIN_METADATA_SCHEMA_FILE', None),
+            help = 'The file to write the snapshots to (default JASMIN_METADATA_SCHEMA_FILE)'
+        )
+        parser.add_argument(
+            '--cache', action = 'store_true',
+            help = 'Also store the snapshots in JASMIN_METADATA_SCHEMA_CACHE'
+        )
+
+    def handle(self, *args, **options):
+        if not options['output']:
+            raise CommandError('No output file given and JASMIN_METADATA_SCHEMA_FILE is not set')
+        forms = Form.objects.all()
+        if options['form_ids']:
+            forms = forms.filter(pk__in = options['form_ids'])
+        schemas = [form.get_schema() for form in forms]
+        with open(options['output'], 'w') as fp:
+            dump_schemas(schemas, fp)
+        if options['cache']:
+            for schema in schemas:
+                set_cached_schema(schema)
+        self.stdout.write('Wrote {} form schemas to {}'.format(len(schemas), options['output']))
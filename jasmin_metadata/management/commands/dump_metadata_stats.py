@@ -0,0 +1,82 @@
+"""
+Management command that prints the statistics from the instrumentation collector
+as JSON.
+
+To see the statistics recorded by the workers of a site, rather than by the
+command itself, configure a collector that is shared between processes, e.g.
+:py:class:`~jasmin_metadata.instrumentation.CacheCollector`.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.test.utils import override_settings
+
+from ...benchmarks import BENCHMARKS, Runner
+from ...instrumentation import get_collector, MemoryCollector
+
+
+class Command(BaseCommand):
+    help = 'Prints the statistics from the instrumentation collector as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'benchmarks', nargs = '*', metavar = 'benchmark',
+            help = 'Benchmarks to run with instrumentation enabled, printing '
+                   'the statistics for them instead of those in the configured '
+                   'collector. Choices: {}'.format(', '.join(BENCHMARKS))
+        )
+        parser.add_argument(
+            '--database', default = DEFAULT_DB_ALIAS,
+            help = 'The database to run the benchmarks against'
+        )
+        parser.add_argument(
+            '--reset', action = 'store_true',
+            help = 'Discard the statistics once they have been printed'
+        )
+        parser.add_argument(
+            '--output', '-o', default = '-',
+            help = 'The file to write the statistics to (default stdout)'
+        )
+
+    def handle(self, *args, **options):
+        unknown = set(options['benchmarks']).difference(BENCHMARKS)
+        if unknown:
+            raise CommandError('Unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+        if options['benchmarks']:
+            # Use a fresh in-memory collector, which is discarded when the override
+            # ends, so that the benchmarks are never mixed up with the statistics
+            # in a shared collector
+            with override_settings(
+                JASMIN_METADATA_INSTRUMENTATION = True,
+                JASMIN_METADATA_COLLECTOR = 'jasmin_metadata.instrumentation.MemoryCollector',
+                JASMIN_METADATA_COLLECTOR_OPTIONS = {}
+            ):
+                runner = Runner(options['database'], allocations = False)
+                for name in options['benchmarks']:
+                    func, sizes = BENCHMARKS[name]
+                    for size in sizes:
+                        func(runner, size)
+                stats = get_collector().stats()
+        else:
+            collector = get_collector()
+            if collector is None:
+                raise CommandError('Instrumentation is not enabled')
+            if isinstance(collector, MemoryCollector):
+                self.stderr.write(
+                    'The collector only holds the statistics for this process - '
+                    'use CacheCollector to see the statistics for other processes'
+                )
+            stats = collector.stats()
+            if options['reset']:
+                collector.reset()
+        output = json.dumps(stats, indent = 2)
+        if options['output'] == '-':
+            self.stdout.write(output)
+        else:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
@@ -0,0 +1,49 @@
+"""
+Management command that exports metadata form definitions as JSON or YAML.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from ...models import Form
+from ...exchange import FORMATS, export_forms, dump_definitions
+
+
+class Command(BaseCommand):
+    help = 'Exports metadata forms, with their fields and choices, as JSON or YAML'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'names', nargs = '*', metavar = 'name',
+            help = 'The names of the forms to export (default all)'
+        )
+        parser.add_argument(
+            '--format', choices = FORMATS, default = 'json',
+            help = 'The output format (default json)'
+        )
+        parser.add_argument(
+            '--output', '-o', default = '-',
+            help = 'The file to write to (default stdout)'
+        )
+        parser.add_argument(
+            '--database', default = DEFAULT_DB_ALIAS,
+            help = 'The database to export from'
+        )
+
+    def handle(self, *args, **options):
+        forms = Form.objects.using(options['database']).order_by('name', 'pk')
+        if options['names']:
+            forms = forms.filter(name__in = options['names'])
+            missing = set(options['names']).difference(f.name for f in forms)
+            if missing:
+                raise CommandError('Unknown forms: {}'.format(', '.join(sorted(missing))))
+        definitions = export_forms(forms)
+        if options['output'] == '-':
+            dump_definitions(definitions, self.stdout, options['format'])
+        else:
+            with open(options['output'], 'w') as fp:
+                dump_definitions(definitions, fp, options['format'])
+            self.stdout.write('Exported {} forms to {}'.format(len(definitions), options['output']))
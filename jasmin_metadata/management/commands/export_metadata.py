@@ -0,0 +1,127 @@
+"""
+Management command that streams metadata to a file as JSON Lines or CSV.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import csv, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.contrib.contenttypes.models import ContentType
+from django.db import DEFAULT_DB_ALIAS
+
+from ...models import Metadatum
+
+
+class MetadataJSONEncoder(DjangoJSONEncoder):
+    """
+    JSON encoder that falls back to ``str`` for values that are not otherwise
+    serialisable, since metadata values can be any pickle-able object.
+    """
+    def default(self, o):
+        if isinstance(o, (set, frozenset, tuple)):
+            return list(o)
+        try:
+            return super().default(o)
+        except TypeError:
+            return str(o)
+
+
+class Command(BaseCommand):
+    help = 'Streams metadata as JSON Lines (one object per line) or CSV (one datum per row)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format', choices = ['jsonl', 'csv'], default = 'jsonl',
+            help = 'The output format (default jsonl)'
+        )
+        parser.add_argument(
+            '--output', '-o', default = '-',
+            help = 'The file to write to (default stdout)'
+        )
+        parser.add_argument(
+            '--content-type', action = 'append', dest = 'content_types', default = [],
+            metavar = 'APP_LABEL.MODEL',
+            help = 'Only export metadata for the given content type (may be repeated)'
+        )
+        parser.add_argument(
+            '--key', action = 'append', dest = 'keys', default = [],
+            help = 'Only export the given metadata key (may be repeated)'
+        )
+        parser.add_argument(
+            '--chunk-size', type = int, default = 2000,
+            help = 'The number of rows to fetch from the database at once'
+        )
+        parser.add_argument(
+            '--progress-every', type = int, default = 10000,
+            help = 'Report progress after this many objects (0 to disable)'
+        )
+        parser.add_argument(
+            '--database', default = DEFAULT_DB_ALIAS,
+            help = 'The database to export from'
+        )
+
+    def get_queryset(self, options):
+        queryset = Metadatum.objects.using(options['database'])
+        if options['content_types']:
+            content_types = []
+            for label in options['content_types']:
+                try:
+                    app_label, model = label.lower().split('.')
+                    content_types.append(
+                        ContentType.objects.db_manager(options['database'])
+                            .get_by_natural_key(app_label, model)
+                    )
+                except (ValueError, ContentType.DoesNotExist):
+                    raise CommandError('Unknown content type: {}'.format(label))
+            queryset = queryset.filter(content_type__in = content_types)
+        if options['keys']:
+            queryset = queryset.filter(key__in = options['keys'])
+        return queryset
+
+    def handle(self, *args, **options):
+        queryset = self.get_queryset(options)
+        encoder = MetadataJSONEncoder()
+        if options['output'] == '-':
+            output = self.stdout
+        else:
+            output = open(options['output'], 'w', newline = '')
+        try:
+            if options['format'] == 'csv':
+                writer = csv.writer(output)
+                writer.writerow(['content_type', 'object_id', 'key', 'value'])
+            n_objects = n_rows = 0
+            start = time.perf_counter()
+            for content_type_id, object_id, metadata in queryset.iter_grouped(options['chunk_size']):
+                content_type = ContentType.objects.get_for_id(content_type_id)
+                label = '{}.{}'.format(content_type.app_label, content_type.model)
+                if options['format'] == 'csv':
+                    writer.writerows(
+                        [label, object_id, key, encoder.encode(value)]
+                        for key, value in metadata.items()
+                    )
+                else:
+                    output.write(encoder.encode({
+                        'content_type' : label,
+                        'object_id' : object_id,
+                        'metadata' : metadata,
+                    }) + '\n')
+                n_objects += 1
+                n_rows += len(metadata)
+                if options['progress_every'] and n_objects % options['progress_every'] == 0:
+                    self.report_progress(n_objects, n_rows, start)
+            if not options['progress_every'] or n_objects % options['progress_every'] != 0:
+                self.report_progress(n_objects, n_rows, start)
+        finally:
+            if output is not self.stdout:
+                output.close()
+
+    def report_progress(self, n_objects, n_rows, start):
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        self.stderr.write(
+            'Exported {} objects ({} rows) in {:.1f}s - {:.0f} rows/s'.format(
+                n_objects, n_rows, elapsed, n_rows / elapsed
+            )
+        )
@@ -0,0 +1,50 @@
+"""
+Management command that imports metadata form definitions written by the
+``export_forms`` command.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import sys
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, IntegrityError
+
+from ...exchange import FORMATS, import_forms, load_definitions
+
+
+class Command(BaseCommand):
+    help = 'Imports metadata forms exported by export_forms in a single transaction'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'input', nargs = '?', default = '-',
+            help = 'The file to read from (default stdin)'
+        )
+        parser.add_argument(
+            '--format', choices = FORMATS,
+            help = 'The input format (default from the file extension, otherwise json)'
+        )
+        parser.add_argument(
+            '--database', default = DEFAULT_DB_ALIAS,
+            help = 'The database to import into'
+        )
+
+    def handle(self, *args, **options):
+        format = options['format']
+        if not format:
+            format = 'yaml' if options['input'].endswith(('.yaml', '.yml')) else 'json'
+        try:
+            if options['input'] == '-':
+                definitions = load_definitions(sys.stdin, format)
+            else:
+                with open(options['input']) as fp:
+                    definitions = load_definitions(fp, format)
+            forms = import_forms(definitions, options['database'])
+        # The definitions are validated before inserting, but the database has
+        # the final say, e.g. if another process creates conflicting rows
+        except (ValueError, TypeError, LookupError, ValidationError, IntegrityError) as exc:
+            raise CommandError('Import failed: {}'.format(exc))
+        self.stdout.write('Imported {} forms'.format(len(forms)))
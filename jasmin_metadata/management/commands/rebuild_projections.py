@@ -0,0 +1,42 @@
+"""
+Management command that rebuilds the projection tables for metadata forms.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from ...models import FormProjection
+
+
+class Command(BaseCommand):
+    help = 'Drops and rebuilds the projection tables for metadata forms from the ' \
+           'stored metadata, using the current schema of each form'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'form_ids', nargs = '*', type = int, metavar = 'form_id',
+            help = 'The ids of the forms to rebuild the projections for (default all)'
+        )
+        parser.add_argument(
+            '--batch-size', type = int, default = 1000,
+            help = 'The number of rows to write at once'
+        )
+        parser.add_argument(
+            '--database', default = DEFAULT_DB_ALIAS,
+            help = 'The database to rebuild the projections in'
+        )
+
+    def handle(self, *args, **options):
+        projections = FormProjection.objects.using(options['database']).select_related('form')
+        if options['form_ids']:
+            projections = projections.filter(form__in = options['form_ids'])
+        for projection in projections:
+            try:
+                written = projection.rebuild(options['batch_size'], options['database'])
+            except ValueError as exc:
+                self.stderr.write('Could not rebuild {}: {}'.format(projection.table_name, exc))
+            else:
+                self.stdout.write('Rebuilt {} with {} rows'.format(projection.table_name, written))
@@ -0,0 +1,46 @@
+"""
+Management command that refreshes the projection tables for metadata forms.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from ...models import FormProjection
+
+
+class Command(BaseCommand):
+    help = 'Writes the rows for objects queued for the projection tables of metadata ' \
+           'forms, rebuilding any tables that are out of date with their form'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'form_ids', nargs = '*', type = int, metavar = 'form_id',
+            help = 'The ids of the forms to refresh the projections for (default all)'
+        )
+        parser.add_argument(
+            '--batch-size', type = int, default = 1000,
+            help = 'The number of objects to refresh at once'
+        )
+        parser.add_argument(
+            '--database', default = DEFAULT_DB_ALIAS,
+            help = 'The database to refresh the projections in'
+        )
+
+    def handle(self, *args, **options):
+        projections = FormProjection.objects.using(options['database']).select_related('form')
+        if options['form_ids']:
+            projections = projections.filter(form__in = options['form_ids'])
+        for projection in projections:
+            if projection.is_current:
+                refreshed = projection.refresh(options['batch_size'], options['database'])
+                self.stdout.write('Refreshed {} objects in {}'.format(refreshed, projection.table_name))
+            else:
+                try:
+                    written = projection.rebuild(options['batch_size'], options['database'])
+                except ValueError as exc:
+                    self.stderr.write('Could not rebuild {}: {}'.format(projection.table_name, exc))
+                else:
+                    self.stdout.write('Rebuilt {} with {} rows'.format(projection.table_name, written))
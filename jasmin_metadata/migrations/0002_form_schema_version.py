@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jasmin_metadata', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='form',
+            name='schema_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:15
+
+from django.db import migrations, models
+
+from markdown_deux.templatetags.markdown_deux_tags import markdown_filter
+
+
+def render_help_text(apps, schema_editor):
+    """
+    Renders the help text for existing fields.
+    """
+    Field = apps.get_model('jasmin_metadata', 'Field')
+    db_alias = schema_editor.connection.alias
+    fields = list(Field.objects.using(db_alias).only('id', 'help_text'))
+    for field in fields:
+        field.help_text_html = markdown_filter(field.help_text)
+    Field.objects.using(db_alias).bulk_update(fields, ['help_text_html'], batch_size = 500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jasmin_metadata', '0002_form_schema_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='field',
+            name='help_text_html',
+            field=models.TextField(editable=False, null=True),
+        ),
+        migrations.RunPython(render_help_text, migrations.RunPython.noop),
+    ]
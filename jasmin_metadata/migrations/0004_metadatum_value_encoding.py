@@ -0,0 +1,36 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:16
+
+from django.db import migrations
+import jasmin_metadata.fields
+
+
+def convert_values(apps, schema_editor):
+    """
+    Converts existing values to the configured encoding.
+
+    This is a no-op for deployments that keep the default pickle encoding.
+    """
+    encoding = jasmin_metadata.fields.get_value_encoding()
+    if encoding == 'pickle':
+        return
+    Metadatum = apps.get_model('jasmin_metadata', 'Metadatum')
+    jasmin_metadata.fields.convert_values(
+        Metadatum.objects.using(schema_editor.connection.alias),
+        encoding
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jasmin_metadata', '0003_field_help_text_html'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='metadatum',
+            name='value',
+            field=jasmin_metadata.fields.MetadataValueField(editable=False, null=True),
+        ),
+        migrations.RunPython(convert_values, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:17
+
+from django.db import migrations, models
+import jasmin_metadata.fields
+
+
+def index_values(apps, schema_editor):
+    """
+    Populates the normalised value for existing rows in batches.
+    """
+    Metadatum = apps.get_model('jasmin_metadata', 'Metadatum')
+    queryset = Metadatum.objects.using(schema_editor.connection.alias).order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt = last_pk).only('pk', 'value')[:1000])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        for datum in batch:
+            datum.value_index = jasmin_metadata.fields.index_value(datum.value)
+        queryset.bulk_update(batch, ['value_index'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jasmin_metadata', '0004_metadatum_value_encoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metadatum',
+            name='value_index',
+            field=models.CharField(editable=False, max_length=250, null=True),
+        ),
+        migrations.RunPython(index_values, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='metadatum',
+            index=models.Index(fields=['content_type', 'key', 'value_index'], name='jasmin_metadatum_value_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:19
+
+from django.db import migrations, models
+import jasmin_metadata.patterns
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jasmin_metadata', '0005_metadatum_value_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='regexfield',
+            name='regex',
+            field=models.CharField(help_text='The Python-formatted regular expression to match', max_length=250, validators=[jasmin_metadata.patterns.validate_pattern]),
+        ),
+    ]
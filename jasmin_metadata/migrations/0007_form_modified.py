@@ -0,0 +1,20 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:20
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jasmin_metadata', '0006_regexfield_validate_pattern'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='form',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='last modified'),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jasmin_metadata.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('jasmin_metadata', '0007_form_modified'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetadataRevision',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.CharField(max_length=250)),
+                ('number', models.PositiveIntegerField()),
+                ('created', models.DateTimeField()),
+                ('is_snapshot', models.BooleanField(default=False)),
+                ('changed', jasmin_metadata.fields.MetadataValueField(editable=False)),
+                ('removed', jasmin_metadata.fields.MetadataValueField(editable=False)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='metadatarevision',
+            index=models.Index(fields=['content_type', 'object_id', 'created'], name='jasmin_metadatarev_time_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='metadatarevision',
+            unique_together={('content_type', 'object_id', 'number')},
+        ),
+    ]
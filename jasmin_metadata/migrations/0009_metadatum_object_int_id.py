@@ -0,0 +1,58 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:29
+
+from django.db import migrations, models
+from django.db.models.functions import Cast
+import jasmin_metadata.models.targets
+
+
+def populate_object_int_ids(apps, schema_editor):
+    """
+    Populates the integer object id for existing rows whose object id is the
+    canonical representation of an integer in the range of the column.
+
+    Ids of up to 18 digits always fit, so they are set using a single update.
+    Ids of 19 digits may not, so they are checked using the same function as new
+    rows and updated in batches.
+    """
+    Metadatum = apps.get_model('jasmin_metadata', 'Metadatum')
+    queryset = Metadatum.objects.using(schema_editor.connection.alias)
+    queryset \
+        .filter(object_id__regex = r'^(0|-?[1-9][0-9]{0,17})$') \
+        .update(object_int_id = Cast('object_id', models.BigIntegerField()))
+    populate_long_object_int_ids(queryset)
+
+
+def populate_long_object_int_ids(queryset):
+    """
+    Populates the integer object id for the rows in the queryset with 19 digit ids.
+    """
+    queryset = queryset.filter(object_id__regex = r'^-?[1-9][0-9]{18}$').order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt = last_pk).only('pk', 'object_id')[:1000])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        for datum in batch:
+            datum.object_int_id = jasmin_metadata.models.targets.parse_object_int_id(datum.object_id)
+        queryset.bulk_update(batch, ['object_int_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jasmin_metadata', '0008_metadatarevision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metadatum',
+            name='object_int_id',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(populate_object_int_ids, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='metadatum',
+            index=models.Index(fields=['content_type', 'object_int_id', 'key'], name='jasmin_metadatum_int_id_idx'),
+        ),
+    ]
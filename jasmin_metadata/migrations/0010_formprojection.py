@@ -0,0 +1,39 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('jasmin_metadata', '0009_metadatum_object_int_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FormProjection',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mode', models.CharField(choices=[('sync', 'Synchronous'), ('incremental', 'Incremental')], default='sync', max_length=20)),
+                ('schema_version', models.PositiveIntegerField(editable=False, null=True)),
+                ('rebuilt', models.DateTimeField(editable=False, null=True)),
+                ('refreshed', models.DateTimeField(editable=False, null=True)),
+                ('content_types', models.ManyToManyField(blank=True, help_text='Objects of these models with metadata for the form are included when the table is rebuilt, in addition to objects that are already projected', to='contenttypes.ContentType')),
+                ('form', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='projection', to='jasmin_metadata.form')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProjectionUpdate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.CharField(max_length=250)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+                ('projection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='updates', to='jasmin_metadata.formprojection')),
+            ],
+            options={
+                'unique_together': {('projection', 'content_type', 'object_id')},
+            },
+        ),
+    ]
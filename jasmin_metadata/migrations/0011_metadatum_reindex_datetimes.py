@@ -0,0 +1,35 @@
+from django.db import migrations, models
+import jasmin_metadata.fields
+
+
+def reindex_datetimes(apps, schema_editor):
+    """
+    Recomputes the normalised value for existing datetime and time rows in batches,
+    as aware datetimes are now indexed in UTC and microseconds are always included.
+    """
+    Metadatum = apps.get_model('jasmin_metadata', 'Metadatum')
+    queryset = (
+        Metadatum.objects.using(schema_editor.connection.alias)
+            .filter(models.Q(value_index__startswith = 'dt:') | models.Q(value_index__startswith = 't:'))
+            .order_by('pk')
+    )
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt = last_pk).only('pk', 'value')[:1000])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        for datum in batch:
+            datum.value_index = jasmin_metadata.fields.index_value(datum.value)
+        Metadatum.objects.using(schema_editor.connection.alias).bulk_update(batch, ['value_index'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jasmin_metadata', '0010_formprojection'),
+    ]
+
+    operations = [
+        migrations.RunPython(reindex_datetimes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+from django.db import migrations
+import jasmin_metadata.models.targets
+
+
+def populate_long_object_int_ids(apps, schema_editor):
+    """
+    Populates the integer object id for existing rows whose object id has 19
+    digits, which were missed by earlier versions of migration 0009, checking the
+    range using the same function as new rows.
+    """
+    Metadatum = apps.get_model('jasmin_metadata', 'Metadatum')
+    queryset = (
+        Metadatum.objects.using(schema_editor.connection.alias)
+            .filter(object_int_id__isnull = True, object_id__regex = r'^-?[1-9][0-9]{18}$')
+            .order_by('pk')
+    )
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt = last_pk).only('pk', 'object_id')[:1000])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        for datum in batch:
+            datum.object_int_id = jasmin_metadata.models.targets.parse_object_int_id(datum.object_id)
+        Metadatum.objects.using(schema_editor.connection.alias) \
+            .bulk_update(batch, ['object_int_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jasmin_metadata', '0011_metadatum_reindex_datetimes'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_long_object_int_ids, migrations.RunPython.noop),
+    ]
@@ -5,5 +5,10 @@ Models for the JASMIN dynamic forms app.
 __author__ = "Matt Pryor"
 __copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
 
-from .base import Metadatum, HasMetadata
+from .base import (
+    Metadatum, MetadataWriteResult, HasMetadata, HasMetadataQuerySet, LazyMetadata,
+    load_metadata, aload_metadata
+)
+from .history import MetadataRevision
 from .forms import *
+from .projections import FormProjection, ProjectionUpdate, project_metadata
@@ -5,12 +5,242 @@ Django models for the JASMIN services app.
 __author__ = "Matt Pryor"
 __copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
 
-from django.db import models
+import itertools
+
+import django
+from collections import namedtuple
+from collections.abc import Mapping
+
+from django.db import models, transaction, DEFAULT_DB_ALIAS
+from django.db.models import prefetch_related_objects
+from django.db.models.functions import Cast
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from asgiref.sync import sync_to_async
+
+from ..cache import get_metadata_cache
+from ..fields import MetadataValueField, index_value, INDEX_MAX_LENGTH
+from .history import MetadataRevision, history_enabled
+from .targets import (
+    get_content_type, metadata_target, ametadata_target,
+    parse_object_int_id, use_integer_object_ids
+)
+
+
+#: Indicates if Django's async ORM interface is available, i.e. Django >= 4.1
+#: Otherwise, the async methods fall back to running the sync code in a thread
+ASYNC_ORM = django.VERSION >= (4, 1)
+
+
+#: The result of a metadata write, i.e. the number of rows inserted, updated and deleted
+MetadataWriteResult = namedtuple('MetadataWriteResult', ('inserted', 'updated', 'deleted'))
+
+
+def _values_equal(a, b):
+    """
+    Returns ``True`` if the two values are equal *and* of the same type, so that
+    changes such as ``1`` to ``True`` are not lost.
+    """
+    return type(a) is type(b) and a == b
+
+
+def _has_integer_pk(model):
+    pk = model._meta.pk
+    # For multi-table inheritance, the primary key is a link to the parent
+    while pk.is_relation:
+        pk = pk.target_field
+    return isinstance(pk, models.IntegerField)
+
+
+class MetadatumQuerySet(models.QuerySet):
+    """
+    Queryset for :py:class:`Metadatum`.
+    """
+    def iter_grouped(self, chunk_size = 2000):
+        """
+        Streams the metadata in the queryset grouped by object, yielding a
+        ``(content_type_id, object_id, metadata_dict)`` tuple for each object.
+
+        Rows are fetched ``chunk_size`` at a time (using a server-side cursor
+        where the database supports it) without creating model instances, so
+        memory use is bounded regardless of the size of the table.
+        """
+        rows = (
+            self.order_by('content_type', 'object_id', 'key')
+                .values_list('content_type_id', 'object_id', 'key', 'value')
+                .iterator(chunk_size = chunk_size)
+        )
+        for (content_type_id, object_id), group in itertools.groupby(rows, lambda r: r[:2]):
+            yield content_type_id, object_id, { r[2] : r[3] for r in group }
+
+
+    def object_pks(self, model, key, value):
+        """
+        Returns a queryset of the primary keys of the instances of ``model`` whose
+        metadata ``key`` has the given scalar value, suitable for use as a subquery.
+
+        The lookup uses the index on the normalised value, so runs as a single
+        indexed query. Raises ``ValueError`` if the value cannot be indexed.
+        """
+        normalised = index_value(value)
+        if normalised is None:
+            raise ValueError('Only scalar metadata values can be looked up')
+        queryset = self.filter(
+            content_type = get_content_type(model, self.db),
+            key = key,
+            value_index = normalised
+        )
+        if use_integer_object_ids() and _has_integer_pk(model):
+            return queryset.values('object_int_id')
+        # object_id is a string, so cast it to the type of the primary key
+        return queryset.annotate(object_pk = Cast('object_id', model._meta.pk)).values('object_pk')
+
 
-from picklefield.fields import PickledObjectField
+class MetadatumManager(models.Manager.from_queryset(MetadatumQuerySet)):
+    """
+    Manager for :py:class:`Metadatum` that provides set-based writes.
+    """
+    def for_object(self, obj):
+        """
+        Returns a queryset of the metadata attached to the given object.
+        """
+        return self.filter(**metadata_target(obj, self.db).lookup())
+
+    def set_for_object(self, obj, data):
+        """
+        Replaces the metadata attached to the given object with the given dictionary.
+
+        The stored rows are diffed against ``data`` so that new keys are inserted,
+        changed values are updated and keys that are gone are deleted, with rows
+        whose value has not changed left untouched. All the writes happen in a
+        single transaction using a constant number of queries, regardless of the
+        number of keys.
+
+        Returns a :py:class:`MetadataWriteResult`.
+
+        .. warning::
+
+            The object must be saved before calling this method.
+        """
+        return self.set_for_objects([(obj, data)])
+
+    def update_for_object(self, obj, data):
+        """
+        Sets the metadata keys in the given dictionary on the given object, leaving
+        any other keys untouched.
+
+        Only the rows for the given keys are read, so values stored for other keys
+        are never decoded or written.
+
+        Returns a :py:class:`MetadataWriteResult`.
+        """
+        return self.set_for_objects([(obj, data)], replace = False)
+
+    def set_for_objects(self, items, batch_size = 500, replace = True):
+        """
+        Replaces the metadata attached to many objects at once, given an iterable
+        of ``(obj, data)`` pairs. The objects may be of different models.
+
+        This works like :py:meth:`set_for_object`, but the objects are processed
+        ``batch_size`` at a time with a constant number of queries per batch, all
+        in a single transaction. If ``replace`` is false, it works like
+        :py:meth:`update_for_object` instead.
+
+        Returns a :py:class:`MetadataWriteResult` with the totals for all the objects.
+        """
+        items = list(items)
+        totals = MetadataWriteResult(0, 0, 0)
+        with transaction.atomic(using = self.db):
+            for start in range(0, len(items), batch_size):
+                result = self._set_batch(items[start:start + batch_size], batch_size, replace)
+                totals = MetadataWriteResult(*(t + r for t, r in zip(totals, result)))
+        # Discard any metadata prefetched or cached for the objects, as it is now stale
+        for obj, _ in items:
+            getattr(obj, '_prefetched_objects_cache', {}).pop('metadata', None)
+            obj.__dict__.pop('meta', None)
+        cache = get_metadata_cache()
+        if cache is not None:
+            cache.invalidate(
+                [
+                    (target.content_type.pk, target.object_id)
+                    for target in (metadata_target(obj, self.db) for obj, _ in items)
+                ],
+                self.db
+            )
+        return totals
+
+    def _set_batch(self, items, batch_size, replace):
+        """
+        Writes the metadata for a single batch of ``(obj, data)`` pairs.
+        """
+        targets = {}
+        lookups = {}
+        for obj, data in items:
+            target = metadata_target(obj, self.db)
+            targets[target] = data
+            # Group the ids by content type and the column used to find them
+            field, value = next(
+                (k, v) for k, v in target.lookup().items() if k != 'content_type'
+            )
+            lookups.setdefault((target.content_type, field), set()).add(value)
+        condition = models.Q()
+        for (content_type, field), ids in lookups.items():
+            condition |= models.Q(content_type = content_type, **{ field + '__in' : ids })
+        queryset = self.select_for_update().filter(condition)
+        if not replace:
+            # Only the rows for the keys being set are needed
+            queryset = queryset.filter(key__in = set(k for _, data in items for k in data))
+        existing = {}
+        for datum in queryset:
+            target = (datum.content_type_id, datum.object_id)
+            existing.setdefault(target, {})[datum.key] = datum
+        to_create = []
+        to_update = []
+        to_delete = []
+        revisions = []
+        for (content_type, object_id, object_int_id), data in targets.items():
+            stored = existing.pop((content_type.pk, object_id), {})
+            changed = {}
+            for key, value in data.items():
+                datum = stored.pop(key, None)
+                if datum is None:
+                    to_create.append(self.model(
+                        content_type = content_type,
+                        object_id = object_id,
+                        object_int_id = object_int_id,
+                        key = key,
+                        value = value,
+                        value_index = index_value(value)
+                    ))
+                    changed[key] = value
+                elif not _values_equal(datum.value, value):
+                    datum.value = value
+                    datum.value_index = index_value(value)
+                    to_update.append(datum)
+                    changed[key] = value
+            if not replace:
+                # The full metadata is not known, so the history loads it if needed
+                if changed:
+                    revisions.append((content_type, object_id, None, changed, []))
+                continue
+            to_delete.extend(d.pk for d in stored.values())
+            if changed or stored:
+                revisions.append((content_type, object_id, data, changed, list(stored)))
+        if to_create:
+            self.bulk_create(to_create, batch_size = batch_size)
+        if to_update:
+            self.bulk_update(to_update, ['value', 'value_index'], batch_size = batch_size)
+        deleted = 0
+        for start in range(0, len(to_delete), batch_size):
+            count, _ = self.filter(pk__in = to_delete[start:start + batch_size]).delete()
+            deleted += count
+        if history_enabled():
+            MetadataRevision.objects.db_manager(self.db).record(revisions, timezone.now())
+        return MetadataWriteResult(len(to_create), len(to_update), deleted)
 
 
 class Metadatum(models.Model):
@@ -18,49 +248,300 @@ class Metadatum(models.Model):
     Model that allows the association of arbitrary data of any pickle-able
     type with any model instance.
 
+    Values are stored pickled or using a typed JSON encoding depending on the
+    ``JASMIN_METADATA_VALUE_ENCODING`` setting - see
+    :py:class:`~..fields.MetadataValueField`.
+
     This is achieved by using the generic foreign key from the
     ``django.contrib.contenttypes`` module.
     """
     class Meta:
         verbose_name_plural = 'metadata'
         unique_together = ('content_type', 'object_id', 'key')
+        indexes = [
+            models.Index(
+                fields = ['content_type', 'key', 'value_index'],
+                name = 'jasmin_metadatum_value_idx'
+            ),
+            models.Index(
+                fields = ['content_type', 'object_int_id', 'key'],
+                name = 'jasmin_metadatum_int_id_idx'
+            ),
+        ]
 
     content_type = models.ForeignKey(ContentType, models.CASCADE)
     object_id = models.CharField(max_length = 250)
+    #: The object id as an integer, for objects with integer primary keys
+    object_int_id = models.BigIntegerField(null = True, editable = False)
     content_object = GenericForeignKey('content_type', 'object_id')
     #: The metadata key
     key = models.CharField(max_length = 200)
-    #: The pickled value for the datum
-    value = PickledObjectField(null = True)
+    #: The encoded value for the datum
+    value = MetadataValueField(null = True)
+    #: Normalised representation of scalar values, for indexed lookups
+    value_index = models.CharField(max_length = INDEX_MAX_LENGTH, null = True, editable = False)
+
+    objects = MetadatumManager()
+
+    def save(self, *args, **kwargs):
+        self.object_int_id = parse_object_int_id(self.object_id)
+        self.value_index = index_value(self.value)
+        super().save(*args, **kwargs)
+
+
+def load_metadata(objs):
+    """
+    Loads the metadata for all the given objects, which must inherit from
+    :py:class:`HasMetadata` but may be of different models, so that accessing
+    :py:attr:`HasMetadata.metadata_dict` does not query the database.
+
+    Makes one query per model.
+    """
+    objs = [obj for obj in objs if obj.pk is not None]
+    objs.sort(key = lambda obj: obj._meta.label)
+    for _, group in itertools.groupby(objs, lambda obj: obj._meta.label):
+        prefetch_related_objects(list(group), 'metadata')
+
+
+async def aload_metadata(objs):
+    """
+    Async counterpart of :py:func:`load_metadata`, which also makes one query per
+    model, after which :py:meth:`HasMetadata.ametadata_dict` does not query the
+    database.
+    """
+    if not ASYNC_ORM:
+        return await sync_to_async(load_metadata)(objs)
+    objs = [obj for obj in objs if obj.pk is not None]
+    objs.sort(key = lambda obj: obj._meta.label)
+    for _, group in itertools.groupby(objs, lambda obj: obj._meta.label):
+        group = list(group)
+        targets = [await ametadata_target(obj) for obj in group]
+        # Match the rows to the objects using the column the relation joins on
+        relation = group[0]._meta.get_field('metadata')
+        if relation.object_id_field_name == 'object_int_id':
+            ids = [t.object_int_id for t in targets]
+        else:
+            ids = [t.object_id for t in targets]
+        found = {}
+        queryset = Metadatum.objects.using(group[0]._state.db).filter(**{
+            'content_type' : targets[0].content_type,
+            relation.object_id_field_name + '__in' : ids,
+        })
+        async for datum in queryset:
+            found.setdefault(getattr(datum, relation.object_id_field_name), []).append(datum)
+        # Store the results in the same way as prefetch_related_objects, building
+        # the related managers in a thread as they can resolve the content type
+        querysets = await sync_to_async(lambda: [obj.metadata.all() for obj in group])()
+        for obj, metadata, object_id in zip(group, querysets, ids):
+            metadata._result_cache = found.get(object_id, [])
+            metadata._prefetch_done = True
+            obj.__dict__.setdefault('_prefetched_objects_cache', {})['metadata'] = metadata
+
+
+class LazyMetadata(Mapping):
+    """
+    Read-only mapping of the metadata for an object that only fetches the keys
+    that are accessed, and only decodes values when they are first accessed.
+
+    Fetched keys are remembered, including keys that are not present, so each
+    key is fetched at most once. If the metadata for the object has been loaded
+    using :py:func:`load_metadata`, it is used instead of querying.
+    """
+    #: Marker for keys that are not present
+    _MISSING = object()
+
+    def __init__(self, obj):
+        self.obj = obj
+        # Maps fetched keys to their raw encoded values, or to _MISSING
+        self._raw = {}
+        # Maps keys to their decoded values
+        self._values = {}
+        self._keys = None
+
+    def _fetch(self, keys):
+        """
+        Fetches the raw values for any of the given keys that have not already
+        been fetched using a single query.
+        """
+        keys = [k for k in keys if k not in self._raw]
+        if not keys:
+            return
+        prefetched = getattr(self.obj, '_prefetched_objects_cache', {}).get('metadata')
+        if prefetched is not None:
+            data = { d.key : d.value for d in prefetched }
+            for key in keys:
+                if key in data:
+                    self._values[key] = data[key]
+                    self._raw[key] = None
+                else:
+                    self._raw[key] = self._MISSING
+            return
+        for key in keys:
+            self._raw[key] = self._MISSING
+        # Fetch the stored strings without decoding them
+        self._raw.update(
+            Metadatum.objects.db_manager(self.obj._state.db)
+                .for_object(self.obj)
+                .filter(key__in = keys)
+                .annotate(raw_value = Cast('value', models.TextField()))
+                .values_list('key', 'raw_value')
+        )
+
+    def _value(self, key):
+        raw = self._raw[key]
+        if raw is self._MISSING:
+            raise KeyError(key)
+        if key not in self._values:
+            self._values[key] = Metadatum._meta.get_field('value').to_python(raw)
+        return self._values[key]
+
+    def __getitem__(self, key):
+        self._fetch([key])
+        return self._value(key)
+
+    def get_many(self, keys):
+        """
+        Returns a dictionary of the values for the given keys that are present,
+        fetching any that have not already been fetched using a single query.
+        """
+        self._fetch(keys)
+        return { k : self._value(k) for k in keys if self._raw[k] is not self._MISSING }
+
+    def _all_keys(self):
+        if self._keys is None:
+            prefetched = getattr(self.obj, '_prefetched_objects_cache', {}).get('metadata')
+            if prefetched is not None:
+                self._keys = [d.key for d in prefetched]
+            else:
+                # Only fetch the keys, not the values
+                self._keys = list(
+                    Metadatum.objects.db_manager(self.obj._state.db)
+                        .for_object(self.obj)
+                        .order_by('key')
+                        .values_list('key', flat = True)
+                )
+        return self._keys
+
+    def __iter__(self):
+        return iter(self._all_keys())
+
+    def __len__(self):
+        return len(self._all_keys())
+
+    def __repr__(self):
+        return '<LazyMetadata for {!r}>'.format(self.obj)
+
+
+class HasMetadataQuerySet(models.QuerySet):
+    """
+    Queryset for models that inherit from :py:class:`HasMetadata`.
+    """
+    def filter_metadata(self, key, value):
+        """
+        Filters the queryset to objects whose metadata ``key`` has the given
+        scalar value, using a single indexed subquery.
+        """
+        return self.filter(pk__in = Metadatum.objects.object_pks(self.model, key, value))
+
+    def with_metadata(self):
+        """
+        Loads the metadata for all the objects in the queryset using a single
+        additional query.
+        """
+        return self.prefetch_related('metadata')
 
 
 class HasMetadata(models.Model):
     """
     Abstract base model for all models that need access to attached metadata.
+
+    Models that define their own manager should base it on
+    :py:class:`HasMetadataQuerySet` to keep :py:meth:`~HasMetadataQuerySet.with_metadata`.
     """
     class Meta:
         abstract = True
 
-    metadata = GenericRelation(Metadatum, content_type_field = 'content_type',
-                                          object_id_field = 'object_id')
+    #: When ``JASMIN_METADATA_INTEGER_OBJECT_IDS`` is set, the relation joins on
+    #: the integer object id, so it requires models with integer primary keys
+    metadata = GenericRelation(
+        Metadatum,
+        content_type_field = 'content_type',
+        object_id_field = 'object_int_id' if use_integer_object_ids() else 'object_id'
+    )
+
+    objects = HasMetadataQuerySet.as_manager()
+
+    @cached_property
+    def meta(self):
+        """
+        A :py:class:`LazyMetadata` mapping of the metadata entries, which only
+        fetches and decodes the keys that are accessed, e.g. ``obj.meta['email']``
+        or ``obj.meta.get_many(['email', 'name'])``.
+
+        The mapping is discarded when the metadata is written using
+        :py:meth:`MetadatumManager.set_for_object`.
+        """
+        return LazyMetadata(self)
 
     @property
     def metadata_dict(self):
         """
         Returns the metadata entries as a dictionary.
+
+        If the metadata has been loaded using :py:func:`load_metadata` or
+        :py:meth:`HasMetadataQuerySet.with_metadata`, no query is made. Otherwise,
+        if the ``JASMIN_METADATA_CACHE`` setting is set, the dictionary is read
+        through the metadata cache - see :py:class:`~..cache.MetadataCache`.
+        """
+        cache = get_metadata_cache()
+        if cache is None or 'metadata' in getattr(self, '_prefetched_objects_cache', {}):
+            return { d.key : d.value for d in self.metadata.all() }
+        using = self._state.db or DEFAULT_DB_ALIAS
+        target = metadata_target(self, using)
+        data = cache.get(target.content_type.pk, target.object_id, using)
+        if data is None:
+            data = { d.key : d.value for d in self.metadata.all() }
+            cache.set(target.content_type.pk, target.object_id, data, using)
+        return data
+
+    async def ametadata_dict(self):
+        """
+        Async counterpart of :py:attr:`metadata_dict`.
         """
-        return { d.key : d.value for d in self.metadata.all() }
+        if not ASYNC_ORM:
+            return await sync_to_async(lambda: self.metadata_dict)()
+        if 'metadata' in getattr(self, '_prefetched_objects_cache', {}):
+            return { d.key : d.value for d in self.metadata.all() }
+        target = await ametadata_target(self)
+        cache = get_metadata_cache()
+        if cache is not None:
+            data = await cache.aget(target.content_type.pk, target.object_id)
+            if data is not None:
+                return data
+        # Query the rows directly, as the related manager resolves the content
+        # type synchronously
+        relation = self._meta.get_field('metadata')
+        queryset = Metadatum.objects.using(self._state.db).filter(**{
+            'content_type' : target.content_type,
+            relation.object_id_field_name : getattr(target, relation.object_id_field_name),
+        })
+        data = { d.key : d.value async for d in queryset }
+        if cache is not None:
+            await cache.aset(target.content_type.pk, target.object_id, data)
+        return data
 
     def copy_metadata_to(self, obj):
         """
         Finds all metadata entries associated with this object and copies them
-        onto the given object.
-        """
-        content_type = ContentType.objects.get_for_model(obj)
-        # Remove any existing metadata for the object
-        Metadatum.objects.filter(content_type = content_type, object_id = obj.pk).delete()
-        for datum in self.metadata.all():
-            Metadatum.objects.create(
-                content_type = content_type, object_id = obj.pk,
-                key = datum.key, value = datum.value
-            )
+        onto the given object, replacing any metadata it already has.
+
+        Returns a :py:class:`MetadataWriteResult`.
+        """
+        return Metadatum.objects.set_for_object(obj, self.metadata_dict)
+
+    def metadata_as_of(self, when):
+        """
+        Returns the metadata for this object as it was at the given time, as
+        recorded when the ``JASMIN_METADATA_HISTORY`` setting is enabled.
+        """
+        return MetadataRevision.objects.db_manager(self._state.db).as_of(self, when)
@@ -5,21 +5,36 @@ Base models for the JASMIN dynamic forms app.
 __author__ = "Matt Pryor"
 __copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
 
-import uuid, socket
-from collections import OrderedDict
+import functools
 from ipaddress import IPv4Address
 
 from django.conf import settings
 from django.db import models
+from django.db.models import F, prefetch_related_objects
+from django.contrib.contenttypes.models import ContentType
 from django import forms
 from django.core.exceptions import ValidationError, ImproperlyConfigured
 from django.core.validators import RegexValidator
+from django.utils.safestring import mark_safe
 
 from polymorphic.models import PolymorphicModel
 
+from asgiref.sync import sync_to_async
+
 from markdown_deux.templatetags.markdown_deux_tags import markdown_filter
 
-from ..forms import MetadataForm
+from ..forms import metadata_form_class
+from ..cache import LRUCache
+from ..dns import get_resolver
+from ..instrumentation import timer
+from ..patterns import compile_pattern, validate_pattern
+from ..schema import (
+    compile_schema, build_form_class, get_cached_schema, set_cached_schema, schema_key
+)
+
+
+#: Process-local cache of compiled form classes, keyed by :py:func:`~..schema.schema_key`
+form_class_cache = LRUCache(getattr(settings, 'JASMIN_METADATA_FORM_CACHE_SIZE', 128))
 
 
 class Form(models.Model):
@@ -30,20 +45,141 @@ class Form(models.Model):
     name = models.CharField(max_length = 200,
                             help_text = 'A name for the form, to identify '
                                         'it in listings')
+    #: Incremented whenever the form or its fields change, to invalidate
+    #: compiled form classes
+    schema_version = models.PositiveIntegerField(default = 0, editable = False)
+    #: The time that the form or its fields were last changed
+    modified = models.DateTimeField(auto_now = True, verbose_name = 'last modified')
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            return super().save(*args, **kwargs)
+        # Increment the schema version in the database rather than writing the
+        # in-memory value, which may be stale, so that a version is never reused
+        schema_version = self.schema_version
+        self.schema_version = F('schema_version') + 1
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | { 'schema_version' }
+        try:
+            super().save(*args, **kwargs)
+        except Exception:
+            self.schema_version = schema_version
+            raise
+        self.refresh_from_db(fields = ['schema_version'])
+
     def get_form(self):
         """
         Returns a :py:class:`~..forms.MetadataForm` for the configuration specified
         by this model.
+
+        Compiled form classes are cached for each schema version of the form, so
+        repeated calls return the same class until the form or its fields change.
+        If a schema cache is configured, the class is built from the shared schema
+        snapshot when there is one, without querying the fields.
         """
-        return type(
-            uuid.uuid4().hex,
-            (MetadataForm, ),
-            OrderedDict((f.name, f.get_field()) for f in self.fields.all())
+        with timer('form.get_form', queries = True):
+            if self.pk is None:
+                return self.build_form()
+            return form_class_cache.get_or_set(
+                self.schema_key(),
+                self._build_form_via_schema_cache
+            )
+
+    async def aget_form(self):
+        """
+        Async counterpart of :py:meth:`get_form`.
+
+        When the compiled form class is cached it is returned without leaving the
+        event loop, otherwise it is built in a thread.
+        """
+        if self.pk is None:
+            return await sync_to_async(self.build_form)()
+        key = self.schema_key()
+        form_class = form_class_cache.get(key)
+        if form_class is None:
+            form_class = await sync_to_async(self._build_form_via_schema_cache)()
+            form_class_cache.set(key, form_class)
+        return form_class
+
+    def _build_form_via_schema_cache(self):
+        with timer('form.build', queries = True):
+            schema = get_cached_schema(self.schema_key())
+            if schema is None:
+                schema = self.get_schema()
+                set_cached_schema(schema)
+            return build_form_class(schema)
+
+    def build_form(self):
+        """
+        Builds a new :py:class:`~..forms.MetadataForm` for the configuration
+        specified by this model, bypassing the caches.
+        """
+        return metadata_form_class(self.get_fields(), self.pk)
+
+    def schema_key(self):
+        """
+        Returns the key that identifies the current schema of this form - see
+        :py:func:`~..schema.schema_key`.
+        """
+        return schema_key(self.pk, self.schema_version, self.modified)
+
+    def get_schema(self):
+        """
+        Returns a serialisable snapshot of the schema for this form - see
+        :py:mod:`~..schema`.
+        """
+        return compile_schema(self)
+
+    def get_fields(self):
+        """
+        Returns the fields for this form as instances of their concrete subclasses,
+        with the choices for choice fields prefetched.
+
+        Unlike iterating ``self.fields.all()``, which makes one query per concrete
+        subclass plus one per choice field, this makes one query for the fields
+        (joining all the subclass tables) and one for all the choices. Calling
+        :py:meth:`Field.get_field` on the returned fields needs no further queries.
+        """
+        paths = Field.subclass_paths()
+        queryset = (
+            Field.objects
+                .non_polymorphic()
+                .filter(form = self)
+                .select_related(*(p for p in paths.values() if p))
         )
+        fields = []
+        for field in queryset:
+            model = ContentType.objects.get_for_id(field.polymorphic_ctype_id).model_class()
+            # Follow the parent links down to the concrete subclass using the
+            # instances populated by select_related
+            # We can't use the accessors for this, as polymorphic replaces them
+            # with properties that always query the database
+            for name in filter(None, paths.get(model, '').split('__')):
+                field = field._meta.get_field(name).get_cached_value(field, None)
+                if field is None:
+                    break
+            if type(field) is not model:
+                field = field.get_real_instance()
+            fields.append(field)
+        prefetch_related_objects(
+            [f for f in fields if isinstance(f, ChoiceFieldBase)],
+            'choices'
+        )
+        return fields
+
+
+def _timed_validator(name, validator):
+    """
+    Returns a validator that calls the given validator, reporting the time taken.
+    """
+    def wrapper(value):
+        with timer(name):
+            validator(value)
+    return wrapper
 
 
 class Field(PolymorphicModel):
@@ -56,6 +192,8 @@ class Field(PolymorphicModel):
 
     #: The form field class to use for fields of this type
     form_field_class = None
+    #: The model field class for the column in projection tables
+    projection_column_class = models.TextField
 
     #: The form that the field belongs to
     form = models.ForeignKey(Form, models.CASCADE,
@@ -82,6 +220,8 @@ class Field(PolymorphicModel):
         help_text = 'Help text for the field. Markdown syntax is permitted.',
         blank = True
     )
+    #: The help text rendered as HTML, populated when the field is saved
+    help_text_html = models.TextField(null = True, editable = False)
     #: Used for ordering
     position = models.PositiveIntegerField(
         default = 0,
@@ -90,6 +230,26 @@ class Field(PolymorphicModel):
                     'then alphabetically by name within that.'
     )
 
+    @classmethod
+    @functools.lru_cache(maxsize = None)
+    def subclass_paths(cls):
+        """
+        Returns a dictionary mapping each concrete subclass of this model to the
+        ``select_related`` path that reaches it from this model.
+        """
+        paths = { cls : '' }
+        def visit(model, path):
+            for subclass in model.__subclasses__():
+                if subclass._meta.abstract or subclass._meta.proxy:
+                    # Abstract and proxy models have no table of their own
+                    subclass_path = path
+                else:
+                    subclass_path = '__'.join(filter(None, [path, subclass._meta.model_name]))
+                paths[subclass] = subclass_path
+                visit(subclass, subclass_path)
+        visit(cls, '')
+        return paths
+
     def field_info(self):
         """
         Provides extra information about the field as a string for display in the admin.
@@ -99,6 +259,26 @@ class Field(PolymorphicModel):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # Render the markdown once on save rather than every time a form is built
+        self.help_text_html = self.render_help_text()
+        super().save(*args, **kwargs)
+
+    def render_help_text(self):
+        """
+        Renders the help text for the field as HTML using markdown.
+        """
+        return markdown_filter(self.help_text)
+
+    def get_help_text_html(self):
+        """
+        Returns the help text for the field rendered as HTML, only rendering
+        the markdown if the field has not been saved since it changed.
+        """
+        if self.help_text_html is None:
+            return self.render_help_text()
+        return mark_safe(self.help_text_html)
+
     def get_field(self):
         """
         Returns a Django form field configured as specified by this model.
@@ -107,7 +287,16 @@ class Field(PolymorphicModel):
             raise ImproperlyConfigured(
                 'form_field_class must be set to a subclass of django.forms.Field'
             )
-        return self.form_field_class(**self.get_field_kwargs())
+        field_type = self._meta.model_name
+        with timer('field.get_field.{}'.format(field_type)):
+            field = self.form_field_class(**self.get_field_kwargs())
+        # Time the validators for each type of field
+        # The validators are always wrapped, since the form class may be cached
+        # and used after instrumentation is enabled, and the timer does nothing
+        # while it is disabled
+        name = 'field.validate.{}'.format(field_type)
+        field.validators = [_timed_validator(name, v) for v in field.validators]
+        return field
 
     def get_field_kwargs(self):
         """
@@ -116,10 +305,26 @@ class Field(PolymorphicModel):
         return {
             'required' : self.required,
             'label' : self.label,
-            # Render the help text as markdown
-            'help_text' : markdown_filter(self.help_text),
+            'help_text' : self.get_help_text_html(),
         }
 
+    def get_projection_column(self):
+        """
+        Returns a model field for the column holding this field's values in a
+        :py:class:`~.projections.FormProjection` table.
+
+        The column is named after the field with an ``f_`` prefix, so that it can't
+        clash with the row id, content type and object id columns.
+        """
+        return self.projection_column_class(null = True, db_column = 'f_{}'.format(self.name))
+
+    def get_projection_value(self, value):
+        """
+        Converts a metadata value collected by this field for storing in a
+        :py:class:`~.projections.FormProjection` table.
+        """
+        return value
+
 
 class BooleanField(Field):
     """
@@ -129,6 +334,7 @@ class BooleanField(Field):
         verbose_name = "Boolean field"
 
     form_field_class = forms.BooleanField
+    projection_column_class = models.BooleanField
 
 
 class UserChoice(models.Model):
@@ -154,7 +360,13 @@ class ChoiceFieldBase(Field):
     """
     choices = models.ManyToManyField(UserChoice)
 
+    #: ``(value, display)`` pairs for the choices when they have been loaded from
+    #: somewhere other than the database, e.g. a schema snapshot
+    preloaded_choices = None
+
     def get_choices(self):
+        if self.preloaded_choices is not None:
+            return [tuple(c) for c in self.preloaded_choices]
         return [(c.value, c.display) for c in self.choices.all()]
 
     def get_field_kwargs(self):
@@ -186,6 +398,10 @@ class MultipleChoiceField(ChoiceFieldBase):
 
     form_field_class = forms.MultipleChoiceField
 
+    def get_projection_value(self, value):
+        # Store the selected values as a comma-separated list
+        return ','.join(value) if value is not None else None
+
     def get_field_kwargs(self):
         # Use checkboxes as the default widget for multiple-select
         return dict(
@@ -202,6 +418,7 @@ class DateField(Field):
         verbose_name = "Date field"
 
     form_field_class = forms.DateField
+    projection_column_class = models.DateField
 
     def get_field_kwargs(self):
         return dict(
@@ -218,6 +435,7 @@ class DateTimeField(Field):
         verbose_name = "Date-time field"
 
     form_field_class = forms.DateTimeField
+    projection_column_class = models.DateTimeField
 
     def get_field_kwargs(self):
         return dict(
@@ -237,6 +455,7 @@ class TimeField(Field):
         verbose_name = "Time field"
 
     form_field_class = forms.TimeField
+    projection_column_class = models.TimeField
 
     def get_field_kwargs(self):
         return dict(
@@ -253,6 +472,7 @@ class IntegerField(Field):
         verbose_name = "Integer field"
 
     form_field_class = forms.IntegerField
+    projection_column_class = models.BigIntegerField
 
     min_value = models.IntegerField(
         null = True, blank = True,
@@ -281,6 +501,7 @@ class FloatField(Field):
         verbose_name = "Float field"
 
     form_field_class = forms.FloatField
+    projection_column_class = models.FloatField
 
     min_value = models.FloatField(
         null = True, blank = True,
@@ -369,6 +590,12 @@ class IPv4Field(TextFieldBase):
 
     require_reverse_dns_lookup = models.BooleanField(default = False)
 
+    def get_field(self):
+        field = super().get_field()
+        # Mark the field so that MetadataForm can resolve the addresses in advance
+        field.reverse_dns_lookup = self.require_reverse_dns_lookup
+        return field
+
     def get_field_kwargs(self):
         return dict(
             super().get_field_kwargs(),
@@ -383,9 +610,9 @@ class IPv4Field(TextFieldBase):
                 _ = IPv4Address(value)
             except ValueError:
                 return
-            try:
-                _ = socket.gethostbyaddr(value)[0]
-            except Exception:
+            with timer('field.reverse_dns'):
+                resolved = get_resolver().resolve(value)
+            if not resolved:
                 raise ValidationError('Reverse DNS lookup failed')
 
 class RegexField(TextFieldBase):
@@ -399,7 +626,8 @@ class RegexField(TextFieldBase):
 
     regex = models.CharField(
         max_length = 250,
-        help_text = 'The Python-formatted regular expression to match'
+        help_text = 'The Python-formatted regular expression to match',
+        validators = [validate_pattern]
     )
     error_message = models.CharField(
         default = 'Not a valid value.',
@@ -408,10 +636,16 @@ class RegexField(TextFieldBase):
                     'fails the regex'
     )
 
+    def save(self, *args, **kwargs):
+        # The pattern is validated by forms, but make sure that other writes can't
+        # store a pattern that could make matching extremely slow
+        validate_pattern(self.regex)
+        super().save(*args, **kwargs)
+
     def get_field_kwargs(self):
         return dict(
             super().get_field_kwargs(),
-            regex = self.regex,
+            regex = compile_pattern(self.regex),
             error_messages = { 'invalid' : self.error_message },
         )
 
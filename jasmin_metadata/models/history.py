@@ -0,0 +1,200 @@
+"""
+Models for recording the history of metadata changes.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
+from django.db.models import Max
+from django.contrib.contenttypes.models import ContentType
+
+from ..fields import MetadataValueField
+from .targets import metadata_target
+
+
+#: The number of times to try recording revisions when concurrent writes take
+#: the same revision numbers
+RECORD_ATTEMPTS = 5
+
+
+def history_enabled():
+    """
+    Returns ``True`` if metadata changes should be recorded, as given by the
+    ``JASMIN_METADATA_HISTORY`` setting.
+    """
+    return getattr(settings, 'JASMIN_METADATA_HISTORY', False)
+
+
+def get_snapshot_interval():
+    """
+    Returns the number of revisions between full snapshots, as given by the
+    ``JASMIN_METADATA_HISTORY_SNAPSHOT_INTERVAL`` setting.
+    """
+    return max(getattr(settings, 'JASMIN_METADATA_HISTORY_SNAPSHOT_INTERVAL', 20), 1)
+
+
+class MetadataRevisionManager(models.Manager):
+    """
+    Manager for :py:class:`MetadataRevision`.
+    """
+    def for_object(self, obj):
+        """
+        Returns a queryset of the revisions for the given object.
+        """
+        target = metadata_target(obj, self.db)
+        return self.filter(content_type = target.content_type, object_id = target.object_id)
+
+    def record(self, changes, when):
+        """
+        Records a revision for each object in the given list of
+        ``(content_type, object_id, data, changed, removed)`` tuples, where ``data``
+        is the full metadata for the object after the change, or ``None`` if it
+        should be loaded when required, ``changed`` is a dictionary of the keys that
+        were added or changed and ``removed`` is a list of the keys that were removed.
+
+        Every :py:func:`get_snapshot_interval` revisions for an object, a full
+        snapshot is stored instead of a delta.
+
+        If a concurrent write takes one of the revision numbers, the numbers are
+        read again and the revisions are retried, up to :py:data:`RECORD_ATTEMPTS`
+        times. There may be no revision to lock for an object yet, so the unique
+        constraint on the number is used rather than ``select_for_update``.
+        """
+        if not changes:
+            return
+        for attempt in range(RECORD_ATTEMPTS):
+            revisions = self._build_revisions(changes, when)
+            try:
+                # Use a savepoint so that the enclosing transaction survives a clash
+                with transaction.atomic(using = self.db):
+                    self.bulk_create(revisions)
+            except IntegrityError:
+                if attempt + 1 >= RECORD_ATTEMPTS:
+                    raise
+            else:
+                return
+
+    def _latest_numbers(self, changes):
+        """
+        Returns a dictionary mapping ``(content_type_id, object_id)`` to the
+        number of the latest revision for each object with changes.
+        """
+        condition = models.Q()
+        for content_type, object_id, _, _, _ in changes:
+            condition |= models.Q(content_type = content_type, object_id = object_id)
+        return {
+            (r['content_type'], r['object_id']) : r['number']
+            for r in (
+                self.filter(condition)
+                    .order_by()
+                    .values('content_type', 'object_id')
+                    .annotate(number = Max('number'))
+            )
+        }
+
+    def _build_revisions(self, changes, when):
+        interval = get_snapshot_interval()
+        latest = self._latest_numbers(changes)
+        revisions = []
+        for content_type, object_id, data, changed, removed in changes:
+            number = latest.get((content_type.pk, object_id), -1) + 1
+            if number % interval == 0:
+                if data is None:
+                    data = self._load_metadata(content_type, object_id)
+                revisions.append(self.model(
+                    content_type = content_type, object_id = object_id,
+                    number = number, created = when, is_snapshot = True,
+                    changed = dict(data), removed = []
+                ))
+            else:
+                revisions.append(self.model(
+                    content_type = content_type, object_id = object_id,
+                    number = number, created = when, is_snapshot = False,
+                    changed = changed, removed = removed
+                ))
+        return revisions
+
+    def _load_metadata(self, content_type, object_id):
+        # Imported here as the base module imports this one
+        from .base import Metadatum
+        return dict(
+            Metadatum.objects.using(self.db)
+                .filter(content_type = content_type, object_id = object_id)
+                .values_list('key', 'value')
+        )
+
+    def as_of(self, obj, when):
+        """
+        Returns the metadata for the given object as it was at the given time.
+
+        Only the revisions since the most recent snapshot are replayed, so this
+        makes a single query fetching at most :py:func:`get_snapshot_interval` rows.
+        """
+        revisions = list(
+            self.for_object(obj)
+                .filter(created__lte = when)
+                .order_by('-number')[:get_snapshot_interval()]
+        )
+        data = {}
+        # Find the most recent snapshot, then apply the deltas after it in order
+        for start, revision in enumerate(revisions):
+            if revision.is_snapshot:
+                break
+        else:
+            # The history was pruned or the interval was changed, so fall back
+            # to replaying everything
+            revisions = list(
+                self.for_object(obj).filter(created__lte = when).order_by('-number')
+            )
+            start = len(revisions) - 1
+        for revision in reversed(revisions[:start + 1]):
+            if revision.is_snapshot:
+                data = dict(revision.changed)
+            else:
+                data.update(revision.changed)
+                for key in revision.removed:
+                    data.pop(key, None)
+        return data
+
+
+class MetadataRevision(models.Model):
+    """
+    Model recording a change to the metadata for an object.
+
+    Most revisions store only the keys that changed, with a full snapshot stored
+    periodically so that the metadata at any point in time can be rebuilt from a
+    bounded number of revisions.
+
+    Revisions are only recorded when the ``JASMIN_METADATA_HISTORY`` setting is
+    enabled, for writes made using :py:meth:`~.base.MetadatumManager.set_for_object`
+    or :py:meth:`~.base.MetadatumManager.set_for_objects`, which includes
+    :py:meth:`~..forms.MetadataForm.save`.
+    """
+    class Meta:
+        unique_together = ('content_type', 'object_id', 'number')
+        indexes = [
+            models.Index(
+                fields = ['content_type', 'object_id', 'created'],
+                name = 'jasmin_metadatarev_time_idx'
+            ),
+        ]
+
+    content_type = models.ForeignKey(ContentType, models.CASCADE)
+    object_id = models.CharField(max_length = 250)
+    #: The sequence number of the revision for the object
+    number = models.PositiveIntegerField()
+    #: The time that the change was made
+    created = models.DateTimeField()
+    #: Indicates if the revision is a full snapshot rather than a delta
+    is_snapshot = models.BooleanField(default = False)
+    #: Dictionary of the keys that were added or changed, or all the keys for a snapshot
+    changed = MetadataValueField()
+    #: List of the keys that were removed
+    removed = MetadataValueField()
+
+    objects = MetadataRevisionManager()
+
+    def __str__(self):
+        return '{} #{} ({})'.format(self.content_type, self.object_id, self.number)
@@ -0,0 +1,363 @@
+"""
+Models for flat, typed projections of the metadata collected by forms.
+
+A projection maintains a table for a form with one row per object and one typed
+column per field, so that reporting queries don't need to pivot and decode the
+key/value metadata table. The column types come from the field models - see
+:py:meth:`~.forms.Field.get_projection_column`.
+
+Projection tables are not managed by migrations. Instead, they are created by
+:py:meth:`FormProjection.rebuild` using a model built on the fly for the current
+schema of the form, which is registered in an isolated app registry.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from django.apps.registry import Apps
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import models, connections, transaction, DEFAULT_DB_ALIAS
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from ..cache import LRUCache
+from .base import Metadatum
+from .forms import Form
+from .targets import metadata_target
+
+
+def projections_enabled():
+    """
+    Returns ``True`` if metadata saved using forms should be projected, as given
+    by the ``JASMIN_METADATA_PROJECTIONS`` setting.
+    """
+    return getattr(settings, 'JASMIN_METADATA_PROJECTIONS', False)
+
+
+#: Process-local cache of projection models, keyed by form id and schema version
+projection_model_cache = LRUCache(getattr(settings, 'JASMIN_METADATA_FORM_CACHE_SIZE', 128))
+
+
+def build_projection_model(form_id, schema_version, fields):
+    """
+    Returns a new model class for the projection table of the given form with a
+    column for each of the given :py:class:`~.forms.Field` instances.
+
+    The data columns are named after the fields with an ``f_`` prefix. The row id,
+    content type and object id columns are prefixed with an underscore.
+
+    Raises ``ValueError`` if the names of two fields differ only in case, since
+    column names are case-insensitive on some databases, e.g. SQLite and MySQL.
+    """
+    meta = type('Meta', (), {
+        'app_label' : 'jasmin_metadata',
+        'db_table' : 'jasmin_metadata_projection_{}'.format(form_id),
+        # Keep the model out of the global app registry, and hence out of migrations
+        'apps' : Apps(),
+        'unique_together' : [('projected_content_type_id', 'projected_object_id')],
+    })
+    attrs = {
+        '__module__' : __name__,
+        'Meta' : meta,
+        'id' : models.BigAutoField(primary_key = True, db_column = '_pk'),
+        'projected_content_type_id' : models.IntegerField(db_column = '_content_type_id'),
+        'projected_object_id' : models.CharField(max_length = 250, db_column = '_object_id'),
+    }
+    # Field names may clash with model attributes, so use generated attribute names
+    columns = []
+    db_columns = {}
+    for i, field in enumerate(fields):
+        attname = 'column_{}'.format(i)
+        column = attrs[attname] = field.get_projection_column()
+        clash = db_columns.setdefault((column.db_column or attname).lower(), field)
+        if clash is not field:
+            raise ValueError(
+                'Fields {} and {} cannot both be projected, as their names differ '
+                'only in case'.format(clash.name, field.name)
+            )
+        columns.append((attname, field))
+    model = type('Projection{}v{}'.format(form_id, schema_version), (models.Model, ), attrs)
+    #: List of ``(attribute name, field)`` pairs for the data columns
+    model.projection_columns = columns
+    return model
+
+
+class FormProjection(models.Model):
+    """
+    Model that enables the flat table projection for a form.
+
+    In ``sync`` mode, rows are written when metadata is saved using the form. In
+    ``incremental`` mode, the objects are queued and their rows are written by
+    :py:meth:`refresh`, e.g. periodically using the ``refresh_projections``
+    management command. Saves made while the table is out of date with the form
+    are always queued, and the table must be rebuilt using :py:meth:`rebuild`, e.g.
+    using the ``rebuild_projections`` management command.
+
+    Projection only happens when the ``JASMIN_METADATA_PROJECTIONS`` setting is
+    enabled.
+    """
+    MODE_SYNC = 'sync'
+    MODE_INCREMENTAL = 'incremental'
+    MODE_CHOICES = (
+        (MODE_SYNC, 'Synchronous'),
+        (MODE_INCREMENTAL, 'Incremental'),
+    )
+
+    #: The form being projected
+    form = models.OneToOneField(Form, models.CASCADE, related_name = 'projection')
+    #: How the table is kept up to date
+    mode = models.CharField(max_length = 20, choices = MODE_CHOICES, default = MODE_SYNC)
+    #: The models whose objects are included when the table is rebuilt
+    content_types = models.ManyToManyField(
+        ContentType, blank = True,
+        help_text = 'Objects of these models with metadata for the form are '
+                    'included when the table is rebuilt, in addition to objects '
+                    'that are already projected'
+    )
+    #: The schema version of the form that the table was built for
+    schema_version = models.PositiveIntegerField(null = True, editable = False)
+    #: The time that the table was last rebuilt
+    rebuilt = models.DateTimeField(null = True, editable = False)
+    #: The time that the table was last refreshed
+    refreshed = models.DateTimeField(null = True, editable = False)
+
+    def __str__(self):
+        return 'Projection of {}'.format(self.form)
+
+    @property
+    def table_name(self):
+        return 'jasmin_metadata_projection_{}'.format(self.form_id)
+
+    @property
+    def is_current(self):
+        """
+        ``True`` if the table has been built for the current schema of the form.
+        """
+        return self.schema_version == self.form.schema_version
+
+    def get_model(self):
+        """
+        Returns the model class for the table as built, or ``None`` if it has not
+        been built.
+        """
+        if self.schema_version is None:
+            return None
+        return projection_model_cache.get_or_set(
+            (self.form_id, self.schema_version),
+            lambda: build_projection_model(
+                self.form_id, self.schema_version, self.form.get_fields()
+            )
+        )
+
+    def _write_rows(self, model, items, using):
+        """
+        Replaces the rows for the given ``(content_type_id, object_id, data)`` tuples.
+        Objects whose data is ``None`` are removed.
+        """
+        manager = model._base_manager.db_manager(using)
+        object_ids = {}
+        for content_type_id, object_id, _ in items:
+            object_ids.setdefault(content_type_id, set()).add(object_id)
+        condition = models.Q()
+        for content_type_id, ids in object_ids.items():
+            condition |= models.Q(
+                projected_content_type_id = content_type_id,
+                projected_object_id__in = ids
+            )
+        manager.filter(condition).delete()
+        rows = []
+        for content_type_id, object_id, data in items:
+            if data is None:
+                continue
+            row = model(
+                projected_content_type_id = content_type_id,
+                projected_object_id = object_id
+            )
+            for attname, field in model.projection_columns:
+                column = model._meta.get_field(attname)
+                try:
+                    value = column.to_python(field.get_projection_value(data.get(field.name)))
+                except (ValidationError, TypeError, ValueError):
+                    # Values that don't fit the column, e.g. metadata written by
+                    # other code, are left empty
+                    value = None
+                setattr(row, attname, value)
+            rows.append(row)
+        manager.bulk_create(rows)
+
+    def _read_metadata(self, condition, using):
+        """
+        Returns an iterator of ``(content_type_id, object_id, data)`` tuples with
+        the metadata for the form's fields for the objects matching ``condition``.
+        """
+        names = [field.name for _, field in self.get_model().projection_columns]
+        return (
+            Metadatum.objects.using(using)
+                .filter(condition, key__in = names)
+                .iter_grouped()
+        )
+
+    def project(self, items, using = DEFAULT_DB_ALIAS):
+        """
+        Projects the given ``(obj, data)`` pairs, either immediately or by queuing
+        the objects for :py:meth:`refresh`, depending on the mode.
+        """
+        targets = [(metadata_target(obj, using), data) for obj, data in items]
+        if self.mode == self.MODE_SYNC and self.is_current:
+            self._write_rows(
+                self.get_model(),
+                [(t.content_type.pk, t.object_id, data) for t, data in targets],
+                using
+            )
+        else:
+            ProjectionUpdate.objects.using(using).bulk_create(
+                [
+                    ProjectionUpdate(
+                        projection = self,
+                        content_type = t.content_type,
+                        object_id = t.object_id
+                    )
+                    for t, _ in targets
+                ],
+                ignore_conflicts = True
+            )
+
+    def refresh(self, batch_size = 1000, using = DEFAULT_DB_ALIAS):
+        """
+        Writes the rows for the queued objects, ``batch_size`` objects at a time,
+        rebuilding the table first if it is out of date with the form.
+
+        Returns the number of objects that were refreshed.
+        """
+        if not self.is_current:
+            self.rebuild(batch_size, using)
+            return 0
+        model = self.get_model()
+        queue = ProjectionUpdate.objects.using(using).filter(projection = self).order_by('pk')
+        refreshed = 0
+        while True:
+            batch = list(queue.values_list('pk', 'content_type_id', 'object_id')[:batch_size])
+            if not batch:
+                break
+            object_ids = {}
+            for _, content_type_id, object_id in batch:
+                object_ids.setdefault(content_type_id, set()).add(object_id)
+            condition = models.Q()
+            for content_type_id, ids in object_ids.items():
+                condition |= models.Q(content_type = content_type_id, object_id__in = ids)
+            metadata = {
+                (content_type_id, object_id) : data
+                for content_type_id, object_id, data in self._read_metadata(condition, using)
+            }
+            with transaction.atomic(using = using):
+                self._write_rows(
+                    model,
+                    [
+                        (content_type_id, object_id, metadata.get((content_type_id, object_id)))
+                        for _, content_type_id, object_id in batch
+                    ],
+                    using
+                )
+                queue.filter(pk__in = [pk for pk, _, _ in batch]).delete()
+            refreshed += len(batch)
+        self.refreshed = timezone.now()
+        self.save(update_fields = ['refreshed'])
+        return refreshed
+
+    def rebuild(self, batch_size = 1000, using = DEFAULT_DB_ALIAS):
+        """
+        Drops and recreates the table for the current schema of the form, then
+        fills it from the metadata of the objects that were already projected or
+        queued and the objects of :py:attr:`content_types`.
+
+        Returns the number of rows written.
+        """
+        connection = connections[using]
+        old_model = self.get_model()
+        # Remember the objects that are already projected before dropping the table
+        projected = {}
+        if old_model is not None and self.table_name in connection.introspection.table_names():
+            for content_type_id, object_id in (
+                old_model._base_manager.using(using)
+                    .values_list('projected_content_type_id', 'projected_object_id')
+                    .iterator()
+            ):
+                projected.setdefault(content_type_id, set()).add(object_id)
+        form = Form.objects.using(using).get(pk = self.form_id)
+        model = build_projection_model(form.pk, form.schema_version, form.get_fields())
+        # SQLite cannot alter the schema inside a transaction, so the DDL happens first
+        with connection.schema_editor() as editor:
+            if self.table_name in connection.introspection.table_names():
+                editor.delete_model(model)
+            editor.create_model(model)
+        projection_model_cache.set((form.pk, form.schema_version), model)
+        self.form = form
+        self.schema_version = form.schema_version
+        queue = ProjectionUpdate.objects.using(using).filter(projection = self)
+        # Objects saved while the table was out of date are queued, so include them
+        for content_type_id, object_id in queue.values_list('content_type_id', 'object_id'):
+            projected.setdefault(content_type_id, set()).add(object_id)
+        content_type_ids = set(self.content_types.values_list('pk', flat = True))
+        condition = models.Q(content_type__in = content_type_ids)
+        for content_type_id, ids in projected.items():
+            if content_type_id not in content_type_ids:
+                condition |= models.Q(content_type = content_type_id, object_id__in = ids)
+        written = 0
+        with transaction.atomic(using = using):
+            # The queued objects are included in the rebuild, so the queue is done
+            queue.delete()
+            batch = []
+            for item in self._read_metadata(condition, using):
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    self._write_rows(model, batch, using)
+                    written += len(batch)
+                    batch = []
+            if batch:
+                self._write_rows(model, batch, using)
+                written += len(batch)
+            self.rebuilt = self.refreshed = timezone.now()
+            self.save(update_fields = ['schema_version', 'rebuilt', 'refreshed'])
+        return written
+
+    def drop(self, using = DEFAULT_DB_ALIAS):
+        """
+        Drops the table, if it exists.
+        """
+        connection = connections[using]
+        if self.table_name in connection.introspection.table_names():
+            with connection.schema_editor() as editor:
+                editor.delete_model(build_projection_model(self.form_id, 0, []))
+        self.schema_version = None
+        self.save(update_fields = ['schema_version'])
+
+
+class ProjectionUpdate(models.Model):
+    """
+    Model for an object that is queued to have its row in a projection table
+    refreshed.
+    """
+    class Meta:
+        unique_together = ('projection', 'content_type', 'object_id')
+
+    projection = models.ForeignKey(FormProjection, models.CASCADE, related_name = 'updates')
+    content_type = models.ForeignKey(ContentType, models.CASCADE)
+    object_id = models.CharField(max_length = 250)
+
+
+def project_metadata(form_id, items, using = DEFAULT_DB_ALIAS):
+    """
+    Projects the given ``(obj, data)`` pairs, where the data was collected using
+    the form with the given id, if projections are enabled and the form has one.
+    """
+    if not projections_enabled():
+        return
+    projection = (
+        FormProjection.objects.using(using)
+            .select_related('form')
+            .filter(form_id = form_id)
+            .first()
+    )
+    if projection is not None:
+        projection.project(items, using)
@@ -0,0 +1,132 @@
+"""
+Module for resolving the objects that metadata is attached to.
+
+All the metadata read and write paths identify objects using
+:py:func:`metadata_target`, so that content types are resolved once per model
+class and object ids are normalised in one place.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
+
+from asgiref.sync import sync_to_async
+
+
+def use_integer_object_ids():
+    """
+    Returns ``True`` if metadata lookups should use the integer object id column,
+    as given by the ``JASMIN_METADATA_INTEGER_OBJECT_IDS`` setting.
+    """
+    return getattr(settings, 'JASMIN_METADATA_INTEGER_OBJECT_IDS', False)
+
+
+#: Content types resolved by get_content_type, keyed by model class and database
+_content_types = {}
+
+
+def get_content_type(model, using = DEFAULT_DB_ALIAS):
+    """
+    Returns the content type for the given model class, resolved once
+    per concrete model and database.
+    """
+    try:
+        return _content_types[(model, using)]
+    except KeyError:
+        content_type = ContentType.objects.db_manager(using).get_for_model(model)
+        _content_types[(model, using)] = content_type
+        return content_type
+
+
+async def aget_content_type(model, using = DEFAULT_DB_ALIAS):
+    """
+    Async counterpart of :py:func:`get_content_type`, which only leaves the event
+    loop the first time the content type for a model is resolved.
+    """
+    try:
+        return _content_types[(model, using)]
+    except KeyError:
+        return await sync_to_async(get_content_type)(model, using)
+
+
+@receiver(post_migrate)
+def reset_content_types(**kwargs):
+    """
+    Discards the resolved content types when the database is migrated, since
+    content types may have been created or removed.
+    """
+    _content_types.clear()
+
+
+def normalise_object_id(pk):
+    """
+    Returns a tuple of ``(object_id, object_int_id)`` for the given primary key,
+    where ``object_int_id`` is ``None`` unless the primary key is an integer.
+    """
+    if isinstance(pk, int) and not isinstance(pk, bool):
+        return str(pk), parse_object_int_id(pk)
+    return str(pk), None
+
+
+#: The range of values that fit in the integer object id column
+OBJECT_INT_ID_RANGE = (-2 ** 63, 2 ** 63 - 1)
+
+
+def parse_object_int_id(object_id):
+    """
+    Returns the integer for the given object id if it is the canonical
+    representation of an integer that fits in the integer object id column,
+    otherwise ``None``.
+
+    The object id may be given as a string, as stored, or as the primary key
+    itself, e.g. when a :py:class:`~.base.Metadatum` is created directly.
+    """
+    if object_id is None:
+        return None
+    object_id = str(object_id)
+    try:
+        value = int(object_id)
+    except ValueError:
+        return None
+    if str(value) != object_id:
+        return None
+    minimum, maximum = OBJECT_INT_ID_RANGE
+    return value if minimum <= value <= maximum else None
+
+
+#: The content type and normalised ids of an object that metadata is attached to
+class MetadataTarget(namedtuple('MetadataTarget', ('content_type', 'object_id', 'object_int_id'))):
+    __slots__ = ()
+
+    def lookup(self):
+        """
+        Returns the keyword arguments to filter :py:class:`~.base.Metadatum` rows
+        for the object, using the integer object id column if enabled.
+        """
+        if self.object_int_id is not None and use_integer_object_ids():
+            return { 'content_type' : self.content_type, 'object_int_id' : self.object_int_id }
+        return { 'content_type' : self.content_type, 'object_id' : self.object_id }
+
+
+def metadata_target(obj, using = None):
+    """
+    Returns the :py:class:`MetadataTarget` for the given model instance.
+    """
+    using = using or obj._state.db or DEFAULT_DB_ALIAS
+    return MetadataTarget(get_content_type(type(obj), using), *normalise_object_id(obj.pk))
+
+
+async def ametadata_target(obj, using = None):
+    """
+    Async counterpart of :py:func:`metadata_target`.
+    """
+    using = using or obj._state.db or DEFAULT_DB_ALIAS
+    content_type = await aget_content_type(type(obj), using)
+    return MetadataTarget(content_type, *normalise_object_id(obj.pk))
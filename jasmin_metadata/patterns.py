@@ -0,0 +1,220 @@
+"""
+Module containing utilities for the regular expressions entered for regex fields.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import re, functools
+
+try:
+    from re import _parser as sre_parse, _compiler as sre_compile, _constants as sre_constants
+except ImportError:
+    # Python < 3.11
+    import sre_parse, sre_compile, sre_constants
+
+from django.core.exceptions import ValidationError
+
+
+_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+#: Nodes that match a single character
+_CHARACTERS = (
+    sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY, sre_constants.IN
+)
+#: Nodes that match without consuming any characters
+_ZERO_WIDTH = (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT)
+#: Nodes that never backtrack into their contents, which only exist in Python 3.11+
+_ATOMIC_GROUP = getattr(sre_constants, 'ATOMIC_GROUP', None)
+_POSSESSIVE_REPEAT = getattr(sre_constants, 'POSSESSIVE_REPEAT', None)
+#: Node used for constructs that could match any character, e.g. backreferences
+_ANY = (sre_constants.ANY, None)
+
+#: Characters that are tried when checking if two character nodes overlap, in
+#: addition to the literals and range bounds that appear in the nodes
+_CANDIDATES = frozenset(chr(i) for i in range(0x180))
+
+
+def _subpatterns(op, av):
+    """
+    Returns the subpatterns of the given parsed regex node that can backtrack.
+    """
+    if op in _REPEATS:
+        return [av[2]]
+    if op is sre_constants.SUBPATTERN:
+        return [av[3]]
+    if op is sre_constants.BRANCH:
+        return av[1]
+    if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+        return [av[1]]
+    if op is sre_constants.GROUPREF_EXISTS:
+        return [p for p in av[1:] if p is not None]
+    # Atomic groups and possessive repeats never backtrack into their contents
+    return []
+
+
+def _first(seq):
+    """
+    Returns a tuple of ``(nodes, nullable)`` for the given parsed sequence, where
+    ``nodes`` are the character nodes that can match its first character and
+    ``nullable`` indicates if it can match the empty string.
+    """
+    nodes = []
+    for op, av in seq:
+        if op in _CHARACTERS:
+            return nodes + [(op, av)], False
+        if op in _ZERO_WIDTH:
+            continue
+        if op is sre_constants.SUBPATTERN:
+            first, nullable = _first(av[3])
+        elif op in _REPEATS or op is _POSSESSIVE_REPEAT:
+            first, nullable = _first(av[2])
+            nullable = nullable or av[0] == 0
+        elif op is _ATOMIC_GROUP:
+            first, nullable = _first(av)
+        elif op is sre_constants.BRANCH:
+            first, nullable = _first_of_alternatives(av[1])
+        elif op is sre_constants.GROUPREF_EXISTS:
+            first, nullable = _first_of_alternatives([av[1], av[2] or []])
+        else:
+            # Backreferences could match anything, including nothing
+            first, nullable = [_ANY], True
+        nodes.extend(first)
+        if not nullable:
+            return nodes, False
+    return nodes, True
+
+
+def _first_of_alternatives(alternatives):
+    nodes, nullable = [], False
+    for alternative in alternatives:
+        first, alternative_nullable = _first(alternative)
+        nodes.extend(first)
+        nullable = nullable or alternative_nullable
+    return nodes, nullable
+
+
+def _node_matcher(node, state):
+    """
+    Returns a compiled regex that matches a single character as the given node does.
+    """
+    return sre_compile.compile(sre_parse.SubPattern(state, [node]))
+
+
+def _node_candidates(node):
+    op, av = node
+    if op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL):
+        return { chr(av) }
+    if op is sre_constants.IN:
+        candidates = set()
+        for item_op, item_av in av:
+            if item_op is sre_constants.LITERAL:
+                candidates.add(chr(item_av))
+            elif item_op is sre_constants.RANGE:
+                candidates.update(chr(c) for c in item_av)
+        return candidates
+    return set()
+
+
+def _overlaps(nodes, other_nodes, state):
+    """
+    Returns ``True`` if any character can be matched by both one of ``nodes``
+    and one of ``other_nodes``.
+    """
+    for node in nodes:
+        for other in other_nodes:
+            matcher, other_matcher = _node_matcher(node, state), _node_matcher(other, state)
+            candidates = _CANDIDATES | _node_candidates(node) | _node_candidates(other)
+            if any(matcher.fullmatch(c) and other_matcher.fullmatch(c) for c in candidates):
+                return True
+    return False
+
+
+def _is_ambiguous(seq, follow, state):
+    """
+    Returns ``True`` if the given parsed sequence, which can be followed by the
+    character nodes in ``follow``, contains a choice - to repeat again, to take
+    an optional part or between alternatives - that can't be made by looking at
+    the next character, i.e. the same text could be matched in more than one way.
+    """
+    for i, (op, av) in enumerate(seq):
+        rest, rest_nullable = _first(seq[i + 1:])
+        item_follow = rest + follow if rest_nullable else rest
+        if op in _REPEATS:
+            first, _ = _first(av[2])
+            if av[0] != av[1] and _overlaps(first, item_follow, state):
+                return True
+            # Within the body, the next iteration can follow as well
+            body_follow = item_follow + first if av[1] > 1 else item_follow
+            if _is_ambiguous(av[2], body_follow, state):
+                return True
+        elif op is sre_constants.SUBPATTERN:
+            if _is_ambiguous(av[3], item_follow, state):
+                return True
+        elif op in (sre_constants.BRANCH, sre_constants.GROUPREF_EXISTS):
+            if op is sre_constants.BRANCH:
+                alternatives = av[1]
+            else:
+                alternatives = [av[1], av[2] or []]
+            firsts = [_first(alternative) for alternative in alternatives]
+            for j, (first, _) in enumerate(firsts):
+                if any(_overlaps(first, other, state) for other, _ in firsts[j + 1:]):
+                    return True
+            if any(nullable for _, nullable in firsts):
+                if _overlaps([n for first, _ in firsts for n in first], item_follow, state):
+                    return True
+            if any(_is_ambiguous(alternative, item_follow, state) for alternative in alternatives):
+                return True
+    return False
+
+
+def _contains_ambiguous_repeat(parsed, state):
+    """
+    Returns ``True`` if the given parsed sequence contains a repeat of more than
+    one iteration, bounded or not, whose body can match the same text in more
+    than one way, e.g. ``(a+)+``, ``(\\w*,?)*``, ``(a|aa)+`` or ``(.*a){20}``.
+
+    Repeats whose body starts with something that the parts of the body that
+    repeat can't match, e.g. ``(\\.\\d+)*``, are unambiguous.
+    """
+    for op, av in parsed:
+        # The number of ways to match grows exponentially with the number of
+        # iterations, so bounded repeats are just as dangerous as unbounded ones
+        if op in _REPEATS and av[1] > 1:
+            # The body of the repeat can be followed by another iteration
+            first, _ = _first(av[2])
+            if _is_ambiguous(av[2], first, state):
+                return True
+        if any(_contains_ambiguous_repeat(p, state) for p in _subpatterns(op, av)):
+            return True
+    return False
+
+
+@functools.lru_cache(maxsize = 256)
+def compile_pattern(pattern):
+    """
+    Returns the compiled regex for the given pattern, caching the result.
+    """
+    return re.compile(pattern)
+
+
+def validate_pattern(pattern):
+    """
+    Validator that checks that the given string is a valid Python regular
+    expression that is not prone to catastrophic backtracking.
+
+    Python's regex engine cannot time out a match, so patterns containing a
+    repeat whose body can match the same text in more than one way, e.g.
+    ``(a+)+``, ``(\\w*,?)*``, ``(a|aa)+`` or ``(.*a){20}``, are rejected as they
+    can take exponential time to fail on crafted input. Repeats that are unambiguous, e.g.
+    ``\\d+(\\.\\d+)*``, are allowed. Use a possessive quantifier or atomic group
+    (Python 3.11+) where an ambiguous repeat is really needed.
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error as exc:
+        raise ValidationError('Not a valid regular expression: {}'.format(exc))
+    if _contains_ambiguous_repeat(parsed, parsed.state):
+        raise ValidationError(
+            'Repeats that can match the same text in more than one way, such as '
+            '(a+)+ or (a|aa)+, are not allowed, as they can make matching extremely slow'
+        )
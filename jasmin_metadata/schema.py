@@ -0,0 +1,231 @@
+"""
+Module containing serialisable snapshots of the schema of metadata forms.
+
+A snapshot is a plain-data description of a :py:class:`~.models.Form` and its
+fields, including their choices and pre-rendered help text, that can be stored in
+a cache backend or a file and used to rebuild the form class without any database
+queries.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import json, warnings
+from collections import namedtuple
+from types import MappingProxyType
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+
+from .forms import metadata_form_class
+
+
+def schema_key(form_id, schema_version, modified):
+    """
+    Returns the key that identifies a schema of a form, given its id, schema version
+    and modified time.
+
+    The schema version alone is not enough, since the same version of the same form
+    id may have a different schema in another database, e.g. one restored from a
+    backup, or after the transaction that incremented it was rolled back. The
+    modified time is updated whenever the schema version is incremented, so a
+    snapshot is only used for the form that it was compiled from.
+    """
+    if not isinstance(modified, str):
+        modified = modified.isoformat()
+    return (form_id, schema_version, modified)
+
+
+#: The version of the snapshot format, which is changed whenever the format or
+#: the meaning of the stored attributes changes
+SNAPSHOT_FORMAT = 2
+
+#: Snapshot of the schema of a form
+#: ``modified`` is the modified time of the form in ISO format which, along with
+#: the form id and schema version, identifies the schema - see :py:func:`schema_key`
+FormSchema = namedtuple('FormSchema', ('format', 'form_id', 'schema_version', 'modified', 'name', 'fields'))
+
+#: Snapshot of a field in a form schema
+#: ``model`` is the label of the field model, ``attributes`` the values of its
+#: database fields and ``choices`` the ``(value, display)`` pairs for choice fields
+FieldSchema = namedtuple('FieldSchema', ('model', 'attributes', 'choices'))
+
+
+def compile_schema(form):
+    """
+    Compiles a snapshot of the schema of the given :py:class:`~.models.Form`.
+    """
+    fields = []
+    for field in form.get_fields():
+        attributes = {
+            f.attname : getattr(field, f.attname)
+            for f in field._meta.concrete_fields
+            if f.name != 'polymorphic_ctype'
+        }
+        # Make sure the snapshot includes the rendered help text
+        attributes['help_text_html'] = str(field.get_help_text_html())
+        choices = None
+        if hasattr(field, 'preloaded_choices'):
+            # The choices are prefetched by get_fields
+            choices = tuple((c.value, c.display) for c in field.choices.all())
+        fields.append(FieldSchema(field._meta.label_lower, MappingProxyType(attributes), choices))
+    return FormSchema(
+        SNAPSHOT_FORMAT,
+        form.pk,
+        form.schema_version,
+        form.modified.isoformat(),
+        form.name,
+        tuple(fields)
+    )
+
+
+def build_form_class(schema):
+    """
+    Builds a :py:class:`~.forms.MetadataForm` class from the given schema snapshot
+    without making any database queries.
+    """
+    fields = []
+    for field_schema in schema.fields:
+        field = apps.get_model(field_schema.model)(**field_schema.attributes)
+        if field_schema.choices is not None:
+            field.preloaded_choices = field_schema.choices
+        fields.append(field)
+    return metadata_form_class(fields, schema.form_id)
+
+
+def schema_to_dict(schema):
+    """
+    Converts the given schema snapshot to a JSON-serialisable dictionary.
+    """
+    return dict(
+        schema._asdict(),
+        fields = [
+            dict(
+                f._asdict(),
+                attributes = dict(f.attributes),
+                choices = None if f.choices is None else [list(c) for c in f.choices]
+            )
+            for f in schema.fields
+        ]
+    )
+
+
+def schema_from_dict(data):
+    """
+    Reverses :py:func:`schema_to_dict`, returning ``None`` if the data uses a
+    different snapshot format.
+    """
+    if data.get('format') != SNAPSHOT_FORMAT:
+        return None
+    return FormSchema(**dict(
+        data,
+        fields = tuple(
+            FieldSchema(
+                f['model'],
+                MappingProxyType(f['attributes']),
+                None if f['choices'] is None else tuple(tuple(c) for c in f['choices'])
+            )
+            for f in data['fields']
+        )
+    ))
+
+
+def dump_schemas(schemas, fp):
+    """
+    Writes the given schema snapshots to a file as JSON.
+    """
+    json.dump([schema_to_dict(s) for s in schemas], fp, indent = 2)
+
+
+def load_schemas(fp):
+    """
+    Reads schema snapshots written by :py:func:`dump_schemas` from a file,
+    ignoring any that use a different snapshot format.
+    """
+    schemas = (schema_from_dict(data) for data in json.load(fp))
+    return [s for s in schemas if s is not None]
+
+
+def get_schema_cache():
+    """
+    Returns the cache backend used to share schema snapshots between processes,
+    as given by the ``JASMIN_METADATA_SCHEMA_CACHE`` setting, or ``None`` if
+    snapshots are not shared.
+    """
+    alias = getattr(settings, 'JASMIN_METADATA_SCHEMA_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def get_schema_cache_timeout():
+    """
+    Returns the time to keep schema snapshots in the schema cache for in seconds, as
+    given by the ``JASMIN_METADATA_SCHEMA_CACHE_TIMEOUT`` setting (default one day).
+    """
+    return getattr(settings, 'JASMIN_METADATA_SCHEMA_CACHE_TIMEOUT', 86400)
+
+
+def schema_cache_key(key):
+    return 'jasmin_metadata:form_schema:{}:{}:{}:{}'.format(SNAPSHOT_FORMAT, *key)
+
+
+def get_cached_schema(key):
+    """
+    Returns the schema snapshot with the given :py:func:`schema_key` from the
+    schema cache, or ``None`` if it is not present.
+    """
+    cache = get_schema_cache()
+    if cache is None:
+        return None
+    data = cache.get(schema_cache_key(key))
+    return schema_from_dict(data) if data else None
+
+
+def set_cached_schema(schema):
+    """
+    Stores the given schema snapshot in the schema cache, if configured.
+    """
+    cache = get_schema_cache()
+    if cache is not None:
+        # Snapshots are immutable for a given key, but once the form changes they
+        # are never used again, so let them expire
+        cache.set(
+            schema_cache_key(schema_key(schema.form_id, schema.schema_version, schema.modified)),
+            schema_to_dict(schema),
+            get_schema_cache_timeout()
+        )
+
+
+def warm_form_cache(schemas):
+    """
+    Populates the process-local compiled form cache from the given schema snapshots.
+
+    The form classes are keyed by :py:func:`schema_key`, so a snapshot that does
+    not match the form as loaded from the database, e.g. one from a different
+    environment, is never used.
+    """
+    from .models.forms import form_class_cache
+    for schema in schemas:
+        form_class_cache.set(
+            schema_key(schema.form_id, schema.schema_version, schema.modified),
+            build_form_class(schema)
+        )
+
+
+def warm_form_cache_from_file(path):
+    """
+    Populates the process-local compiled form cache from the schema snapshots in
+    the given file, warning instead if the file does not exist, e.g. because
+    ``dump_form_schemas`` has not been run yet.
+    """
+    try:
+        fp = open(path)
+    except FileNotFoundError:
+        warnings.warn(
+            'Schema snapshot file {} does not exist - run dump_form_schemas '
+            'to create it'.format(path),
+            RuntimeWarning
+        )
+        return
+    with fp:
+        warm_form_cache(load_schemas(fp))
@@ -0,0 +1,95 @@
+"""
+Signal handlers for the JASMIN metadata app.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .cache import get_metadata_cache
+from .models import Form, Field, UserChoice, ChoiceFieldBase, Metadatum
+
+
+def bump_schema_version(**filters):
+    """
+    Increments the schema version of the forms matching the given filters, which
+    invalidates any compiled form classes for them, and updates their modified time.
+    """
+    Form.objects.filter(**filters).update(
+        schema_version = F('schema_version') + 1,
+        modified = timezone.now()
+    )
+
+
+def refresh_schema_version(field):
+    """
+    Updates the schema version and modified time of the form instance cached on
+    the given field, if there is one, so that e.g. ``form.fields.create(...)``
+    followed by ``form.get_form()`` returns the new form class.
+    """
+    form = field._meta.get_field('form').get_cached_value(field, None)
+    if form is not None and form.pk is not None:
+        values = (
+            Form.objects.filter(pk = form.pk)
+                .values_list('schema_version', 'modified')
+                .first()
+        )
+        if values is not None:
+            form.schema_version, form.modified = values
+
+
+# Form.save increments the schema version itself, so there is no handler for it
+@receiver(post_save)
+@receiver(post_delete)
+def field_changed(sender, instance, **kwargs):
+    # Field is polymorphic, so the signals are sent with the concrete subclass
+    if isinstance(instance, Field):
+        bump_schema_version(pk = instance.form_id)
+        refresh_schema_version(instance)
+
+
+@receiver(post_save, sender = UserChoice)
+# Use pre_delete so that the fields using the choice can still be found
+@receiver(pre_delete, sender = UserChoice)
+def user_choice_changed(sender, instance, **kwargs):
+    bump_schema_version(field__choicefieldbase__choices = instance)
+
+
+@receiver(m2m_changed, sender = ChoiceFieldBase.choices.through)
+def choices_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        # The instance is a UserChoice
+        if action == 'post_clear':
+            # The pk_set is not available for clear, so just bump every form with choices
+            bump_schema_version(field__choicefieldbase__isnull = False)
+        elif pk_set:
+            bump_schema_version(field__pk__in = pk_set)
+    else:
+        bump_schema_version(pk = instance.form_id)
+        refresh_schema_version(instance)
+
+
+def metadatum_changed(sender, instance, using, **kwargs):
+    cache = get_metadata_cache()
+    if cache is not None:
+        cache.invalidate([(instance.content_type_id, instance.object_id)], using)
+
+
+def connect_metadata_cache_signals():
+    """
+    Connects the signal handlers that invalidate the metadata cache when individual
+    :py:class:`~.models.Metadatum` rows are saved or deleted.
+
+    These are only connected when the cache is enabled, since listening for
+    ``post_delete`` prevents Django from deleting metadata without fetching it.
+    Writes made using ``Metadatum.objects.set_for_object(s)`` invalidate the
+    cache directly.
+    """
+    post_save.connect(metadatum_changed, sender = Metadatum)
+    post_delete.connect(metadatum_changed, sender = Metadatum)
@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+"""
+Runs the tests for the JASMIN metadata app.
+"""
+
+import os, sys
+
+import django
+from django.conf import settings
+from django.test.utils import get_runner
+
+
+if __name__ == "__main__":
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+    django.setup()
+    runner = get_runner(settings)()
+    failures = runner.run_tests(sys.argv[1:] or ['tests'])
+    sys.exit(bool(failures))
@@ -45,7 +45,7 @@ if __name__ == "__main__":
         author_email = 'matt.pryor@stfc.ac.uk',
         url = 'http://www.jasmin.ac.uk',
         keywords = 'web django jasmin metadata',
-        packages = find_packages(),
+        packages = find_packages(exclude = ['tests', 'tests.*']),
         include_package_data = True,
         zip_safe = False,
         install_requires = requires,
@@ -0,0 +1,10 @@
+"""
+Tests for the JASMIN metadata app.
+
+Run them from the root of the repository using::
+
+    python runtests.py
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
@@ -0,0 +1,19 @@
+"""
+Admin configuration used by the tests for the JASMIN metadata app.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from django.contrib import admin
+
+from jasmin_metadata.admin import HasMetadataModelAdmin
+from jasmin_metadata.models import Form
+
+from .models import Thing
+
+
+@admin.register(Thing)
+class ThingAdmin(HasMetadataModelAdmin):
+    def get_metadata_form_class(self, request, obj):
+        return Form.objects.get(name = 'thing').get_form()
@@ -0,0 +1,17 @@
+"""
+Models used by the tests for the JASMIN metadata app.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from django.db import models
+
+from jasmin_metadata.models import HasMetadata
+
+
+class Thing(HasMetadata):
+    """
+    Model that can have metadata attached.
+    """
+    name = models.CharField(max_length = 100)
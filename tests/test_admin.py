@@ -0,0 +1,93 @@
+"""
+Tests for the admin integration of the JASMIN metadata app.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.test import TestCase
+
+from jasmin_metadata.models import Form, Metadatum, SingleLineTextField
+
+from .admin import ThingAdmin
+from .models import Thing
+
+
+class HasMetadataModelAdminTestCase(TestCase):
+    """
+    Tests for :py:class:`~jasmin_metadata.admin.HasMetadataModelAdmin`.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password'
+        )
+        form = Form.objects.create(name = 'thing')
+        for i in range(5):
+            SingleLineTextField.objects.create(
+                form = form, name = 'field_{}'.format(i), label = 'Field {}'.format(i)
+            )
+        cls.thing = Thing.objects.create(name = 'thing')
+        Metadatum.objects.set_for_object(
+            cls.thing, { 'field_{}'.format(i) : 'old' for i in range(5) }
+        )
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.url = '/admin/tests/thing/{}/change/'.format(self.thing.pk)
+        ContentType.objects.clear_cache()
+        # Compile and cache the form class and content types, so that the counts
+        # below are for the steady state
+        self.client.get(self.url)
+
+    def post_data(self, **metadata):
+        data = { 'name' : 'thing', '_has_metadata' : '1' }
+        data.update(('metadata-field_{}'.format(i), 'old') for i in range(5))
+        data.update(('metadata-{}'.format(k), v) for k, v in metadata.items())
+        return data
+
+    # The counts include the session and user queries and, as the test case runs
+    # in a transaction, the savepoint queries for the change view's transaction
+
+    def test_change_view_get(self):
+        with self.assertNumQueries(7):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_change_view_post_valid(self):
+        with self.assertNumQueries(15):
+            response = self.client.post(self.url, self.post_data(field_0 = 'new'))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            Thing.objects.get(pk = self.thing.pk).metadata_dict,
+            dict({ 'field_{}'.format(i) : 'old' for i in range(5) }, field_0 = 'new')
+        )
+
+    def test_change_view_post_invalid(self):
+        with self.assertNumQueries(7):
+            response = self.client.post(self.url, self.post_data(field_0 = ''))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'This field is required')
+        self.assertEqual(Thing.objects.get(pk = self.thing.pk).metadata_dict['field_0'], 'old')
+
+    def test_change_view_post_prefilled(self):
+        # Values prefilled by get_metadata_form_initial_data are not stored, so
+        # they must be written even if they are left unchanged
+        thing = Thing.objects.create(name = 'new thing')
+        prefilled = { 'field_{}'.format(i) : 'old' for i in range(5) }
+        with mock.patch.object(
+            ThingAdmin, 'get_metadata_form_initial_data', return_value = prefilled
+        ):
+            response = self.client.post(
+                '/admin/tests/thing/{}/change/'.format(thing.pk),
+                self.post_data(field_0 = 'new')
+            )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            Thing.objects.get(pk = thing.pk).metadata_dict,
+            dict(prefilled, field_0 = 'new')
+        )
@@ -0,0 +1,140 @@
+"""
+Tests for the async counterparts of the metadata reads, form building and saves.
+
+These run against both the async ORM (Django 4.1+) and the thread fallbacks.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from jasmin_metadata.cache import get_metadata_cache
+from jasmin_metadata.dns import get_resolver
+from jasmin_metadata.models import (
+    Form, IPv4Field, Metadatum, MetadataWriteResult, SingleLineTextField,
+    aload_metadata
+)
+
+from .models import Thing
+
+
+class MetadataReadTestCase(TestCase):
+    """
+    Tests for :py:meth:`~jasmin_metadata.models.HasMetadata.ametadata_dict` and
+    :py:func:`~jasmin_metadata.models.aload_metadata`.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.things = [Thing.objects.create(name = 'thing {}'.format(i)) for i in range(3)]
+        for i, thing in enumerate(cls.things[:2]):
+            Metadatum.objects.set_for_object(thing, { 'index' : i, 'name' : thing.name })
+
+    async def test_ametadata_dict(self):
+        self.assertEqual(
+            await self.things[0].ametadata_dict(),
+            { 'index' : 0, 'name' : 'thing 0' }
+        )
+        self.assertEqual(await self.things[2].ametadata_dict(), {})
+
+    async def test_aload_metadata(self):
+        things = [Thing(pk = thing.pk, name = thing.name) for thing in self.things]
+        await aload_metadata(things)
+        for thing in things:
+            self.assertIn('metadata', thing._prefetched_objects_cache)
+        self.assertEqual(
+            [await thing.ametadata_dict() for thing in things],
+            [{ 'index' : 0, 'name' : 'thing 0' }, { 'index' : 1, 'name' : 'thing 1' }, {}]
+        )
+
+
+class UncachedContentTypeTestCase(TransactionTestCase):
+    """
+    Tests for the async reads when Django has not resolved the content type of the
+    model yet, which must not query the database from the event loop.
+    """
+    def setUp(self):
+        self.thing = Thing.objects.create(name = 'thing')
+        Metadatum.objects.set_for_object(self.thing, { 'name' : 'thing' })
+        ContentType.objects.clear_cache()
+
+    async def test_ametadata_dict(self):
+        self.assertEqual(await self.thing.ametadata_dict(), { 'name' : 'thing' })
+
+    async def test_aload_metadata(self):
+        await aload_metadata([self.thing])
+        self.assertEqual(await self.thing.ametadata_dict(), { 'name' : 'thing' })
+
+
+@override_settings(JASMIN_METADATA_CACHE = 'default')
+class CachedMetadataReadTestCase(TransactionTestCase):
+    """
+    Tests for :py:meth:`~jasmin_metadata.models.HasMetadata.ametadata_dict` when the
+    metadata cache is enabled.
+
+    These run outside a test transaction, as entries are only cached on commit.
+    """
+    def setUp(self):
+        caches['default'].clear()
+        self.thing = Thing.objects.create(name = 'thing')
+        Metadatum.objects.set_for_object(self.thing, { 'name' : 'thing' })
+
+    async def test_ametadata_dict(self):
+        cache = get_metadata_cache()
+        self.assertEqual(await self.thing.ametadata_dict(), { 'name' : 'thing' })
+        self.assertEqual(cache.hits, 0)
+        self.assertEqual(await self.thing.ametadata_dict(), { 'name' : 'thing' })
+        self.assertEqual(cache.hits, 1)
+
+
+@override_settings(
+    JASMIN_METADATA_DNS_RESOLVER = 'jasmin_metadata.dns.StaticResolver',
+    JASMIN_METADATA_DNS_OPTIONS = { 'hosts' : { '192.0.2.1' : 'host.example.com' } }
+)
+class MetadataFormTestCase(TestCase):
+    """
+    Tests for :py:meth:`~jasmin_metadata.models.Form.aget_form` and the async
+    methods of :py:class:`~jasmin_metadata.forms.MetadataForm`.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.form = Form.objects.create(name = 'async')
+        SingleLineTextField.objects.create(
+            form = cls.form, name = 'name', label = 'Name', position = 0
+        )
+        IPv4Field.objects.create(
+            form = cls.form, name = 'address', label = 'Address', position = 1,
+            require_reverse_dns_lookup = True
+        )
+        cls.thing = Thing.objects.create(name = 'thing')
+
+    async def test_aget_form(self):
+        form_class = await self.form.aget_form()
+        self.assertEqual(list(form_class.base_fields), ['name', 'address'])
+        self.assertIs(await self.form.aget_form(), form_class)
+
+    async def test_ais_valid(self):
+        form_class = await self.form.aget_form()
+        form = form_class(data = { 'name' : 'thing', 'address' : '192.0.2.1' })
+        self.assertTrue(await form.ais_valid())
+        # The address was resolved before cleaning, so the validator used the cache
+        self.assertEqual(get_resolver().stats()['lookups'], 1)
+        self.assertGreaterEqual(get_resolver().stats()['cache_hits'], 1)
+
+    async def test_ais_valid_lookup_fails(self):
+        form_class = await self.form.aget_form()
+        form = form_class(data = { 'name' : 'thing', 'address' : '192.0.2.2' })
+        self.assertFalse(await form.ais_valid())
+        self.assertEqual(form.errors['address'], ['Reverse DNS lookup failed'])
+
+    async def test_asave(self):
+        form_class = await self.form.aget_form()
+        form = form_class(data = { 'name' : 'thing', 'address' : '192.0.2.1' })
+        self.assertTrue(await form.ais_valid())
+        self.assertEqual(await form.asave(self.thing), MetadataWriteResult(2, 0, 0))
+        self.assertEqual(
+            await self.thing.ametadata_dict(),
+            { 'name' : 'thing', 'address' : '192.0.2.1' }
+        )
@@ -0,0 +1,45 @@
+"""
+Tests for the benchmarks for the JASMIN metadata app.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from django.core.cache import caches
+from django.test import TransactionTestCase, override_settings
+
+from jasmin_metadata.benchmarks import BENCHMARKS, Runner
+from jasmin_metadata.models import Form, Metadatum
+
+from .models import Thing
+
+
+@override_settings(JASMIN_METADATA_CACHE = 'default')
+class BenchmarksTestCase(TransactionTestCase):
+    """
+    Tests that the benchmarks run and leave nothing behind.
+
+    These run outside a test transaction, so that the benchmark transactions
+    are really rolled back.
+    """
+    def setUp(self):
+        caches['default'].clear()
+        self.runner = Runner(allocations = False)
+
+    def run_benchmark(self, name, size):
+        func, _ = BENCHMARKS[name]
+        return func(self.runner, size)
+
+    def test_metadata_write(self):
+        results = self.run_benchmark('metadata_write', 15)
+        self.assertEqual(list(results), ['insert', 'update', 'unchanged'])
+        self.assertFalse(Form.objects.exists())
+        self.assertFalse(Metadatum.objects.exists())
+
+    def test_no_phantom_metadata(self):
+        for name in ['copy_metadata', 'metadata_dict', 'value_storage']:
+            self.assertNotIn('skipped', self.run_benchmark(name, 3))
+        self.assertFalse(Metadatum.objects.exists())
+        # The next objects get the ids that the benchmarks attached metadata to
+        for _ in range(3):
+            self.assertEqual(Thing.objects.create(name = 'thing').metadata_dict, {})
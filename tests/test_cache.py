@@ -0,0 +1,83 @@
+"""
+Tests for the metadata cache.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.db import transaction
+from django.test import TransactionTestCase, override_settings
+
+from jasmin_metadata.cache import get_metadata_cache
+from jasmin_metadata.models import Metadatum
+
+from .models import Thing
+
+
+class Rollback(Exception):
+    pass
+
+
+@override_settings(JASMIN_METADATA_CACHE = 'default')
+class MetadataCacheTestCase(TransactionTestCase):
+    """
+    Tests for :py:attr:`~jasmin_metadata.models.HasMetadata.metadata_dict` when the
+    metadata cache is enabled.
+
+    These run outside a test transaction, so that commits and rollbacks are real.
+    """
+    def setUp(self):
+        caches['default'].clear()
+        self.thing = Thing.objects.create(name = 'thing')
+        Metadatum.objects.set_for_object(self.thing, { 'a' : 'committed' })
+
+    def cached(self):
+        """
+        Returns the entry for the thing in the underlying Django cache.
+        """
+        cache = get_metadata_cache()
+        return cache.cache.get(cache.key(*self.target()))
+
+    def target(self):
+        return (ContentType.objects.get_for_model(Thing).pk, str(self.thing.pk))
+
+    def test_read_through(self):
+        self.assertEqual(self.thing.metadata_dict, { 'a' : 'committed' })
+        self.assertEqual(self.cached(), { 'a' : 'committed' })
+        with self.assertNumQueries(0):
+            self.assertEqual(self.thing.metadata_dict, { 'a' : 'committed' })
+
+    def test_rollback(self):
+        with self.assertRaises(Rollback):
+            with transaction.atomic():
+                Metadatum.objects.set_for_object(self.thing, { 'a' : 'rolled back' })
+                self.assertEqual(self.thing.metadata_dict, { 'a' : 'rolled back' })
+                raise Rollback
+        # The uncommitted metadata must not have been cached
+        self.assertIsNone(self.cached())
+        self.assertEqual(self.thing.metadata_dict, { 'a' : 'committed' })
+
+    def test_read_in_transaction_cached_on_commit(self):
+        with transaction.atomic():
+            self.assertEqual(self.thing.metadata_dict, { 'a' : 'committed' })
+            self.assertIsNone(self.cached())
+        self.assertEqual(self.cached(), { 'a' : 'committed' })
+
+    def test_read_after_write(self):
+        # Fill the cache with the committed metadata
+        self.assertEqual(self.thing.metadata_dict, { 'a' : 'committed' })
+        with transaction.atomic():
+            Metadatum.objects.set_for_object(self.thing, { 'a' : 'written' })
+            # The entry is removed straight away
+            self.assertIsNone(self.cached())
+            self.assertEqual(self.thing.metadata_dict, { 'a' : 'written' })
+            # Even if another reader caches the old metadata before the commit,
+            # the transaction still sees its own write
+            cache = get_metadata_cache()
+            cache.cache.set(cache.key(*self.target()), { 'a' : 'committed' })
+            self.assertEqual(self.thing.metadata_dict, { 'a' : 'written' })
+        # The old metadata cached by the other reader is removed on commit
+        self.assertEqual(self.thing.metadata_dict, { 'a' : 'written' })
+        self.assertEqual(self.cached(), { 'a' : 'written' })
@@ -0,0 +1,51 @@
+"""
+Tests for exporting and importing form definitions.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import json, os, tempfile
+
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from jasmin_metadata.benchmarks import SAMPLE_FIELDS, create_sample_form
+from jasmin_metadata.exchange import export_forms, import_forms
+from jasmin_metadata.models import Form, Field
+
+
+class ImportFormsTestCase(TestCase):
+    """
+    Tests for :py:func:`~jasmin_metadata.exchange.import_forms`.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.form = create_sample_form(len(SAMPLE_FIELDS))
+
+    def test_round_trip(self):
+        definitions = export_forms([self.form])
+        forms = import_forms(definitions)
+        self.assertEqual(len(forms), 1)
+        self.assertNotEqual(forms[0].pk, self.form.pk)
+        self.assertEqual(export_forms(forms), definitions)
+
+    def test_duplicate_field_name(self):
+        definitions = export_forms([self.form])
+        definitions[0]['fields'].append(definitions[0]['fields'][0])
+        with self.assertRaisesMessage(ValidationError, 'more than one field named field_0'):
+            import_forms(definitions)
+        self.assertEqual(Form.objects.count(), 1)
+        self.assertEqual(Field.objects.count(), len(SAMPLE_FIELDS))
+
+    def test_command_duplicate_field_name(self):
+        definitions = export_forms([self.form])
+        definitions[0]['fields'].append(definitions[0]['fields'][0])
+        fd, path = tempfile.mkstemp(suffix = '.json')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(definitions, fp)
+        with self.assertRaisesMessage(CommandError, 'Import failed'):
+            call_command('import_forms', path)
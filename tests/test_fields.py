@@ -0,0 +1,355 @@
+"""
+Tests for the encoding and indexing of metadata values.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import os, datetime, decimal, uuid, zlib
+from base64 import b64encode
+from io import StringIO
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db.models import TextField
+from django.db.models.functions import Cast
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from picklefield.fields import dbsafe_encode
+
+from jasmin_metadata.fields import (
+    JSON_PREFIX, encode_value, decode_value, get_raw_encoding, get_raw_compression,
+    get_value_compression, index_value
+)
+from jasmin_metadata.models import Metadatum
+
+from .models import Thing
+
+
+UTC = datetime.timezone.utc
+#: A time zone ahead of UTC
+CET = datetime.timezone(datetime.timedelta(hours = 1))
+#: A time zone behind UTC
+EST = datetime.timezone(datetime.timedelta(hours = -5))
+
+
+#: Values of all the types that the JSON encoding supports natively or by tagging
+SAMPLE_VALUES = [
+    True, 0, 1, -1.5, '', 'text', 'caf\u00e9', [], [1, 'a', None, [True]],
+    { 'a' : [1, 2], 'b' : { 'c' : None } },
+    { 1 : 'integer key', (1, 2) : 'tuple key' },
+    { '__type__' : 'not a tag', 'value' : 1 },
+    (1, 'a'), { 1, 2 }, frozenset(['a']),
+    datetime.datetime(2020, 9, 10, 12, 0, 0, 123456),
+    datetime.datetime(2020, 9, 10, 12, 0, tzinfo = datetime.timezone(datetime.timedelta(hours = 1))),
+    datetime.date(2020, 9, 10), datetime.time(12, 30),
+    decimal.Decimal('1.10'), uuid.UUID(int = 1),
+    [datetime.date(2020, 1, 1), decimal.Decimal('2')],
+]
+
+#: Strings that look like the start of an encoded or compressed value
+PREFIX_VALUES = [
+    'j:', 'j:1', 'j:"a"', 'j:not json', 'zp:', 'zj:', 'xp:abc', 'xj:abc',
+    'zj:' + b64encode(zlib.compress(b'1')).decode(),
+]
+
+
+def raw_values():
+    """
+    Returns a dictionary mapping the key of each stored metadatum to its stored string.
+    """
+    return dict(
+        Metadatum.objects
+            .annotate(raw_value = Cast('value', TextField()))
+            .values_list('key', 'raw_value')
+    )
+
+
+class EncodeValueTestCase(SimpleTestCase):
+    """
+    Tests for :py:func:`~jasmin_metadata.fields.encode_value` and
+    :py:func:`~jasmin_metadata.fields.decode_value`.
+    """
+    def assertRoundTrip(self, value, encoding, compression = 'none'):
+        raw = encode_value(value, encoding, compression = compression)
+        decoded = decode_value(raw)
+        self.assertEqual(decoded, value)
+        self.assertIs(type(decoded), type(value))
+        return raw
+
+    def test_pickle(self):
+        for value in SAMPLE_VALUES + PREFIX_VALUES:
+            with self.subTest(value = value):
+                raw = self.assertRoundTrip(value, 'pickle')
+                self.assertEqual(get_raw_encoding(raw), 'pickle')
+                self.assertNotIn(':', raw)
+
+    def test_json(self):
+        for value in SAMPLE_VALUES + PREFIX_VALUES:
+            with self.subTest(value = value):
+                raw = self.assertRoundTrip(value, 'json')
+                self.assertTrue(raw.startswith(JSON_PREFIX))
+                self.assertEqual(get_raw_encoding(raw), 'json')
+
+    def test_json_falls_back_to_pickle(self):
+        for value in [1 + 2j, b'bytes', [range(3)], { 'a' : float('nan') }, float('inf')]:
+            with self.subTest(value = value):
+                raw = encode_value(value, 'json')
+                self.assertEqual(get_raw_encoding(raw), 'pickle')
+                self.assertEqual(repr(decode_value(raw)), repr(value))
+
+    def test_legacy_pickle(self):
+        # Values written by PickledObjectField before the encodings were added
+        for value in SAMPLE_VALUES + PREFIX_VALUES:
+            with self.subTest(value = value):
+                raw = dbsafe_encode(value)
+                self.assertEqual(get_raw_encoding(raw), 'pickle')
+                self.assertEqual(get_raw_compression(raw), 'none')
+                self.assertEqual(decode_value(raw), value)
+
+    @override_settings(JASMIN_METADATA_VALUE_COMPRESSION_THRESHOLD = 0)
+    def test_compressed_headers(self):
+        for value in [SAMPLE_VALUES, 'text ' * 100]:
+            for compression, header in [('zlib', 'z'), ('lzma', 'x')]:
+                for encoding in ['pickle', 'json']:
+                    with self.subTest(value = value, encoding = encoding, compression = compression):
+                        raw = self.assertRoundTrip(value, encoding, compression)
+                        self.assertEqual(raw[:3], header + encoding[0] + ':')
+                        self.assertEqual(get_raw_encoding(raw), encoding)
+                        self.assertEqual(get_raw_compression(raw), compression)
+
+
+class MetadataValueFieldTestCase(TestCase):
+    """
+    Tests for storing values using :py:class:`~jasmin_metadata.fields.MetadataValueField`.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.thing = Thing.objects.create(name = 'thing')
+
+    def store(self, values):
+        data = { 'key_{}'.format(i) : value for i, value in enumerate(values) }
+        Metadatum.objects.set_for_object(self.thing, data)
+        return data
+
+    def stored(self):
+        return { d.key : d.value for d in Metadatum.objects.all() }
+
+    def test_round_trip(self):
+        for encoding in ['pickle', 'json']:
+            for compression in ['none', 'zlib', 'lzma']:
+                with self.subTest(encoding = encoding, compression = compression):
+                    with override_settings(
+                        JASMIN_METADATA_VALUE_ENCODING = encoding,
+                        JASMIN_METADATA_VALUE_COMPRESSION = compression,
+                        JASMIN_METADATA_VALUE_COMPRESSION_THRESHOLD = 0
+                    ):
+                        Metadatum.objects.all().delete()
+                        data = self.store(SAMPLE_VALUES + PREFIX_VALUES + ['text ' * 100])
+                        self.assertEqual(self.stored(), data)
+
+    def test_legacy_pickled_rows(self):
+        data = self.store(SAMPLE_VALUES + PREFIX_VALUES)
+        for key, value in data.items():
+            Metadatum.objects.filter(key = key).update(value = dbsafe_encode(value))
+        self.assertEqual(self.stored(), data)
+
+    def test_convert_metadata_values(self):
+        values = SAMPLE_VALUES + PREFIX_VALUES
+        data = self.store(values + [1 + 2j])
+        out = StringIO()
+        call_command('convert_metadata_values', encoding = 'json', batch_size = 7, stdout = out)
+        # The complex number can't be represented as JSON, so it stays pickled
+        self.assertIn('Converted {} of {} values'.format(len(values), len(data)), out.getvalue())
+        raw = raw_values()
+        self.assertEqual(
+            { key : get_raw_encoding(value) for key, value in raw.items() },
+            { key : 'json' if key != 'key_{}'.format(len(values)) else 'pickle' for key in data }
+        )
+        self.assertEqual(self.stored(), data)
+        # Converting again has nothing to do
+        call_command('convert_metadata_values', encoding = 'json', stdout = out)
+        self.assertIn('Converted 0 of {} values'.format(len(data)), out.getvalue())
+        self.assertEqual(raw_values(), raw)
+        # Convert back to pickle
+        call_command('convert_metadata_values', encoding = 'pickle', stdout = out)
+        self.assertEqual(set(map(get_raw_encoding, raw_values().values())), { 'pickle' })
+        self.assertEqual(self.stored(), data)
+
+
+#: A long value that compresses well
+LONG_TEXT = 'A longer piece of text, as entered in a multi-line text field.\n' * 50
+
+
+class CompressionTestCase(SimpleTestCase):
+    """
+    Tests for the compression of large values by :py:func:`~jasmin_metadata.fields.encode_value`.
+    """
+    def test_default_no_compression(self):
+        raw = encode_value(LONG_TEXT, 'json')
+        self.assertEqual(get_raw_compression(raw), 'none')
+
+    @override_settings(JASMIN_METADATA_VALUE_COMPRESSION = 'gzip')
+    def test_invalid_setting(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_value_compression()
+
+    @override_settings(JASMIN_METADATA_VALUE_COMPRESSION = 'zlib')
+    def test_threshold(self):
+        length = len(encode_value(LONG_TEXT, 'json', compression = 'none'))
+        for threshold, expected in [(length + 1, 'none'), (length, 'zlib'), (0, 'zlib')]:
+            with self.subTest(threshold = threshold):
+                with override_settings(JASMIN_METADATA_VALUE_COMPRESSION_THRESHOLD = threshold):
+                    raw = encode_value(LONG_TEXT, 'json')
+                    self.assertEqual(get_raw_compression(raw), expected)
+                    self.assertEqual(decode_value(raw), LONG_TEXT)
+
+    @override_settings(JASMIN_METADATA_VALUE_COMPRESSION_THRESHOLD = 0)
+    def test_smaller(self):
+        for compression in ['zlib', 'lzma']:
+            for encoding in ['pickle', 'json']:
+                with self.subTest(encoding = encoding, compression = compression):
+                    uncompressed = encode_value(LONG_TEXT, encoding, compression = 'none')
+                    compressed = encode_value(LONG_TEXT, encoding, compression = compression)
+                    self.assertEqual(get_raw_compression(compressed), compression)
+                    self.assertLess(len(compressed), len(uncompressed) / 10)
+
+    @override_settings(JASMIN_METADATA_VALUE_COMPRESSION_THRESHOLD = 0)
+    def test_not_compressed_unless_smaller(self):
+        # Protocol 4 pickles bytes as-is, so random bytes don't compress
+        for value, protocol in [(1, None), ('short', None), (os.urandom(2000), 4)]:
+            for compression in ['zlib', 'lzma']:
+                with self.subTest(value = value, compression = compression):
+                    raw = encode_value(value, 'pickle', protocol, compression)
+                    self.assertEqual(get_raw_compression(raw), 'none')
+                    self.assertEqual(raw, encode_value(value, 'pickle', protocol, 'none'))
+
+
+class ConvertCompressionTestCase(TestCase):
+    """
+    Tests for converting the compression of stored values using the
+    ``convert_metadata_values`` command.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        thing = Thing.objects.create(name = 'thing')
+        cls.data = {
+            'short' : 'short',
+            'text' : LONG_TEXT,
+            'choices' : ['choice_{}'.format(i) for i in range(200)],
+        }
+        Metadatum.objects.set_for_object(thing, cls.data)
+
+    def convert(self, compression):
+        out = StringIO()
+        call_command('convert_metadata_values', encoding = 'pickle', compression = compression, stdout = out)
+        return out.getvalue()
+
+    def compressions(self):
+        return { key : get_raw_compression(raw) for key, raw in raw_values().items() }
+
+    def stored(self):
+        return { d.key : d.value for d in Metadatum.objects.all() }
+
+    def test_convert(self):
+        self.assertEqual(set(self.compressions().values()), { 'none' })
+        for compression in ['zlib', 'lzma']:
+            with self.subTest(compression = compression):
+                self.assertIn('Converted 2 of 3 values', self.convert(compression))
+                # Values below the threshold are left uncompressed
+                self.assertEqual(self.compressions(), {
+                    'short' : 'none',
+                    'text' : compression,
+                    'choices' : compression,
+                })
+                self.assertEqual(self.stored(), self.data)
+                self.assertIn('Converted 0 of 3 values', self.convert(compression))
+        self.assertIn('Converted 2 of 3 values', self.convert('none'))
+        self.assertEqual(set(self.compressions().values()), { 'none' })
+        self.assertEqual(self.stored(), self.data)
+
+    @override_settings(JASMIN_METADATA_VALUE_COMPRESSION = 'zlib')
+    def test_written_compressed(self):
+        # Values written with compression enabled are compressed on save
+        thing = Thing.objects.create(name = 'other')
+        Metadatum.objects.set_for_object(thing, { 'other_text' : LONG_TEXT })
+        self.assertEqual(self.compressions()['other_text'], 'zlib')
+        self.assertEqual(thing.metadata_dict, { 'other_text' : LONG_TEXT })
+
+
+class IndexValueTestCase(SimpleTestCase):
+    """
+    Tests for :py:func:`~jasmin_metadata.fields.index_value`.
+    """
+    def test_types_distinguished(self):
+        values = [None, True, 1, 1.0, decimal.Decimal(1), '1', uuid.UUID(int = 1)]
+        indexed = [index_value(v) for v in values]
+        self.assertEqual(len(set(indexed)), len(values))
+
+    def test_non_scalar(self):
+        self.assertIsNone(index_value(['a']))
+        self.assertIsNone(index_value({ 'a' : 1 }))
+        self.assertIsNone(index_value('a' * 1000))
+
+    def test_aware_datetimes_in_utc(self):
+        instant = datetime.datetime(2020, 9, 10, 12, 0, tzinfo = UTC)
+        self.assertEqual(index_value(instant), 'dt:2020-09-10T12:00:00.000000+00:00')
+        self.assertEqual(index_value(instant.astimezone(CET)), index_value(instant))
+        self.assertEqual(index_value(instant.astimezone(EST)), index_value(instant))
+
+    def test_datetime_ordering(self):
+        values = [
+            datetime.datetime(2020, 9, 10, 12, 0, 0, 500000, tzinfo = UTC),
+            datetime.datetime(2020, 9, 10, 12, 30, tzinfo = CET),
+            datetime.datetime(2020, 9, 10, 8, 0, tzinfo = EST),
+            datetime.datetime(2020, 9, 10, 12, 0, tzinfo = UTC),
+            datetime.datetime(999, 1, 1, tzinfo = UTC),
+        ]
+        self.assertEqual(sorted(values, key = index_value), sorted(values))
+
+    def test_naive_datetime_and_time_ordering(self):
+        for values in [
+            [datetime.datetime(2020, 9, 10, 12, 0, 0, 1), datetime.datetime(2020, 9, 10, 12, 0)],
+            [datetime.time(12, 0, 0, 1), datetime.time(12, 0), datetime.time(9, 30)],
+            [datetime.date(2020, 9, 10), datetime.date(2019, 12, 31)],
+        ]:
+            with self.subTest(values = values):
+                self.assertEqual(sorted(values, key = index_value), sorted(values))
+
+
+class FilterMetadataTestCase(TestCase):
+    """
+    Tests for :py:meth:`~jasmin_metadata.models.HasMetadataQuerySet.filter_metadata`.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.instant = datetime.datetime(2020, 9, 10, 12, 0, tzinfo = UTC)
+        cls.first = Thing.objects.create(name = 'first')
+        cls.second = Thing.objects.create(name = 'second')
+        Metadatum.objects.set_for_object(
+            cls.first,
+            { 'when' : cls.instant.astimezone(CET), 'count' : 1, 'name' : 'first' }
+        )
+        Metadatum.objects.set_for_object(
+            cls.second,
+            { 'when' : cls.instant + datetime.timedelta(hours = 1), 'count' : '1' }
+        )
+
+    def test_datetime_in_other_time_zone(self):
+        for value in [self.instant, self.instant.astimezone(EST)]:
+            with self.subTest(value = value):
+                self.assertEqual(
+                    list(Thing.objects.filter_metadata('when', value)),
+                    [self.first]
+                )
+
+    def test_type_matters(self):
+        self.assertEqual(list(Thing.objects.filter_metadata('count', 1)), [self.first])
+        self.assertEqual(list(Thing.objects.filter_metadata('count', '1')), [self.second])
+
+    def test_missing(self):
+        self.assertEqual(list(Thing.objects.filter_metadata('name', 'second')), [])
+
+    def test_non_scalar(self):
+        with self.assertRaises(ValueError):
+            Thing.objects.filter_metadata('name', ['first'])
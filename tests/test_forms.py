@@ -0,0 +1,130 @@
+"""
+Tests for building forms from the form and field models.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from unittest import mock
+
+from django import forms
+from django.contrib.contenttypes.models import ContentType
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from jasmin_metadata.benchmarks import SAMPLE_FIELDS, create_sample_form
+from jasmin_metadata.dns import get_resolver
+from jasmin_metadata.forms import MetadataForm
+from jasmin_metadata.models import Field, Form, IntegerField
+
+
+class GetFieldsTestCase(TestCase):
+    """
+    Tests for :py:meth:`~jasmin_metadata.models.Form.get_fields`.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        # One field of each type, with choices for the choice fields
+        cls.form = create_sample_form(len(SAMPLE_FIELDS))
+
+    def setUp(self):
+        # Resolve the content types of the field models up front, so that the
+        # query count doesn't depend on the state of the content type cache
+        ContentType.objects.clear_cache()
+        ContentType.objects.get_for_models(*Field.subclass_paths())
+
+    def test_field_types(self):
+        fields = self.form.get_fields()
+        self.assertEqual([type(f) for f in fields], [model for model, _ in SAMPLE_FIELDS])
+
+    def test_num_queries(self):
+        # One query for the fields, joining the subclass tables, and one for the choices
+        with self.assertNumQueries(2):
+            form_fields = [f.get_field() for f in self.form.get_fields()]
+        self.assertEqual(len(form_fields), len(SAMPLE_FIELDS))
+
+
+class MetadataFormClassTestCase(TestCase):
+    """
+    Tests for :py:func:`~jasmin_metadata.forms.metadata_form_class`.
+    """
+    def test_field_named_form_id(self):
+        form = Form.objects.create(name = 'form')
+        IntegerField.objects.create(form = form, name = 'form_id', label = 'Form id', position = 0)
+        form_class = form.get_form()
+        self.assertEqual(form_class.form_id, form.pk)
+        self.assertEqual(list(form_class.base_fields), ['form_id'])
+        bound = form_class(data = { 'form_id' : '3' })
+        self.assertTrue(bound.is_valid(), bound.errors)
+        self.assertEqual(bound.cleaned_data, { 'form_id' : 3 })
+
+
+class RowForm(MetadataForm):
+    """
+    Form with field and form level cleaning, for testing ``validate_many``.
+    """
+    name = forms.CharField()
+    address = forms.GenericIPAddressField(required = False)
+    count = forms.IntegerField(required = False)
+
+    def clean_name(self):
+        return self.cleaned_data['name'].upper()
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('count') == 0:
+            raise forms.ValidationError('Count must not be zero')
+        return cleaned_data
+
+RowForm.base_fields['address'].reverse_dns_lookup = True
+
+
+@override_settings(
+    JASMIN_METADATA_DNS_RESOLVER = 'jasmin_metadata.dns.StaticResolver',
+    JASMIN_METADATA_DNS_OPTIONS = { 'hosts' : { '192.0.2.1' : 'host.example.com' } }
+)
+class ValidateManyTestCase(SimpleTestCase):
+    """
+    Tests for :py:meth:`~jasmin_metadata.forms.MetadataForm.validate_many`.
+    """
+    def test_clean_methods_run_per_row(self):
+        results = list(RowForm.validate_many([
+            { 'name' : 'first', 'count' : '1' },
+            { 'name' : 'second', 'count' : '0' },
+            { 'name' : 'third' },
+        ]))
+        self.assertEqual([r.index for r in results], [0, 1, 2])
+        self.assertEqual(results[0].cleaned_data, { 'name' : 'FIRST', 'address' : '', 'count' : 1 })
+        self.assertEqual(results[0].errors, {})
+        self.assertIsNone(results[1].cleaned_data)
+        self.assertEqual(results[1].errors, { '__all__' : ['Count must not be zero'] })
+        self.assertEqual(results[2].cleaned_data, { 'name' : 'THIRD', 'address' : '', 'count' : None })
+
+    def test_no_leakage_between_rows(self):
+        results = list(RowForm.validate_many([
+            { 'count' : 'x' },
+            { 'name' : 'valid' },
+            { 'name' : 'a', 'count' : '0' },
+            { 'name' : 'b', 'count' : '2' },
+        ]))
+        self.assertEqual(set(results[0].errors), { 'name', 'count' })
+        self.assertEqual(results[1].errors, {})
+        self.assertEqual(results[1].cleaned_data['name'], 'VALID')
+        self.assertEqual(list(results[2].errors), ['__all__'])
+        self.assertEqual(results[3].errors, {})
+        # The cleaned data yielded for earlier rows is not changed by later rows
+        self.assertEqual(results[1].cleaned_data['count'], None)
+        self.assertEqual(results[3].cleaned_data['count'], 2)
+
+    def test_chunks(self):
+        rows = [{ 'name' : str(i), 'address' : '192.0.2.1' } for i in range(5)]
+        rows[3]['address'] = '192.0.2.2'
+        resolver = get_resolver()
+        with mock.patch.object(resolver, 'resolve_many', wraps = resolver.resolve_many) as resolve_many:
+            results = list(RowForm.validate_many(iter(rows), chunk_size = 2))
+        # One concurrent lookup per chunk, made before the chunk is validated
+        self.assertEqual(
+            [sorted(call.args[0]) for call in resolve_many.call_args_list],
+            [['192.0.2.1'], ['192.0.2.1', '192.0.2.2'], ['192.0.2.1']]
+        )
+        self.assertEqual([r.index for r in results], list(range(5)))
+        self.assertEqual([r.cleaned_data['name'] for r in results], ['0', '1', '2', '3', '4'])
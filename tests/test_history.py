@@ -0,0 +1,124 @@
+"""
+Tests for recording the history of metadata changes.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import datetime
+from unittest import mock
+
+from django.db import IntegrityError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from jasmin_metadata.models import Metadatum, MetadataRevision
+from jasmin_metadata.models.history import MetadataRevisionManager
+from jasmin_metadata.models.targets import metadata_target
+
+from .models import Thing
+
+
+@override_settings(
+    JASMIN_METADATA_HISTORY = True,
+    JASMIN_METADATA_HISTORY_SNAPSHOT_INTERVAL = 3
+)
+class MetadataHistoryTestCase(TestCase):
+    """
+    Tests for :py:class:`~jasmin_metadata.models.MetadataRevisionManager` and
+    :py:meth:`~jasmin_metadata.models.HasMetadata.metadata_as_of`.
+    """
+    def setUp(self):
+        self.thing = Thing.objects.create(name = 'thing')
+        self.start = timezone.now()
+
+    def at(self, minutes):
+        return self.start + datetime.timedelta(minutes = minutes)
+
+    def write(self, minutes, data, replace = True):
+        """
+        Writes the given metadata for the thing as if it was the given number of
+        minutes after the start of the test.
+        """
+        with mock.patch('django.utils.timezone.now', return_value = self.at(minutes)):
+            if replace:
+                Metadatum.objects.set_for_object(self.thing, data)
+            else:
+                Metadatum.objects.update_for_object(self.thing, data)
+
+    def test_record(self):
+        self.write(0, { 'a' : 1, 'b' : 2 })
+        self.write(1, { 'a' : 1, 'b' : 3 })
+        # Writing the same data does not record a revision
+        self.write(2, { 'a' : 1, 'b' : 3 })
+        self.write(3, { 'a' : 1 })
+        self.write(4, { 'c' : 4 }, replace = False)
+        revisions = MetadataRevision.objects.for_object(self.thing).order_by('number')
+        self.assertEqual(
+            [(r.number, r.is_snapshot, r.changed, r.removed) for r in revisions],
+            [
+                (0, True, { 'a' : 1, 'b' : 2 }, []),
+                (1, False, { 'b' : 3 }, []),
+                (2, False, {}, ['b']),
+                # The interval is reached on a partial update, so the metadata is loaded
+                (3, True, { 'a' : 1, 'c' : 4 }, []),
+            ]
+        )
+
+    def test_as_of(self):
+        values = [{ 'a' : i, 'b' : 'x' * i } for i in range(8)]
+        for i, data in enumerate(values):
+            self.write(i, data)
+        self.write(8, {})
+        self.assertEqual(self.thing.metadata_as_of(self.at(-1)), {})
+        for i, data in enumerate(values):
+            with self.subTest(minutes = i):
+                # Replaying from the latest snapshot takes a single query
+                with self.assertNumQueries(1):
+                    self.assertEqual(self.thing.metadata_as_of(self.at(i)), data)
+        self.assertEqual(self.thing.metadata_as_of(self.at(8)), {})
+
+    def test_as_of_without_snapshot(self):
+        for i in range(4):
+            self.write(i, { 'a' : i })
+        # Remove the snapshot, as if the history had been pruned
+        MetadataRevision.objects.for_object(self.thing).filter(number = 3).delete()
+        self.assertEqual(
+            MetadataRevision.objects.as_of(self.thing, self.at(3)),
+            { 'a' : 2 }
+        )
+
+    def test_record_concurrent_write(self):
+        self.write(0, { 'a' : 1 })
+        target = metadata_target(self.thing)
+        latest_numbers = MetadataRevisionManager._latest_numbers
+
+        def stale_latest_numbers(manager, changes):
+            # Read the numbers, then record a revision as if another writer got in first
+            latest = latest_numbers(manager, changes)
+            if not stale_latest_numbers.raced:
+                stale_latest_numbers.raced = True
+                MetadataRevision.objects.create(
+                    content_type = target.content_type, object_id = target.object_id,
+                    number = 1, created = self.at(1), changed = { 'a' : 2 }, removed = []
+                )
+            return latest
+        stale_latest_numbers.raced = False
+
+        with mock.patch.object(MetadataRevisionManager, '_latest_numbers', stale_latest_numbers):
+            self.write(2, { 'a' : 3 })
+        revisions = MetadataRevision.objects.for_object(self.thing).order_by('number')
+        self.assertEqual([(r.number, r.changed) for r in revisions], [
+            (0, { 'a' : 1 }),
+            (1, { 'a' : 2 }),
+            (2, { 'a' : 3 }),
+        ])
+        # The metadata written in the same transaction was kept
+        self.assertEqual(self.thing.metadata_dict, { 'a' : 3 })
+
+    def test_record_gives_up(self):
+        self.write(0, { 'a' : 1 })
+        with mock.patch.object(MetadataRevisionManager, '_latest_numbers', return_value = {}):
+            with self.assertRaises(IntegrityError):
+                self.write(1, { 'a' : 2 })
+        self.assertEqual(MetadataRevision.objects.for_object(self.thing).count(), 1)
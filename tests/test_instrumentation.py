@@ -0,0 +1,75 @@
+"""
+Tests for the instrumentation hooks.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import io, json
+
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from jasmin_metadata.instrumentation import CacheCollector, get_collector
+from jasmin_metadata.models import Form, RegexField
+
+
+class CacheCollectorTestCase(SimpleTestCase):
+    """
+    Tests for :py:class:`~jasmin_metadata.instrumentation.CacheCollector`.
+    """
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_shared_between_collectors(self):
+        # Each collector stands in for a different process
+        first, second = CacheCollector(), CacheCollector()
+        first.timing('op', 0.5)
+        second.timing('op', 1.5)
+        first.increment('bytes', 10)
+        second.increment('bytes', 5)
+        stats = CacheCollector().stats()
+        self.assertEqual(
+            dict(stats['timings']['op']),
+            { 'count' : 2, 'total' : 2.0, 'mean' : 1.0, 'min' : 0.5, 'max' : 1.5 }
+        )
+        self.assertEqual(dict(stats['counters']), { 'bytes' : 15 })
+
+    def test_reset(self):
+        # Re-register the names every time, rather than after a minute
+        collector = CacheCollector(refresh = 0)
+        collector.timing('op', 0.5)
+        collector.increment('bytes', 10)
+        CacheCollector().reset()
+        self.assertEqual(collector.stats(), { 'timings' : {}, 'counters' : {} })
+        # The names are registered again after a reset by another process
+        collector.increment('bytes', 1)
+        self.assertEqual(dict(collector.stats()['counters']), { 'bytes' : 1 })
+
+    @override_settings(
+        JASMIN_METADATA_INSTRUMENTATION = True,
+        JASMIN_METADATA_COLLECTOR = 'jasmin_metadata.instrumentation.CacheCollector'
+    )
+    def test_dump_metadata_stats(self):
+        # Statistics recorded by another process are dumped
+        CacheCollector().increment('bytes', 10)
+        stdout = io.StringIO()
+        call_command('dump_metadata_stats', stdout = stdout)
+        self.assertEqual(json.loads(stdout.getvalue())['counters'], { 'bytes' : 10 })
+
+
+class ValidatorTimingTestCase(TestCase):
+    """
+    Tests for the timing of field validators.
+    """
+    def test_form_class_built_before_enabled(self):
+        form = Form.objects.create(name = 'timed')
+        RegexField.objects.create(form = form, name = 'slug', label = 'Slug', regex = '^[a-z]+$')
+        # Build and cache the form class while instrumentation is disabled
+        form_class = form.get_form()
+        with override_settings(JASMIN_METADATA_INSTRUMENTATION = True):
+            self.assertIs(form.get_form(), form_class)
+            self.assertTrue(form_class(data = { 'slug' : 'abc' }).is_valid())
+            timings = get_collector().stats()['timings']
+        self.assertIn('field.validate.regexfield', timings)
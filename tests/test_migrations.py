@@ -0,0 +1,69 @@
+"""
+Tests for the data migrations of the JASMIN metadata app.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from importlib import import_module
+from types import SimpleNamespace
+
+from django.apps import apps
+from django.db import connection
+from django.db.models import BigIntegerField
+from django.db.models.functions import Cast
+from django.test import TestCase
+
+from jasmin_metadata.models import Metadatum
+from jasmin_metadata.models.targets import parse_object_int_id
+
+from .models import Thing
+
+
+#: Object ids around the limits of the integer object id column
+OBJECT_IDS = [
+    '0', '-0', '7', '-7', '007', '1.0', ' 1', 'abc',
+    '999999999999999999',
+    '9223372036854775807', '-9223372036854775808',
+    '9223372036854775808', '-9223372036854775809',
+    '9999999999999999999', '10000000000000000000',
+]
+
+
+class PopulateObjectIntIdsTestCase(TestCase):
+    """
+    Tests for the migrations that populate :py:attr:`Metadatum.object_int_id`.
+    """
+    def setUp(self):
+        thing = Thing.objects.create(name = 'thing')
+        Metadatum.objects.set_for_object(thing, { 'a' : 1 })
+        datum = Metadatum.objects.get()
+        Metadatum.objects.bulk_create([
+            Metadatum(content_type = datum.content_type, object_id = object_id, key = 'a', value = 1)
+            for object_id in OBJECT_IDS
+        ])
+        # Clear the integer ids as if the rows were written before they existed
+        Metadatum.objects.update(object_int_id = None)
+        self.schema_editor = SimpleNamespace(connection = connection)
+
+    def run_migration(self, name, function):
+        module = import_module('jasmin_metadata.migrations.{}'.format(name))
+        getattr(module, function)(apps, self.schema_editor)
+
+    def assertPopulated(self):
+        self.assertEqual(
+            dict(Metadatum.objects.filter(object_id__in = OBJECT_IDS).values_list('object_id', 'object_int_id')),
+            { object_id : parse_object_int_id(object_id) for object_id in OBJECT_IDS }
+        )
+
+    def test_0009(self):
+        self.run_migration('0009_metadatum_object_int_id', 'populate_object_int_ids')
+        self.assertPopulated()
+
+    def test_0012(self):
+        # Populate the rows as the old version of 0009 did
+        Metadatum.objects \
+            .filter(object_id__regex = r'^(0|-?[1-9][0-9]{0,17})$') \
+            .update(object_int_id = Cast('object_id', BigIntegerField()))
+        self.run_migration('0012_metadatum_object_int_id_long', 'populate_long_object_int_ids')
+        self.assertPopulated()
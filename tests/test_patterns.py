@@ -0,0 +1,69 @@
+"""
+Tests for the validation of the regular expressions entered for regex fields.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from django.core.exceptions import ValidationError
+from django.test import SimpleTestCase, TestCase
+
+from jasmin_metadata.models import Form, RegexField
+from jasmin_metadata.patterns import validate_pattern
+
+
+class ValidatePatternTestCase(SimpleTestCase):
+    """
+    Tests for :py:func:`~jasmin_metadata.patterns.validate_pattern`.
+    """
+    #: Patterns that can be matched in linear time
+    SAFE = [
+        r'^[a-z]+$',
+        r'\d+(\.\d+)*',
+        r'^\d+(\.\d+)*$',
+        r'^[a-z]+(-[a-z]+)*$',
+        r'^(\d{1,3}\.){3}\d{1,3}$',
+        r'([^,]+,)*',
+        r'(a+b)+',
+        r'(\d|\w)+',
+        r'^[\w.+-]+@[\w-]+(\.[\w-]+)+$',
+    ]
+
+    #: Patterns that can take exponential time to fail
+    UNSAFE = [
+        r'(a+)+',
+        r'(a|aa)+',
+        r'(a|aa)+$',
+        r'(\w*,?)*',
+        r'(\w+\s?)*$',
+        r'(.*a){20}',
+        r'(?:a?){20}a{20}',
+        r'^(a+){2,10}$',
+    ]
+
+    def test_safe(self):
+        for pattern in self.SAFE:
+            with self.subTest(pattern = pattern):
+                validate_pattern(pattern)
+
+    def test_unsafe(self):
+        for pattern in self.UNSAFE:
+            with self.subTest(pattern = pattern):
+                with self.assertRaises(ValidationError):
+                    validate_pattern(pattern)
+
+    def test_invalid(self):
+        with self.assertRaisesMessage(ValidationError, 'Not a valid regular expression'):
+            validate_pattern('(a')
+
+
+class RegexFieldTestCase(TestCase):
+    """
+    Tests for :py:class:`~jasmin_metadata.models.RegexField`.
+    """
+    def test_save_validates_pattern(self):
+        form = Form.objects.create(name = 'regex')
+        field = RegexField(form = form, name = 'code', label = 'Code', regex = '(a|aa)+$')
+        with self.assertRaises(ValidationError):
+            field.save()
+        self.assertFalse(RegexField.objects.exists())
@@ -0,0 +1,118 @@
+"""
+Tests for the flat table projections of form metadata.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+from django.contrib.contenttypes.models import ContentType
+from django.test import TransactionTestCase, override_settings
+
+from jasmin_metadata.models import (
+    Form, FormProjection, IntegerField, Metadatum, ProjectionUpdate, SingleLineTextField
+)
+
+from .models import Thing
+
+
+@override_settings(JASMIN_METADATA_PROJECTIONS = True)
+class FormProjectionTestCase(TransactionTestCase):
+    """
+    Tests for :py:class:`~jasmin_metadata.models.FormProjection`.
+
+    These run outside a test transaction, as SQLite can't create the projection
+    tables inside one.
+    """
+    def setUp(self):
+        self.form = Form.objects.create(name = 'projected')
+        # Include fields named after the fixed columns of the table
+        for position, name in enumerate(['name', '_pk', '_content_type_id', '_object_id']):
+            SingleLineTextField.objects.create(
+                form = self.form, name = name, label = name, required = False, position = position
+            )
+        IntegerField.objects.create(
+            form = self.form, name = 'count', label = 'Count', required = False, position = 10
+        )
+        self.form.refresh_from_db()
+        self.projection = FormProjection.objects.create(form = self.form)
+
+    def tearDown(self):
+        self.projection.drop()
+
+    def save_metadata(self, thing, **data):
+        form = self.form.get_form()(data = data)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save(thing)
+
+    def rows(self):
+        """
+        Returns a dictionary mapping object ids to dictionaries of the projected
+        values, keyed by field name.
+        """
+        model = FormProjection.objects.get(pk = self.projection.pk).get_model()
+        return {
+            int(row.projected_object_id) : {
+                field.name : getattr(row, attname)
+                for attname, field in model.projection_columns
+            }
+            for row in model._base_manager.all()
+        }
+
+    def test_rebuild(self):
+        things = [Thing.objects.create(name = 'thing {}'.format(i)) for i in range(2)]
+        for i, thing in enumerate(things):
+            Metadatum.objects.set_for_object(thing, {
+                'name' : 'Thing {}'.format(i),
+                '_pk' : 'pk {}'.format(i),
+                '_content_type_id' : 'content type {}'.format(i),
+                '_object_id' : 'object {}'.format(i),
+                'count' : i,
+            })
+        self.projection.content_types.add(ContentType.objects.get_for_model(Thing))
+        self.assertEqual(self.projection.rebuild(), 2)
+        self.assertEqual(
+            self.rows(),
+            {
+                thing.pk : {
+                    'name' : 'Thing {}'.format(i),
+                    '_pk' : 'pk {}'.format(i),
+                    '_content_type_id' : 'content type {}'.format(i),
+                    '_object_id' : 'object {}'.format(i),
+                    'count' : i,
+                }
+                for i, thing in enumerate(things)
+            }
+        )
+
+    def test_sync(self):
+        self.projection.rebuild()
+        thing = Thing.objects.create(name = 'thing')
+        self.save_metadata(thing, name = 'Thing', _pk = 'pk', count = '3')
+        self.assertEqual(self.rows()[thing.pk]['_pk'], 'pk')
+        self.assertEqual(self.rows()[thing.pk]['count'], 3)
+        self.assertFalse(ProjectionUpdate.objects.exists())
+
+    def test_refresh(self):
+        self.projection.mode = FormProjection.MODE_INCREMENTAL
+        self.projection.save()
+        self.projection.rebuild()
+        thing = Thing.objects.create(name = 'thing')
+        self.save_metadata(thing, name = 'Thing', count = '3')
+        self.assertEqual(self.rows(), {})
+        self.assertEqual(self.projection.refresh(), 1)
+        self.assertEqual(self.rows()[thing.pk]['name'], 'Thing')
+        self.assertFalse(ProjectionUpdate.objects.exists())
+
+    def test_rebuild_includes_queued(self):
+        # Saves made before the table is built are queued
+        thing = Thing.objects.create(name = 'thing')
+        self.save_metadata(thing, name = 'Thing')
+        self.assertTrue(ProjectionUpdate.objects.exists())
+        self.assertEqual(self.projection.rebuild(), 1)
+        self.assertEqual(self.rows()[thing.pk]['name'], 'Thing')
+        self.assertFalse(ProjectionUpdate.objects.exists())
+
+    def test_names_differing_in_case(self):
+        SingleLineTextField.objects.create(form = self.form, name = 'Name', label = 'Name')
+        with self.assertRaises(ValueError):
+            self.projection.rebuild()
@@ -0,0 +1,78 @@
+"""
+Tests for form schema snapshots.
+"""
+
+__author__ = "Matt Pryor"
+__copyright__ = "Copyright 2015 UK Science and Technology Facilities Council"
+
+import io, os, tempfile
+from datetime import timedelta
+from unittest import mock
+
+from django.apps import apps
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from jasmin_metadata.models import Form, SingleLineTextField
+from jasmin_metadata.models.forms import form_class_cache
+from jasmin_metadata.schema import dump_schemas, load_schemas, warm_form_cache, set_cached_schema
+
+
+class SchemaTestCase(TestCase):
+    """
+    Tests for building forms from schema snapshots.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.form = Form.objects.create(name = 'snapshot')
+        SingleLineTextField.objects.create(
+            form = cls.form, name = 'name', label = 'Name', required = True, position = 1
+        )
+
+    def setUp(self):
+        form_class_cache.clear()
+        self.form.refresh_from_db()
+
+    def snapshot(self):
+        """
+        Returns a snapshot of the form after a round trip through a file.
+        """
+        fp = io.StringIO()
+        dump_schemas([self.form.get_schema()], fp)
+        fp.seek(0)
+        return load_schemas(fp)
+
+    def test_round_trip(self):
+        warm_form_cache(self.snapshot())
+        with self.assertNumQueries(0):
+            form_class = self.form.get_form()
+        self.assertEqual(list(form_class.base_fields), ['name'])
+
+    def test_snapshot_for_other_schema_not_used(self):
+        schemas = self.snapshot()
+        # Change the form without going through the signals, as e.g. a different
+        # database with the same form id and schema version would
+        Form.objects.filter(pk = self.form.pk).update(
+            modified = self.form.modified + timedelta(seconds = 1)
+        )
+        SingleLineTextField.objects.filter(form = self.form).update(name = 'renamed')
+        warm_form_cache(schemas)
+        self.form.refresh_from_db()
+        self.assertEqual(list(self.form.get_form().base_fields), ['renamed'])
+
+    def test_missing_file(self):
+        path = os.path.join(tempfile.gettempdir(), 'jasmin_metadata_missing_schemas.json')
+        if os.path.exists(path):
+            os.remove(path)
+        with override_settings(JASMIN_METADATA_SCHEMA_FILE = path):
+            with self.assertWarns(RuntimeWarning):
+                apps.get_app_config('jasmin_metadata').ready()
+
+    @override_settings(
+        JASMIN_METADATA_SCHEMA_CACHE = 'default',
+        JASMIN_METADATA_SCHEMA_CACHE_TIMEOUT = 60
+    )
+    def test_schema_cache_timeout(self):
+        with mock.patch.object(caches['default'], 'set') as cache_set:
+            set_cached_schema(self.form.get_schema())
+        self.assertEqual(cache_set.call_args[0][2], 60)